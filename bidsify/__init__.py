@@ -1,2 +1,4 @@
 from __future__ import absolute_import, division, print_function
 from .main import bidsify  # noqa
+from .batch import bidsify_batch  # noqa
+from .scheduler import get_scheduler, usage_tags  # noqa
@@ -0,0 +1,116 @@
+from __future__ import print_function, division
+import os.path as op
+import warnings
+import numpy as np
+import nibabel as nib
+from nibabel.parrec import PARRECHeader
+
+try:
+    import pydicom
+except ImportError:  # optional, only to read the dimensions of dcm files
+    pydicom = None
+
+# Memory of a session besides the images it processes (in bytes)
+BASE_MEMORY = 256 * 1024 ** 2
+
+# Copies of each image that are in memory at the same time while it is
+# converted, reoriented, or defaced (e.g., the input and output of
+# fslreorient2std, which also converts the image to float)
+MEMORY_COPIES = 3
+
+
+def estimate_session(source, cfg, n_cores=1):
+    """ Estimates the peak disk usage and memory of converting a session.
+
+    On disk, a session holds its raw files, the uncompressed images (from
+    dcm2niix) and their reoriented or compressed versions, and a defaced
+    copy of the images. In memory, the largest images are processed at the
+    same time (at most one per core). The sizes of the images are read from
+    the PAR, dcm (if pydicom is installed), and nifti headers; for other
+    files and archive members, the size of the raw file is used.
+
+    Parameters
+    ----------
+    source : DirSource or ArchiveSource
+        Raw data of the session
+    cfg : dict
+        Config dictionary
+    n_cores : int
+        Number of images that may be processed at the same time
+
+    Returns
+    -------
+    disk : int
+        Estimated peak disk usage (in bytes)
+    memory : int
+        Estimated peak memory (in bytes)
+    """
+
+    options = cfg['options']
+    files = source.list_files()
+    if source.is_archive:
+        # Headers cannot be read without extracting the members, but their
+        # sizes are known from the listing of the archive
+        sizes = source.file_sizes(files)
+        raw = sum(sizes.values())
+        images = [_member_image_size(f, sizes[f], options['mri_ext'])
+                  for f in files]
+    else:
+        raw = sum(op.getsize(f) for f in files)
+        images = [_image_size(f, options['mri_ext']) for f in files]
+
+    images = [size for size in images if size is not None]
+    if options['mri_ext'] == 'DICOM':
+        images = [sum(images)]  # a single series per directory
+
+    copies = 2 + (1 if options['deface'] else 0)
+    disk = raw + copies * sum(images)
+    largest = sorted(images, reverse=True)[:max(n_cores, 1)]
+    memory = BASE_MEMORY + MEMORY_COPIES * sum(largest)
+    return int(disk), int(memory)
+
+
+def _member_image_size(name, size, mri_ext):
+    """ Approximate size (in bytes) of the image in an archive member, i.e.
+    the size of its (raw) data, or None if the member is not an image. """
+
+    fname = name.lower()
+    if (mri_ext == 'DICOM' or (mri_ext == 'PAR' and fname.endswith('.rec'))
+            or (mri_ext == 'dcm' and fname.endswith('.dcm'))
+            or fname.endswith('.nii') or fname.endswith('.nii.gz')):
+        return size
+
+    return None
+
+
+def _image_size(f, mri_ext):
+    """ Size (in bytes) of the (uncompressed) image in a raw file, or None
+    if the file is not an image. """
+
+    fname = op.basename(f).lower()
+    try:
+        if mri_ext == 'PAR' and fname.endswith('.par'):
+            with warnings.catch_warnings(), open(f) as f_in:
+                warnings.simplefilter('ignore', UserWarning)
+                hdr = PARRECHeader.from_fileobj(f_in, permit_truncated=True)
+            return int(np.prod(hdr.get_data_shape())) * max(hdr.get_data_dtype().itemsize, 2)
+
+        if mri_ext == 'dcm' and fname.endswith('.dcm'):
+            if pydicom is None:
+                return op.getsize(f)
+
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+            return (int(ds.Rows) * int(ds.Columns) * int(getattr(ds, 'NumberOfFrames', 1))
+                    * int(ds.BitsAllocated) // 8)
+
+        if mri_ext == 'DICOM':
+            return op.getsize(f)
+
+        if fname.endswith('.nii') or fname.endswith('.nii.gz'):
+            hdr = nib.load(f).header
+            return int(np.prod(hdr.get_data_shape())) * hdr.get_data_dtype().itemsize
+    except Exception:
+        # Unreadable headers are reported when the file is converted
+        return op.getsize(f)
+
+    return None
@@ -0,0 +1,149 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import tarfile
+import threading
+from glob import glob
+from .utils import _make_dir
+
+ARCHIVE_MODES = ['dataset', 'subject']
+
+
+class BIDSArchive(object):
+    """ Streams finished BIDS files into (uncompressed) tar archives.
+
+    Files are added as soon as a session has been converted, while they
+    are still in the page cache, so the archive is ready when the conversion
+    ends. For each archive, an index (``<archive>.index.tsv``) with the
+    offset and size of each member is written as well, so members can be
+    extracted without scanning the archive.
+
+    Re-runs append the newly converted sessions to the existing archives
+    (members that are in an archive already are skipped). The dataset-level
+    files (e.g. participants.tsv), which change between runs, are written to
+    a separate archive (``<dataset>_toplevel.tar``) that is replaced by every
+    run (see `write_toplevel`).
+
+    Parameters
+    ----------
+    out_dir : str
+        BIDS root directory (member names are relative to this dir)
+    mode : str
+        Either 'dataset' (one tar for the whole dataset) or 'subject'
+        (one tar per subject plus one for the dataset-level files)
+    archive_dir : str or None
+        Directory to write the archive(s) to; defaults to the parent
+        directory of out_dir
+    """
+
+    def __init__(self, out_dir, mode='dataset', archive_dir=None):
+
+        if mode not in ARCHIVE_MODES:
+            raise ValueError("Archive mode should be one of %r, not '%s'!" %
+                             (ARCHIVE_MODES, mode))
+
+        self.out_dir = out_dir
+        self.mode = mode
+        if archive_dir is None:
+            archive_dir = op.dirname(op.abspath(out_dir))
+        self.archive_dir = _make_dir(archive_dir)
+        self._tars = dict()
+        self._members = dict()  # key -> names of the members in the archive
+        self._lock = threading.Lock()
+
+    def add_session(self, session_dir):
+        """ Adds all files of a converted session (or subject without
+        sessions) to the archive. """
+
+        files = sorted(f for f in glob(op.join(session_dir, '**', '*'), recursive=True)
+                       if op.isfile(f))
+        sub_name = op.relpath(session_dir, self.out_dir).split(os.sep)[0]
+        self.add_files(files, key=sub_name if self.mode == 'subject' else 'dataset')
+
+    def add_files(self, files, key='dataset'):
+        """ Adds files to the archive with the given key ('dataset' or a
+        subject name). """
+
+        with self._lock:
+            tar, index = self._open(key)
+            for f in files:
+                arcname = op.relpath(f, self.out_dir)
+                if arcname in self._members[key]:
+                    continue
+
+                self._members[key].add(arcname)
+                info = tar.gettarinfo(f, arcname=arcname)
+                offset = tar.offset
+                with open(f, 'rb') as f_in:
+                    tar.addfile(info, f_in)
+
+                # Data is padded to full blocks and preceded by the header
+                n_blocks = -(-info.size // tarfile.BLOCKSIZE)
+                offset_data = tar.offset - n_blocks * tarfile.BLOCKSIZE
+                index.write('%s\t%i\t%i\t%i\n' % (arcname, offset,
+                                                  offset_data, info.size))
+            index.flush()
+
+    def write_toplevel(self, files):
+        """ Writes the dataset-level files to their own archive, replacing
+        the one of previous runs (instead of adding duplicate members). """
+
+        with self._lock:
+            self._close('toplevel')
+            path = self.get_path('toplevel')
+            for f in [path, path + '.index.tsv']:
+                if op.isfile(f):
+                    os.remove(f)
+
+        self.add_files(files, key='toplevel')
+        with self._lock:
+            self._close('toplevel')
+
+    def close_subject(self, sub_name):
+        """ Closes the archive of a subject (if in subject mode). """
+        if self.mode == 'subject':
+            with self._lock:
+                self._close(sub_name)
+
+    def close(self):
+        """ Closes all open archives. """
+        with self._lock:
+            for key in list(self._tars):
+                self._close(key)
+
+    def get_path(self, key='dataset'):
+        """ Returns the path to the archive for a given key. """
+        if key == 'toplevel':
+            name = op.basename(op.normpath(self.out_dir)) + '_toplevel'
+        elif self.mode == 'dataset' or key == 'dataset':
+            name = op.basename(op.normpath(self.out_dir))
+        else:
+            name = key
+        return op.join(self.archive_dir, name + '.tar')
+
+    def _open(self, key):
+        if key not in self._tars:
+            path = self.get_path(key)
+            # Append mode, so re-runs add the newly converted sessions
+            tar = tarfile.open(path, mode='a', format=tarfile.GNU_FORMAT)
+            index_path = path + '.index.tsv'
+            is_new = not op.isfile(index_path)
+            members = set()
+            if not is_new:
+                with open(index_path) as f_in:
+                    next(f_in, None)  # header
+                    members.update(line.split('\t')[0] for line in f_in)
+
+            index = open(index_path, 'a')
+            if is_new:
+                index.write('member\toffset\toffset_data\tsize\n')
+            self._tars[key] = (tar, index)
+            self._members[key] = members
+
+        return self._tars[key]
+
+    def _close(self, key):
+        if key in self._tars:
+            tar, index = self._tars.pop(key)
+            tar.close()
+            index.close()
@@ -0,0 +1,120 @@
+from __future__ import print_function, division
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .main import _BidsifyRun
+from .scheduler import get_scheduler
+
+JOB_KEYS = ['cfg_path', 'directory', 'out_dir', 'validate', 'scratch_dir']
+
+
+def bidsify_batch(jobs, n_parallel=None, n_cores=None, tool_limits=None):
+    """ Converts many raw datasets, yielding results as sessions finish.
+
+    All jobs share the (persistent) worker pool and tool scheduler, so the
+    CPU budget holds for the whole batch. Sessions of different jobs are
+    processed concurrently, but sessions of the same job are processed one
+    at a time; jobs get a free slot in round-robin order, so a big project
+    cannot starve the others.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs, either as dicts (with cfg_path, directory, out_dir, and
+        optionally validate and scratch_dir) or as (cfg_path, directory,
+        out_dir) tuples
+    n_parallel : int or None
+        Max. number of sessions in flight (default: the number of jobs,
+        but at most the number of cores)
+    n_cores : int or None
+        CPU budget of the batch (joblib-style); the n_cores and tool_limits
+        options in the configs of the jobs are ignored
+    tool_limits : dict or None
+        Per-tool limits for the batch
+
+    Yields
+    ------
+    result : dict
+        Result of a session, with keys job (index of the job), session,
+        status ('converted', 'skipped', 'empty', or 'failed' if the job's
+        on_error option is 'continue'), outputs, wall_time, and error (None,
+        or the traceback of a failed session). When a job is done, a result with session None and
+        status 'done' (with the BIDSIndex of the dataset under 'index') or
+        'failed' (with the traceback under 'error') is yielded.
+    """
+
+    jobs = [_parse_job(job) for job in jobs]
+    if not jobs:
+        return
+
+    scheduler = get_scheduler(n_cores=n_cores, tool_limits=tool_limits)
+    if n_parallel is None:
+        n_parallel = min(len(jobs), scheduler.n_cores)
+
+    runs = dict()
+    waiting = deque(range(len(jobs)))  # jobs that can start a session
+    running = dict()
+    with ThreadPoolExecutor(max_workers=max(n_parallel, 1),
+                            thread_name_prefix='bidsify-session') as drivers:
+        while waiting or running:
+            while waiting and len(running) < n_parallel:
+                i = waiting.popleft()
+                running[drivers.submit(_step, i, jobs[i], runs)] = i
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                result = future.result()
+                if result['session'] is not None:
+                    waiting.append(i)  # back of the line
+
+                yield result
+
+
+def _parse_job(job):
+    """ Converts a job (dict or tuple) to a dict with all keys. """
+    if not isinstance(job, dict):
+        job = dict(zip(JOB_KEYS, job))
+
+    missing = [key for key in JOB_KEYS[:3] if key not in job]
+    if missing:
+        raise ValueError("Job %r is missing %s!" % (job, missing))
+
+    job = dict(job)
+    job.setdefault('validate', False)
+    job.setdefault('scratch_dir', None)
+    return job
+
+
+def _step(i, job, runs):
+    """ Processes the next session of a job (setting up the run first,
+    and finishing it after the last session). """
+
+    t_start = time.time()
+    try:
+        if i not in runs:
+            run = _BidsifyRun(job['cfg_path'], job['directory'], job['out_dir'],
+                              job['validate'], scratch_dir=job['scratch_dir'],
+                              configure=False)
+            runs[i] = (run, run.sessions())
+
+        run, sessions = runs[i]
+        try:
+            result = next(sessions)
+        except StopIteration:
+            index = run.finish()
+            del runs[i]
+            result = dict(session=None, status='done', outputs=[],
+                          index=index)
+    except Exception:
+        runs.pop(i, None)
+        result = dict(session=None, status='failed', outputs=[],
+                      error=traceback.format_exc())
+
+    result.setdefault('error', None)
+    if result.get('wall_time') is None:
+        result['wall_time'] = time.time() - t_start
+
+    result['job'] = i
+    return result
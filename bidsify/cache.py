@@ -0,0 +1,195 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import Counter
+from glob import glob
+from .manifest import HashingWriter, record_digest
+from .utils import _make_dir
+
+CHUNK_SIZE = 2 ** 20
+
+
+class ConversionCache(object):
+    """ Content-addressed cache of processed (converted, reoriented,
+    defaced, and compressed) images and their raw sidecars, so that
+    re-running bidsify after a change of the config (e.g. a mapping or
+    metadata field) only needs to rename files and add metadata.
+
+    Entries are keyed by the fingerprint of the raw file(s) plus the
+    options that affect the processed images; the files themselves are
+    stored once per content (``objects/<sha256>``), so the same image in
+    multiple entries takes up space only once. When the cache grows beyond
+    max_size, the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache
+    max_size : float
+        Maximum size of the cache (in GB)
+    """
+
+    def __init__(self, cache_dir, max_size=20):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024 ** 3)
+        _make_dir(op.join(cache_dir, 'objects'))
+        _make_dir(op.join(cache_dir, 'entries'))
+        self._lock = threading.Lock()
+        # Objects that are being restored (and must not be evicted)
+        self._pinned = Counter()
+
+    def key(self, files, options, fingerprint=None):
+        """ Computes the key of raw file(s) and conversion options.
+
+        Parameters
+        ----------
+        files : list
+            Raw files (e.g., a PAR and its REC file)
+        options : dict
+            Options that affect the processed images
+        fingerprint : tuple or None
+            Fingerprint of the raw file(s) (see `dedup.fingerprint_scan`);
+            if given, it is used instead of reading the raw data again
+
+        Returns
+        -------
+        key : str
+        """
+        h = hashlib.blake2b()
+        h.update(json.dumps(options, sort_keys=True).encode())
+        for f in sorted(files, key=op.basename):
+            h.update(op.basename(f).encode())
+            if fingerprint is not None:
+                continue
+
+            with open(f, 'rb') as f_in:
+                for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                    h.update(chunk)
+
+        if fingerprint is not None:
+            h.update(json.dumps(list(fingerprint)).encode())
+
+        return h.hexdigest()
+
+    def get(self, key, dst_dir):
+        """ Restores the files of an entry to dst_dir.
+
+        Returns
+        -------
+        outputs : list or None
+            Paths to the restored files (None if the key is not in the
+            cache)
+        info : dict or None
+            Info stored with the entry
+        """
+        entry_file = self._entry_path(key)
+        with self._lock:
+            if not op.isfile(entry_file):
+                return None, None
+
+            with open(entry_file) as f_in:
+                entry = json.load(f_in)
+
+            files = sorted(entry['files'].items())
+            if not all(op.isfile(self._object_path(d)) for _, d in files):
+                os.remove(entry_file)
+                return None, None
+
+            # Most recently used
+            os.utime(entry_file, None)
+            self._pinned.update(d for _, d in files)
+
+        # The copies can be large, so they are made without holding the lock
+        # (the pinned objects are not evicted in the meantime)
+        try:
+            outputs = []
+            for name, digest in files:
+                dst = op.join(dst_dir, name)
+                shutil.copyfile(self._object_path(digest), dst)
+                record_digest(dst, digest)
+                outputs.append(dst)
+        finally:
+            with self._lock:
+                self._pinned.subtract(d for _, d in files)
+                self._pinned += Counter()  # drop zero counts
+
+        return outputs, entry['info']
+
+    def put(self, key, files, info=None):
+        """ Adds an entry to the cache and evicts the least recently used
+        entries if the cache is too large.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry (see `key`)
+        files : dict
+            Mapping from (restored) names to paths of the processed files
+            (or their contents, as bytes)
+        info : dict or None
+            Additional (json serializable) info about the entry
+        """
+        with self._lock:
+            digests = dict((name, self._add_object(path))
+                           for name, path in files.items())
+            entry = dict(files=digests, info=info or dict())
+            entry_file = self._entry_path(key)
+            with open(entry_file + '.tmp', 'w') as f_out:
+                json.dump(entry, f_out)
+            os.replace(entry_file + '.tmp', entry_file)
+            self._evict()
+
+    def _add_object(self, path):
+        # Copy and hash in a single pass
+        tmp = tempfile.NamedTemporaryFile(dir=op.join(self.cache_dir, 'objects'),
+                                          prefix='.', delete=False)
+        with tmp:
+            writer = HashingWriter(tmp)
+            if isinstance(path, bytes):
+                writer.write(path)
+            else:
+                with open(path, 'rb') as f_in:
+                    for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                        writer.write(chunk)
+
+        digest = writer.hexdigest()
+        obj = self._object_path(digest)
+        if op.isfile(obj):
+            os.remove(tmp.name)
+        else:
+            os.replace(tmp.name, obj)
+
+        return digest
+
+    def _evict(self):
+        """ Removes the least recently used entries (and the objects that are
+        not used anymore or being restored) until the cache is smaller than
+        max_size. """
+        entries = []
+        for f in glob(op.join(self.cache_dir, 'entries', '*.json')):
+            with open(f) as f_in:
+                digests = set(json.load(f_in)['files'].values())
+            entries.append((os.stat(f).st_mtime, f, digests))
+
+        entries.sort()
+        sizes = dict((op.basename(obj), op.getsize(obj))
+                     for obj in glob(op.join(self.cache_dir, 'objects', '*')))
+        used = set().union(*[e[2] for e in entries])
+        while entries and sum(sizes.get(d, 0) for d in used) > self.max_size:
+            _, f, _ = entries.pop(0)
+            os.remove(f)
+            used = set().union(*[e[2] for e in entries])
+
+        for digest in set(sizes) - used - set(self._pinned):
+            os.remove(self._object_path(digest))
+
+    def _entry_path(self, key):
+        return op.join(self.cache_dir, 'entries', key + '.json')
+
+    def _object_path(self, digest):
+        return op.join(self.cache_dir, 'objects', digest)
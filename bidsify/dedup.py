@@ -0,0 +1,194 @@
+from __future__ import print_function, division
+import os.path as op
+import hashlib
+import threading
+import pandas as pd
+from glob import glob
+
+CHUNK_SIZE = 2 ** 20
+
+
+class ScanRegistry(object):
+    """ Keeps track of fingerprints of raw MRI files to detect duplicate
+    scans (e.g., re-sent PAR/REC files or repeated exports).
+
+    A fingerprint consists of the size of the image data, a hash of the
+    normalised header, and a hash of the image data. The fingerprint is
+    computed when a file is registered (outside the lock, so sessions can
+    hash their files concurrently), as raw files may be temporary copies
+    (e.g. prefetched or extracted from an archive) that are removed after
+    their session; the paths are only kept for reporting.
+    """
+
+    def __init__(self):
+        self._entries = dict()  # fingerprint -> entry of first file
+        self.records = []
+        self._lock = threading.Lock()
+
+    def check(self, f, session, mri_ext, fingerprint=None):
+        """ Checks whether a raw file is a duplicate of a file seen before.
+
+        Parameters
+        ----------
+        f : str
+            Path to raw file (PAR, dcm, or DICOM file)
+        session : str
+            Name of the session (e.g. sub-01/ses-1) the file belongs to
+        mri_ext : str
+            Type of MRI file (PAR, dcm, DICOM)
+        fingerprint : tuple or None
+            Fingerprint of the file, if already computed (see
+            `fingerprint_scan`)
+
+        Returns
+        -------
+        original : dict or None
+            Entry of the file it duplicates (None if it is not a duplicate)
+        """
+        if fingerprint is None:
+            fingerprint = fingerprint_scan(f, mri_ext)
+        if fingerprint is None:
+            return None
+
+        entry = dict(file=f, session=session)
+        with self._lock:
+            original = self._entries.setdefault(fingerprint, entry)
+            if original is entry:
+                return None
+
+            self._record(entry, original)
+
+        return original
+
+    def _record(self, entry, original):
+        within = entry['session'] == original['session']
+        self.records.append(dict(
+            session=entry['session'],
+            file=op.basename(entry['file']),
+            duplicate_of=op.join(original['session'], op.basename(original['file'])),
+            kind='within-session' if within else 'across-sessions',
+            action='skipped' if within else 'converted'
+        ))
+
+    def write_report(self, path):
+        """ Writes the deduplication report to a tsv file. """
+        if not self.records:
+            return None
+
+        df = pd.DataFrame(self.records, columns=['session', 'file', 'duplicate_of',
+                                                 'kind', 'action'])
+        df.to_csv(path, sep='\t', index=False)
+        print("Found %i duplicate scan(s); see %s." % (len(df), path))
+        return path
+
+
+def find_duplicate_scans(files, cfg, session, registry=None, fingerprints=None):
+    """ Finds (near-)exact duplicate raw MRI files of a single session.
+
+    Parameters
+    ----------
+    files : list
+        Raw files of the session
+    cfg : dict
+        Config dictionary
+    session : str
+        Name of the session (e.g. sub-01/ses-1)
+    registry : ScanRegistry or None
+        Registry to check against; also records duplicates across sessions
+        (which are still converted, but reported)
+    fingerprints : dict or None
+        If given, it is updated with the fingerprint of each checked file
+        (by basename), so the raw data does not need to be read again (e.g.
+        for the key of the conversion cache)
+
+    Returns
+    -------
+    to_skip : list
+        Files that duplicate another file of the same session and thus
+        do not need to be converted (including the REC files of PARs)
+    """
+
+    mri_ext = cfg['options']['mri_ext']
+    if registry is None:
+        registry = ScanRegistry()
+
+    if mri_ext == 'PAR':
+        candidates = [f for f in files if f.endswith('.PAR')]
+    elif mri_ext == 'dcm':
+        candidates = [f for f in files if f.endswith('.dcm')]
+    elif mri_ext == 'DICOM':
+        candidates = [f for f in files if op.basename(f) != 'DICOMDIR']
+    else:
+        return []
+
+    to_skip = []
+    for f in sorted(candidates):
+        fingerprint = fingerprint_scan(f, mri_ext)
+        if fingerprints is not None and fingerprint is not None:
+            fingerprints[op.basename(f)] = fingerprint
+
+        original = registry.check(f, session, mri_ext, fingerprint=fingerprint)
+        if original is None or original['session'] != session:
+            continue
+
+        to_skip.append(f)
+        if mri_ext == 'PAR':
+            to_skip.append(_get_data_file(f))
+
+    return to_skip
+
+
+def fingerprint_scan(f, mri_ext):
+    """ Computes the fingerprint of a raw MRI file: the size of the image
+    data, a hash of the normalised header (for PAR files), and a hash of
+    the image data.
+
+    Parameters
+    ----------
+    f : str
+        Path to raw file (PAR, dcm, or DICOM file)
+    mri_ext : str
+        Type of MRI file (PAR, dcm, DICOM)
+
+    Returns
+    -------
+    fingerprint : tuple or None
+        None if the image data is missing (a PAR file without REC file)
+    """
+    data_file = _get_data_file(f) if mri_ext == 'PAR' else f
+    if data_file is None:
+        return None
+
+    return (op.getsize(data_file), _hash_header(f) if mri_ext == 'PAR' else '',
+            _hash_data(data_file))
+
+
+def _get_data_file(par):
+    """ Finds the REC file belonging to a PAR file. """
+    recs = glob(op.splitext(par)[0] + '.[Rr][Ee][Cc]')
+    return recs[0] if recs else None
+
+
+def _hash_header(par):
+    """ Hashes a PAR header, ignoring comments (which contain e.g. the
+    name and path of the export). """
+
+    h = hashlib.blake2b()
+    with open(par, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith(b'#'):
+                h.update(line)
+
+    return h.hexdigest()
+
+
+def _hash_data(data_file):
+    """ Hashes the image data of a raw file. """
+
+    h = hashlib.blake2b()
+    with open(data_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
@@ -0,0 +1,162 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import warnings
+import numpy as np
+import nibabel as nib
+from glob import glob
+from .manifest import forget_digest
+from .utils import _run_cmd
+
+# Order in which anatomical scans are preferred as the session's
+# reference image for the (expensive) registration to the template
+REF_PRIORITY = ['_T1w.', '_T2w.', '_FLAIR.']
+
+
+def register_template(ref, tmp_dir, cost='mutualinfo'):
+    """ Registers the pydeface template to the session reference; this is
+    the single full registration of the session.
+
+    Parameters
+    ----------
+    ref : str
+        Path to reference image (see `select_reference`)
+    tmp_dir : str
+        Directory to store the transform in
+    cost : str
+        Cost function used for the FSL flirt registration
+
+    Returns
+    -------
+    tmpl2ref : str or None
+        Path to template-to-reference transform (None if it failed, in
+        which case `deface_file` falls back to pydeface)
+    """
+
+    template, facemask = _find_pydeface_data()
+    if template is None:
+        msg = ("Could not locate the pydeface template/facemask; falling "
+               "back to running pydeface for each file separately.")
+        warnings.warn(msg)
+        return None
+
+    tmpl2ref = op.join(tmp_dir, 'template2ref.mat')
+    rs = _run_cmd(['flirt', '-in', template, '-ref', ref,
+                   '-omat', tmpl2ref, '-cost', cost])
+    if rs != 0 or not op.isfile(tmpl2ref):
+        warnings.warn("Could not register template to %s; falling back "
+                      "to pydeface for each file separately." % ref)
+        return None
+
+    return tmpl2ref
+
+
+def deface_file(f, ref, tmpl2ref, tmp_dir, idx, cost='mutualinfo'):
+    """ Warps the facemask to a single file and applies it. """
+
+    if tmpl2ref is None:
+        _pydeface_file(f)
+        return None
+
+    if f == ref:
+        tmpl2f = tmpl2ref
+    else:
+        # Cheap rigid alignment of the reference to this image; both are
+        # acquired in the same session, so the search range can be small
+        ref2f = op.join(tmp_dir, 'ref2img_%i.mat' % idx)
+        tmpl2f = op.join(tmp_dir, 'template2img_%i.mat' % idx)
+        rs = _run_cmd(['flirt', '-in', ref, '-ref', f, '-omat', ref2f,
+                       '-dof', '6', '-cost', cost,
+                       '-searchrx', '-10', '10', '-searchry', '-10', '10',
+                       '-searchrz', '-10', '10'])
+        if rs == 0:
+            rs = _run_cmd(['convert_xfm', '-omat', tmpl2f, '-concat',
+                           ref2f, tmpl2ref])
+
+        if rs != 0 or not op.isfile(tmpl2f):
+            warnings.warn("Could not align %s to session reference %s; "
+                          "running pydeface instead." % (f, ref))
+            _pydeface_file(f)
+            return None
+
+    _, facemask = _find_pydeface_data()
+    mask_base = op.join(tmp_dir, 'facemask_%i' % idx)
+    rs = _run_cmd(['flirt', '-in', facemask, '-ref', f, '-applyxfm',
+                   '-init', tmpl2f, '-interp', 'nearestneighbour',
+                   '-out', mask_base])
+    mask = glob(mask_base + '.nii*')
+    if rs != 0 or not mask:
+        # A (partial) mask of a failed run is not used
+        [os.remove(m) for m in mask]
+        warnings.warn("Could not warp facemask to %s; running pydeface "
+                      "instead." % f)
+        _pydeface_file(f)
+        return None
+
+    _apply_facemask(f, mask[0])
+
+
+def _apply_facemask(f, mask_file):
+    """ Multiplies image by (warped) facemask and overwrites it in a
+    single (compressed) write. """
+
+    img = nib.load(f)
+    mask = np.asanyarray(nib.load(mask_file).dataobj).squeeze() > 0
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > mask.ndim:
+        # e.g. 4D magnitude images
+        mask = mask.reshape(mask.shape + (1,) * (data.ndim - mask.ndim))
+
+    defaced = nib.Nifti1Image(data * mask, img.affine, img.header)
+    defaced.set_data_dtype(img.get_data_dtype())
+
+    # Write to a temporary file in the same dir, so the final rename
+    # is atomic and the file is compressed only once
+    tmp_out = op.join(op.dirname(f), '.defaced_' + op.basename(f))
+    nib.save(defaced, tmp_out)
+    os.rename(tmp_out, f)
+    forget_digest(f)
+
+
+def select_reference(files):
+    """ Selects the image to register the template to. """
+
+    for idf in REF_PRIORITY:
+        matches = sorted(f for f in files if idf in op.basename(f))
+        if matches:
+            return matches[0]
+
+    anat = sorted(f for f in files if 'magnitude' not in op.basename(f))
+    return anat[0] if anat else sorted(files)[0]
+
+
+def _find_pydeface_data():
+    """ Finds the template and facemask shipped with pydeface. """
+
+    try:
+        import pydeface
+    except ImportError:
+        return None, None
+
+    data_dir = op.join(op.dirname(pydeface.__file__), 'data')
+    template = op.join(data_dir, 'mean_reg2mean.nii.gz')
+    facemask = op.join(data_dir, 'facemask.nii.gz')
+    if not op.isfile(template) or not op.isfile(facemask):
+        return None, None
+
+    return template, facemask
+
+
+def _pydeface_file(f):
+    """ Deface anat data with a full pydeface run. """
+
+    out = op.join(op.dirname(f), '.defaced_' + op.basename(f))
+    rs = _run_cmd(['pydeface', f, '--outfile', out, '--force'])  # Run pydeface
+    if rs != 0 or not op.isfile(out):
+        # Never publish an image that was not defaced
+        if op.isfile(out):
+            os.remove(out)
+        raise ValueError("pydeface could not deface %s (return code %i)!"
+                         % (f, rs))
+    os.rename(out, f)  # Revert to old name
+    forget_digest(f)
@@ -0,0 +1,407 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import json
+import sqlite3
+import warnings
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+INDEX_FILE = '.bidsify_index.sqlite'
+
+ENTITIES = ['sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo',
+            'recording']
+
+COLUMNS = ['path', 'datatype'] + ENTITIES + ['suffix', 'extension', 'metadata']
+
+# Sidecar fields that are stored in the index
+INDEX_METADATA = ['TaskName', 'RepetitionTime', 'EchoTime', 'AcquisitionTime',
+                  'PhaseEncodingDirection', 'SliceEncodingDirection',
+                  'IntendedFor']
+
+
+def parse_bids_name(fname):
+    """ Splits a BIDS filename into its entities, suffix, and extension.
+
+    Parameters
+    ----------
+    fname : str
+        (Base)name of file, e.g. sub-01_task-rest_bold.nii.gz
+
+    Returns
+    -------
+    info : dict
+        Dictionary with entities (e.g. sub, task), suffix, and extension
+    """
+    fname = op.basename(fname)
+    stem, _, ext = fname.partition('.')
+    parts = stem.split('_')
+    info = dict(suffix=parts[-1], extension='.' + ext if ext else '')
+    for part in parts[:-1]:
+        if len(part.split('-')) == 2:
+            key, value = part.split('-')
+            info[key] = value
+
+    return info
+
+
+def _stem(path):
+    """ Path without extension(s). """
+    head, _, tail = path.rpartition('/')
+    stem = tail.partition('.')[0]
+    return head + '/' + stem if head else stem
+
+
+class BIDSIndex(object):
+    """ In-memory index of the files in a BIDS dataset, built while
+    bidsify renames and writes files, and persisted as SQLite database
+    (``.bidsify_index.sqlite``) in the root of the dataset.
+
+    Parameters
+    ----------
+    root : str
+        Root of the BIDS dataset
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._rows = OrderedDict()
+        self._stems = dict()  # stem -> set of paths (json + data files)
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, root):
+        """ Loads a persisted index (if any) from the dataset root. """
+        index = cls(root)
+        db = op.join(root, INDEX_FILE)
+        if not op.isfile(db):
+            return index
+
+        with sqlite3.connect(db) as con:
+            cursor = con.execute('SELECT %s FROM files' % ', '.join(COLUMNS))
+            for values in cursor:
+                row = dict(zip(COLUMNS, values))
+                row['metadata'] = json.loads(row['metadata'] or '{}')
+                index._rows[row['path']] = row
+                index._stems.setdefault(_stem(row['path']), set()).add(row['path'])
+
+        return index
+
+    def add_file(self, path):
+        """ Adds a file (path inside the root) to the index. """
+        rel = self._relpath(path)
+        info = parse_bids_name(rel)
+        parts = rel.split('/')
+        row = dict((col, None) for col in COLUMNS)
+        row.update(path=rel, metadata=dict(),
+                   datatype=parts[-2] if len(parts) > 1 else None)
+        row.update((k, v) for k, v in info.items() if k in COLUMNS)
+        with self._lock:
+            self._rows[rel] = row
+            self._stems.setdefault(_stem(rel), set()).add(rel)
+            self._dirty.add(rel)
+
+    def update_metadata(self, path, metadata):
+        """ Stores (key) sidecar fields for all files that share the stem of
+        the given sidecar (i.e., the json and its data file). """
+        rel = self._relpath(path)
+        fields = dict((k, v) for k, v in metadata.items() if k in INDEX_METADATA)
+        with self._lock:
+            for key in self._stems.get(_stem(rel), []):
+                self._rows[key]['metadata'].update(fields)
+                self._dirty.add(key)
+
+    def remove_file(self, path):
+        """ Removes a file from the index. """
+        rel = self._relpath(path)
+        with self._lock:
+            self._rows.pop(rel, None)
+            self._stems.get(_stem(rel), set()).discard(rel)
+            self._dirty.add(rel)
+
+    def update(self, other):
+        """ Adds all rows of another index (e.g., of a single session) that
+        uses the same relative paths. """
+        with other._lock:
+            rows = [dict(row, metadata=dict(row['metadata']))
+                    for row in other._rows.values()]
+
+        with self._lock:
+            for row in rows:
+                self._rows[row['path']] = row
+                self._stems.setdefault(_stem(row['path']), set()).add(row['path'])
+                self._dirty.add(row['path'])
+
+    def get(self, return_type='filename', **filters):
+        """ Queries the index.
+
+        Parameters
+        ----------
+        return_type : str
+            Either 'filename' (absolute paths) or 'dict' (index rows)
+        filters : dict
+            Entities (e.g. sub='01'), datatype, suffix, extension, or
+            metadata fields to filter on; values may be lists
+
+        Returns
+        -------
+        results : list
+        """
+        results = []
+        with self._lock:
+            rows = list(self._rows.values())
+
+        for row in rows:
+            for key, value in filters.items():
+                this = row[key] if key in COLUMNS else row['metadata'].get(key)
+                values = value if isinstance(value, (list, tuple)) else [value]
+                if this not in values:
+                    break
+            else:
+                results.append(row)
+
+        if return_type == 'filename':
+            return [op.join(self.root, row['path']) for row in results]
+
+        return results
+
+    def to_df(self):
+        """ Returns the index as a pandas DataFrame. """
+        with self._lock:
+            rows = list(self._rows.values())
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def save(self):
+        """ Writes the rows that changed since the last save to disk. """
+        db = op.join(self.root, INDEX_FILE)
+        with self._lock:
+            dirty, self._dirty = list(self._dirty), set()
+            rows = [self._rows.get(path) for path in dirty]
+            removed = [path for path, row in zip(dirty, rows) if row is None]
+            rows = [row for row in rows if row is not None]
+
+        with sqlite3.connect(db) as con:
+            con.execute('CREATE TABLE IF NOT EXISTS files (%s)' %
+                        ', '.join(['path TEXT PRIMARY KEY'] + ['%s TEXT' % c for c in COLUMNS[1:]]))
+            con.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in removed])
+            con.executemany(
+                'INSERT OR REPLACE INTO files VALUES (%s)' % ', '.join('?' * len(COLUMNS)),
+                [[json.dumps(row[c]) if c == 'metadata' else row[c] for c in COLUMNS]
+                 for row in rows]
+            )
+
+        return db
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return 'BIDSIndex(root=%r, n_files=%i)' % (self.root, len(self))
+
+    def _relpath(self, path):
+        path = op.relpath(op.abspath(path), op.abspath(self.root))
+        return path.replace(os.sep, '/')
+
+
+class FieldmapTargets(object):
+    """ Table of the functional and diffusion images of a session (from the
+    rows of its index), to resolve the IntendedFor field of its fieldmaps
+    with dictionary lookups instead of searching the filesystem.
+
+    Matching rules:
+
+    - phasediff: all bold images of the session
+    - epi with 'Dirs' in its acq: the dwi images with the same acq (and run,
+      if the epi has one and there is a dwi image with that run)
+    - other epi: the bold images whose task is the dir of the epi, with the
+      same acq (and run, if the epi has one)
+
+    If an epi matches multiple images, the first one is used, or (if nearest
+    is True) the one that was acquired closest in time to the epi.
+
+    Parameters
+    ----------
+    rows : list
+        Index rows (see BIDSIndex.get) of the session's files
+    nearest : bool
+        Whether to pick the image closest in time for epi fieldmaps
+    """
+
+    def __init__(self, rows, nearest=False):
+        self.nearest = nearest
+        self._table = dict()
+        for row in sorted(rows, key=lambda r: r['path']):
+            if row['suffix'] not in ['bold', 'dwi'] or row['extension'] not in ['.nii', '.nii.gz']:
+                continue
+
+            task = row['task'] if row['suffix'] == 'bold' else None
+            for run in [row['run'], '*']:
+                self._table.setdefault((row['suffix'], task, row['acq'], run), []).append(row)
+            self._table.setdefault((row['suffix'], '*', '*', '*'), []).append(row)
+
+    def match(self, fname, acq_time=None):
+        """ Returns the images a fieldmap is intended for.
+
+        Parameters
+        ----------
+        fname : str
+            (Base)name of the fieldmap (json or nifti)
+        acq_time : str or None
+            AcquisitionTime of the fieldmap (only used if nearest is True)
+
+        Returns
+        -------
+        intended_for : list
+            Paths (relative to the subject dir) of the matching images
+        """
+        info = parse_bids_name(fname)
+        acq, run = info.get('acq'), info.get('run', '*')
+        if info['suffix'] == 'phasediff':
+            rows = self._table.get(('bold', '*', '*', '*'), [])
+        elif info['suffix'] == 'epi' and acq is not None and 'Dirs' in acq:
+            # Any run of the dwi if there is none with the run of the epi
+            rows = (self._table.get(('dwi', None, acq, run)) or
+                    self._table.get(('dwi', None, acq, '*'), []))
+        elif info['suffix'] == 'epi':
+            rows = self._table.get(('bold', info.get('dir'), acq, run), [])
+        else:
+            return []
+
+        if info['suffix'] == 'epi' and len(rows) > 1:
+            if self.nearest and _seconds(acq_time) is not None:
+                t_fmap = _seconds(acq_time)
+                timed = [r for r in rows
+                         if _seconds(r['metadata'].get('AcquisitionTime')) is not None]
+                rows = sorted(timed, key=lambda r: abs(
+                    _seconds(r['metadata']['AcquisitionTime']) - t_fmap))[:1] or rows[:1]
+            else:
+                warnings.warn("Found multiple images (%s) corresponding to topup (%s)!" %
+                              ([r['path'] for r in rows], fname))
+                rows = rows[:1]
+
+        # Relative to the subject dir, e.g. ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz
+        return [row['path'].split('/', 1)[1] for row in rows]
+
+
+def _seconds(acq_time):
+    """ Converts an AcquisitionTime (HH:MM:SS.ffffff, possibly preceded by
+    a date and 'T') to seconds; returns None if it is missing. """
+    if not acq_time:
+        return None
+
+    try:
+        h, m, s = acq_time.split('T')[-1].split(':')
+        return int(h) * 3600 + int(m) * 60 + float(s)
+    except ValueError:
+        return None
+
+
+class InheritedMetadata(object):
+    """ Metadata that files share through dataset-level sidecars (the BIDS
+    inheritance principle), e.g. ``task-rest_acq-mb_bold.json``.
+
+    Sidecars are named by all entities of the files (except sub, ses, and
+    run) and their fields are fixed by the first file that creates them, so
+    files that were written before never get different values. A file only
+    leaves out the fields that have the same value in the (single) sidecar
+    that applies to it. No sidecar is created that would apply to the files
+    of another sidecar, or to files (of this or earlier runs) with more
+    entities, so that at most one sidecar applies to each file.
+
+    Parameters
+    ----------
+    root : str or None
+        Root of the dataset, to load the sidecars of earlier runs
+    index : BIDSIndex or None
+        Index of the dataset, with the files of earlier runs
+    """
+
+    def __init__(self, root=None, index=None):
+        self._sidecars = OrderedDict()  # name -> (suffix, entities, fields)
+        self._seen = dict()  # suffix -> entity sets of the files
+        self._lock = threading.Lock()
+
+        if index is not None:
+            for row in index.get(return_type='dict', extension='.json'):
+                suffix, ents = _get_entity_set(row['path'])
+                self._seen.setdefault(suffix, set()).add(ents)
+
+        if root is not None and op.isdir(root):
+            for fname in sorted(os.listdir(root)):
+                if (not fname.endswith('.json') or fname.startswith('.')
+                        or fname == 'dataset_description.json'):
+                    continue
+                with open(op.join(root, fname)) as f_in:
+                    fields = json.load(f_in)
+                if not isinstance(fields, dict):
+                    continue
+                suffix, ents = _get_entity_set(fname)
+                self._sidecars[fname] = (suffix, ents, fields)
+
+    def share(self, fname, shared, own=None):
+        """ Registers a file and returns the fields it inherits.
+
+        Parameters
+        ----------
+        fname : str
+            (Base)name of the file's sidecar
+        shared : dict
+            Fields that the file could inherit
+        own : dict or None
+            Fields in the file's own sidecar (which override inherited ones)
+
+        Returns
+        -------
+        inherits : dict
+            Fields (from shared) that the file does not need in its sidecar
+        """
+        own = own or dict()
+        suffix, ents = _get_entity_set(fname)
+        with self._lock:
+            seen = self._seen.setdefault(suffix, set())
+            applicable = [name for name, (s, e, _) in self._sidecars.items()
+                          if s == suffix and e <= ents]
+            if not applicable:
+                # A new sidecar would also apply to files with more entities
+                overlaps = any(ents <= e for e in seen) or any(
+                    s == suffix and ents < e for s, e, _ in self._sidecars.values())
+                seen.add(ents)
+                if overlaps:
+                    return dict()
+
+                self._sidecars[_get_inherited_name(suffix, ents)] = (suffix, ents, dict(shared))
+                return dict(shared)
+
+            seen.add(ents)
+            fields = self._sidecars[applicable[0]][2]
+
+        missing = [key for key in fields if key not in shared and key not in own]
+        if missing:
+            warnings.warn("%s inherits %s from %s, which does not apply to it!" %
+                          (fname, missing, applicable[0]))
+
+        return dict((key, value) for key, value in shared.items()
+                    if key in fields and fields[key] == value)
+
+    def items(self):
+        """ Returns the sidecars (name, fields), sorted by name. """
+        with self._lock:
+            return sorted((name, dict(fields))
+                          for name, (_, _, fields) in self._sidecars.items())
+
+
+def _get_entity_set(fname):
+    """ Suffix and entities (except sub, ses, and run) of a file. """
+    info = parse_bids_name(fname)
+    ents = frozenset((key, info[key]) for key in ENTITIES
+                     if key in info and key not in ['sub', 'ses', 'run'])
+    return info['suffix'], ents
+
+
+def _get_inherited_name(suffix, ents):
+    """ Name of a dataset-level sidecar, e.g. task-rest_acq-mb_bold.json. """
+    ents = dict(ents)
+    parts = ['%s-%s' % (key, ents[key]) for key in ENTITIES if key in ents]
+    return '_'.join(parts + [suffix]) + '.json'
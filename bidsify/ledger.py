@@ -0,0 +1,94 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import json
+import time
+import threading
+import traceback
+from .version import __version__
+
+FAILURES_FILE = '.bidsify_failures.json'
+QUARANTINE_DIR = '.bidsify_quarantine'
+
+
+class FailureLedger(object):
+    """ Machine-readable record (``.bidsify_failures.json`` in the dataset
+    root) of the sessions that failed to convert, so that they can be
+    inspected and re-run later. Each entry has the session, the raw source,
+    the error (type, message, and traceback), the pipeline task that
+    failed (if any), where the partial output was quarantined, and when
+    it failed. Entries are removed once the session converts.
+
+    Parameters
+    ----------
+    out_dir : str
+        Root of the BIDS dataset
+    """
+
+    def __init__(self, out_dir):
+        self.path = op.join(out_dir, FAILURES_FILE)
+        self._entries = dict()  # session -> entry
+        self._lock = threading.Lock()
+        if op.isfile(self.path):
+            with open(self.path) as f_in:
+                for entry in json.load(f_in):
+                    self._entries[entry['session']] = entry
+
+    def record(self, session, source, exc, quarantine=None):
+        """ Adds (or replaces) the entry of a failed session; should be
+        called while handling the exception.
+
+        Parameters
+        ----------
+        session : str
+            Session (e.g. sub-01/ses-1)
+        source : str
+            Path to the raw session (directory or archive)
+        exc : Exception
+            The error
+        quarantine : str or None
+            Directory the partial output was moved to
+        """
+        entry = dict(
+            session=session,
+            source=source,
+            error=type(exc).__name__,
+            message=str(exc),
+            task=getattr(exc, 'bidsify_task', None),
+            traceback=traceback.format_exc(),
+            quarantine=quarantine,
+            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            version=__version__
+        )
+        with self._lock:
+            self._entries[session] = entry
+            self._save()
+
+    def resolve(self, session):
+        """ Removes the entry of a session (if any). """
+        with self._lock:
+            if self._entries.pop(session, None) is not None:
+                self._save()
+
+    def sessions(self):
+        """ Returns the failed sessions. """
+        with self._lock:
+            return sorted(self._entries)
+
+    def entries(self):
+        """ Returns the entries, sorted by session. """
+        with self._lock:
+            return [dict(self._entries[s]) for s in sorted(self._entries)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _save(self):
+        if not self._entries:
+            if op.isfile(self.path):
+                os.remove(self.path)
+            return
+
+        entries = [self._entries[s] for s in sorted(self._entries)]
+        with open(self.path, 'w') as f_out:
+            json.dump(entries, f_out, indent=4)
@@ -0,0 +1,145 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import warnings
+import numpy as np
+import pandas as pd
+from .manifest import write_text
+
+# Presentation logs store times in units of 0.1 ms
+PRESENTATION_TIME_UNIT = 1e-4
+
+# Extensions of stimulus logs that can be converted
+LOG_EXTS = ['.log', '.csv', '.txt', '.tsv']
+
+DEFAULT_EVENTS_OPTIONS = dict(onset='onset', duration='duration',
+                              trial_type='trial_type', trigger_column=None,
+                              trigger_code=None)
+
+# Columns of the event-table of Presentation logfiles that are needed
+PRESENTATION_COLUMNS = ['Event Type', 'Code', 'Time']
+
+
+def convert_log(f, options=None):
+    """ Converts a stimulus log (Presentation logfile or a table, such as a
+    PsychoPy csv-file) to a BIDS events-file.
+
+    Onsets are aligned to the (first) scanner trigger: the first "Pulse"
+    event (with trigger_code, if given) in Presentation logs or, for tables,
+    the first value of the trigger_column (if given).
+
+    Parameters
+    ----------
+    f : str
+        Path to (renamed) log, e.g. sub-01_task-wm_events.log
+    options : dict or None
+        Names of the onset, duration, trial_type, and trigger columns (for
+        tables) and the trigger code (for Presentation logs; None means any
+        pulse); see DEFAULT_EVENTS_OPTIONS
+
+    Returns
+    -------
+    f_out : str or None
+        Path to the events-file (None if the log could not be converted)
+    """
+
+    opts = dict(DEFAULT_EVENTS_OPTIONS)
+    opts.update(options or dict())
+
+    stem = op.basename(f).split('.')[0]
+    f_out = op.join(op.dirname(f), stem + '.tsv')
+
+    try:
+        if _is_presentation_log(f):
+            events = _parse_presentation_log(f, trigger=opts['trigger_code'])
+        else:
+            events = _parse_table(f, opts)
+    except ValueError as e:
+        warnings.warn("Could not convert log %s to events: %s" % (f, e))
+        return None
+
+    write_text(f_out, events.to_csv(sep='\t', index=False, na_rep='n/a',
+                                    float_format='%.4f'))
+    if f != f_out:
+        os.remove(f)
+
+    return f_out
+
+
+def _is_presentation_log(f):
+    with open(f, errors='replace') as f_in:
+        return f_in.readline().startswith('Scenario -')
+
+
+def _parse_presentation_log(f, trigger=None):
+    """ Parses the event-table of a Presentation logfile. """
+
+    with open(f, errors='replace') as f_in:
+        lines = f_in.read().splitlines()
+
+    start = [i for i, line in enumerate(lines)
+             if line.startswith('Subject\tTrial')]
+    if not start:
+        raise ValueError("no event table found")
+
+    start = start[0]
+    n_rows = lines[start + 1:].index('') if '' in lines[start + 1:] else None
+    df = pd.read_csv(f, sep='\t', skiprows=start, nrows=n_rows,
+                     skip_blank_lines=False, dtype={'Code': str})
+    missing = [col for col in PRESENTATION_COLUMNS if col not in df.columns]
+    if missing:
+        raise ValueError("no column(s) %s in the event table" % missing)
+
+    times = pd.to_numeric(df['Time'], errors='coerce') * PRESENTATION_TIME_UNIT
+    is_pulse = (df['Event Type'] == 'Pulse').to_numpy()
+    if trigger is not None:
+        is_pulse &= (df['Code'] == str(trigger)).to_numpy()
+
+    if is_pulse.any():
+        t0 = times[is_pulse].iloc[0]
+    else:
+        warnings.warn("No scanner pulse found in %s; onsets are relative to "
+                      "the start of the log" % f)
+        t0 = 0
+
+    keep = ~(df['Event Type'] == 'Pulse').to_numpy()
+    duration = np.nan
+    if 'Duration' in df.columns:
+        duration = pd.to_numeric(df['Duration'], errors='coerce') * PRESENTATION_TIME_UNIT
+
+    events = pd.DataFrame(dict(onset=times - t0, duration=duration,
+                               trial_type=df['Code'],
+                               event_type=df['Event Type']))
+    return events[keep].reset_index(drop=True)
+
+
+def _parse_table(f, opts):
+    """ Parses a table-like log (e.g., PsychoPy csv-files). """
+
+    sep = ',' if f.endswith('.csv') else '\t'
+    df = pd.read_csv(f, sep=sep)
+    if opts['onset'] not in df.columns:
+        raise ValueError("no onset column '%s'" % opts['onset'])
+
+    onset = pd.to_numeric(df[opts['onset']], errors='coerce')
+    if opts['trigger_column'] is not None:
+        if opts['trigger_column'] not in df.columns:
+            raise ValueError("no trigger column '%s'" % opts['trigger_column'])
+        triggers = pd.to_numeric(df[opts['trigger_column']], errors='coerce').dropna()
+        if len(triggers):
+            onset = onset - triggers.iloc[0]
+
+    events = pd.DataFrame(dict(onset=onset))
+    events['duration'] = (pd.to_numeric(df[opts['duration']], errors='coerce')
+                          if opts['duration'] in df.columns else np.nan)
+
+    # Keep all other columns (except the trigger), e.g. responses
+    other = [col for col in df.columns
+             if col not in [opts['onset'], opts['duration'], opts['trigger_column']]]
+    events = pd.concat([events, df[other]], axis=1)
+    if opts['trial_type'] in other:
+        events = events.rename(columns={opts['trial_type']: 'trial_type'})
+
+    # Rows without onset (e.g. PsychoPy's loop-summary rows) are no events
+    events = events[events['onset'].notna()]
+    return events.sort_values('onset', kind='stable').reset_index(drop=True)
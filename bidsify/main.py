@@ -7,17 +7,40 @@ import fnmatch
 import warnings
 import yaml
 import json
+import time
+import tempfile
+import threading
+import traceback
+import contextlib
 import pandas as pd
 import nibabel as nib
 import numpy as np
 from copy import copy, deepcopy
 from glob import glob
-from joblib import Parallel, delayed
-from .mri2nifti import convert_mri
+from .mri2nifti import (find_mri_files, convert_mri_file, _get_fmap_idfs,
+                        _rename_phasediff_files, _dcm2niix_version, PIGZ)
 from .phys2tsv import convert_phy
+from .log2tsv import convert_log, LOG_EXTS
+from .deface import select_reference, register_template, deface_file
+from .dedup import ScanRegistry, find_duplicate_scans, fingerprint_scan
+from .archive import BIDSArchive
+from .cache import ConversionCache
+from .ledger import FailureLedger, QUARANTINE_DIR
+from .prefetch import Prefetcher
+from .admission import estimate_session
+from .layout import BIDSIndex, FieldmapTargets, InheritedMetadata, parse_bids_name
+from .manifest import (write_session_manifest, update_session_manifest,
+                       write_dataset_manifest, write_text, copy_hashed,
+                       get_digests, move_digest, forget_digest,
+                       forget_digests)
+from .sources import (find_session_sources, select_files, is_archive,
+                      archive_stem, drop_duplicate_sources, DirSource)
 from .docker import run_from_docker
+from .pipeline import TaskGraph
+from .scheduler import get_scheduler, usage_tags
 from .utils import (check_executable, _make_dir, _append_to_json,
-                    _run_cmd)
+                    _compress, _decompress, _run_cmd, _publish_dir)
+from .dedup import _get_data_file
 from .version import __version__
 
 
@@ -58,6 +81,9 @@ ALLOWED_EXTS = [
 ]
 ALLOWED_EXTS.extend([s.upper() for s in ALLOWED_EXTS])
 
+# Metadata that is specific to a file (and thus never inherited)
+FILE_SPECIFIC_METADATA = ['IntendedFor', 'SliceTiming']
+
 
 def run_cmd():
     """ Calls the bidsify function with cmd line arguments. """
@@ -101,6 +127,35 @@ def run_cmd():
                         help='Do not write out log (stdout/err only)',
                         required=False, action='store_true',
                         default=False)
+
+    parser.add_argument('--scratch-dir',
+                        help=('Directory on fast (local) disk to process '
+                              'sessions in (not used with --docker)'),
+                        required=False, default=None)
+
+    parser.add_argument('--continue-on-error',
+                        help=('Continue with the other sessions when a session '
+                              'fails (and record the error in the failure ledger)'),
+                        required=False, action='store_true',
+                        default=False)
+
+    parser.add_argument('--rerun-failed',
+                        help='Only convert the sessions in the failure ledger',
+                        required=False, action='store_true',
+                        default=False)
+
+    parser.add_argument('--participant-label',
+                        help='Subject label(s) or glob(s) to convert, e.g. 01 0*',
+                        required=False, nargs='+', default=None)
+
+    parser.add_argument('--session-label',
+                        help='Session label(s) or glob(s) to convert, e.g. 1',
+                        required=False, nargs='+', default=None)
+
+    parser.add_argument('--datatype',
+                        help=('Datatype(s) (e.g. fmap) or modality type(s) '
+                              '(e.g. phasediff) to (re)convert'),
+                        required=False, nargs='+', default=None)
     args = parser.parse_args()
     
     if args.out is None:
@@ -124,10 +179,17 @@ def run_cmd():
                         out_dir=args.out, validate=args.validate, spinoza=args.spinoza, nolog=args.nolog)
     else:
         bidsify(cfg_path=args.config_file, directory=args.directory,
-                out_dir=args.out, validate=args.validate)
+                out_dir=args.out, validate=args.validate,
+                scratch_dir=args.scratch_dir,
+                on_error='continue' if args.continue_on_error else None,
+                rerun_failed=args.rerun_failed or None,
+                participant_label=args.participant_label,
+                session_label=args.session_label, datatypes=args.datatype)
 
 
-def bidsify(cfg_path, directory, out_dir, validate):
+def bidsify(cfg_path, directory, out_dir, validate, scratch_dir=None,
+            on_error=None, rerun_failed=None, participant_label=None,
+            session_label=None, datatypes=None):
     """ Converts (raw) MRI datasets to the BIDS-format [1].
 
     Parameters
@@ -140,11 +202,34 @@ def bidsify(cfg_path, directory, out_dir, validate):
         Path to output-directory
     validate : bool
         Whether to run bids-validator on the bids-converted data
+    scratch_dir : str or None
+        Directory (e.g. on local disk or tmpfs) to process sessions in,
+        which are moved to out_dir when finished; overrides the
+        scratch_dir option in the config
+    on_error : str or None
+        What to do when a session fails: 'abort' or 'continue'; overrides
+        the on_error option in the config
+    rerun_failed : bool or None
+        Whether to only convert the sessions that failed before (as
+        recorded in the failure ledger); overrides the rerun_failed option
+        in the config
+    participant_label : list or None
+        Labels or globs of the subjects to convert (e.g. ['01', '1*']);
+        overrides the participant_label option in the config
+    session_label : list or None
+        Labels or globs of the sessions to convert; overrides the
+        session_label option in the config
+    datatypes : list or None
+        Datatypes (e.g. 'fmap') and/or modality types (e.g. 'phasediff') to
+        convert; sessions that were converted before are updated (only
+        replacing the files of these datatypes). Overrides the datatypes
+        option in the config
 
     Returns
     -------
-    layout : BIDSLayout object
-        A BIDSLayout object from the pybids package.
+    layout : BIDSIndex object
+        Queryable index of the converted files (entities and key sidecar
+        fields), which is also stored in the output-directory.
 
     References
     ----------
@@ -154,181 +239,463 @@ def bidsify(cfg_path, directory, out_dir, validate):
            outputs of neuroimaging experiments. Scientific Data, 3, 160044.
     """
 
-    # First, parse the config file
-    cfg = _parse_cfg(cfg_path, directory, out_dir)
-    cfg['orig_cfg_path'] = cfg_path
-  
-    # Check whether everything is available
-    if not check_executable('dcm2niix'):
-        msg = """The program 'dcm2niix' was not found on this computer;
-        install dcm2niix from neurodebian (Linux users) or download dcm2niix
-        from Github (link) and compile locally (Mac/Windows); bidsify
-        needs dcm2niix to convert MRI-files to nifti!. Alternatively, use
-        the bidsify Docker image (not yet tested)!"""
-        warnings.warn(msg)
-
-    if not check_executable('bids-validator') and validate:
-        msg = """The program 'bids-validator' was not found on your computer;
-        setting the validate option to False"""
-        warnings.warn(msg)
-        validate = False
-
-    # Extract some values from cfg for readability
-    options = cfg['options']
-    out_dir = options['out_dir']
-    subject_stem = options['subject_stem']
-    
-    # Find subject directories
-    sub_dirs = [d for d in sorted(glob(op.join(directory, '%s*' % subject_stem)))
-                if op.isdir(d)]
-
-    if not sub_dirs:
-        msg = ("Could not find subject dirs in directory %s with subject stem "
-               "'%s'." % (directory, subject_stem))
-        raise ValueError(msg)
-
-    # Process directories of each subject
-    for sub_dir in sub_dirs:
-        _process_directory(sub_dir, out_dir, cfg, is_sess=False)
-
-    # Write example description_dataset.json to disk
-    desc_json = op.join(op.dirname(__file__), 'data',
-                        'dataset_description.json')
-    dst = op.join(out_dir, 'dataset_description.json')
-    shutil.copyfile(src=desc_json, dst=dst)
-
-    # Copy .bidsignore (if any)
-    bidsignore_file = op.join(directory, '.bidsignore')
-    if op.isfile(bidsignore_file):
-        shutil.copyfile(src=bidsignore_file, dst=op.join(out_dir, '.bidsignore'))
-
-    # Write participants.tsv to disk
-    found_sub_dirs = sorted(glob(op.join(cfg['options']['out_dir'], 'sub-*')))
-    sub_names = [op.basename(s) for s in found_sub_dirs]
-
-    participants_tsv = pd.DataFrame(index=range(len(sub_names)),
-                                    columns=['participant_id'])
-    participants_tsv['participant_id'] = sub_names
-    f_out = op.join(out_dir, 'participants.tsv')
-    participants_tsv.to_csv(f_out, sep='\t', index=False)
-
-    if validate:
-        bids_validator_log = op.join(out_dir, 'bids_validator_log.txt')
-        if op.isfile(bids_validator_log):
-            print("Removing old BIDS-validator log prior to validation ...")
-            os.remove(bids_validator_log)
-
-        cmd = ['bids-validator', '--ignoreNiftiHeaders', out_dir]
-
-        rs = _run_cmd(cmd, outfile=bids_validator_log, verbose=True)
-        if rs == 0:
-            msg = ("bidsify exited without errors and passed the "
-                   "bids-validator checks! For the complete bids-validator "
-                   "report, see %s." % bids_validator_log)
-            print(msg)
-        else:
-            msg = ("bidsify exited without errors but the bids-validator "
-                   "raised one or more errors. Check the complete "
-                   "bids-validator report here: %s." % bids_validator_log)
-            f = open(bids_validator_log, 'r')
-            file_contents = f.read()
-            print(file_contents)
-            f.close()
-            raise ValueError(msg)
+    run = _BidsifyRun(cfg_path, directory, out_dir, validate,
+                      scratch_dir=scratch_dir, on_error=on_error,
+                      rerun_failed=rerun_failed,
+                      participant_label=participant_label,
+                      session_label=session_label, datatypes=datatypes)
+    for _ in run.sessions():
+        pass
 
+    return run.finish()
 
-def _process_directory(cdir, out_dir, cfg, is_sess=False):
-    """ Main workhorse of bidsify """
 
-    options = cfg['options']
-    n_cores = options['n_cores']
+class _BidsifyRun(object):
+    """ A single bidsify run over one raw data directory.
 
-    if is_sess:
-        sub_name = _extract_sub_nr(options['subject_stem'],
-                                   op.basename(op.dirname(cdir)))
-        sess_name = op.basename(cdir)
-        this_out_dir = op.join(out_dir, sub_name, sess_name)
-    else:
-        sub_name = _extract_sub_nr(options['subject_stem'], op.basename(cdir))
-        this_out_dir = op.join(out_dir, sub_name)
+    Setting up (parsing the config, finding subjects), processing the
+    sessions (one at a time, through the `sessions` generator), and
+    finishing the dataset (dataset-level files, reports, validation) are
+    separate steps, so that runs can be interleaved by the batch API.
 
-    # Important: to find session-dirs, they should be named
-    # ses-*something*
-    sess_dirs = sorted(glob(op.join(cdir, 'ses-*')))
+    Parameters
+    ----------
+    cfg_path, directory, out_dir, validate, scratch_dir, on_error,
+    rerun_failed, participant_label, session_label, datatypes
+        See `bidsify`
+    configure : bool
+        Whether to (re)configure the shared tool scheduler with the CPU
+        budget and tool limits of this config
+    """
+
+    def __init__(self, cfg_path, directory, out_dir, validate,
+                 scratch_dir=None, configure=True, on_error=None,
+                 rerun_failed=None, participant_label=None, session_label=None,
+                 datatypes=None):
+
+        # First, parse the config file
+        cfg = _parse_cfg(cfg_path, directory, out_dir)
+        cfg['orig_cfg_path'] = cfg_path
+        overrides = dict(scratch_dir=scratch_dir, on_error=on_error,
+                         rerun_failed=rerun_failed,
+                         participant_label=participant_label,
+                         session_label=session_label, datatypes=datatypes)
+        for key, value in overrides.items():
+            if value is not None:
+                cfg['options'][key] = value
+
+        _parse_filters(cfg['options'])
+
+        # Check whether everything is available
+        native = cfg['options']['mri_ext'] == 'PAR' and cfg['options']['par_engine'] == 'nibabel'
+        if not check_executable('dcm2niix') and not native:
+            msg = """The program 'dcm2niix' was not found on this computer;
+            install dcm2niix from neurodebian (Linux users) or download dcm2niix
+            from Github (link) and compile locally (Mac/Windows); bidsify
+            needs dcm2niix to convert MRI-files to nifti!. Alternatively, use
+            the bidsify Docker image (not yet tested)!"""
+            warnings.warn(msg)
 
-    if sess_dirs:
-        # Recursive call to _process_directory
-        for sess_dir in sess_dirs:
-            _process_directory(sess_dir, out_dir, cfg, is_sess=True)
+        if not check_executable('bids-validator') and validate:
+            msg = """The program 'bids-validator' was not found on your computer;
+            setting the validate option to False"""
+            warnings.warn(msg)
+            validate = False
 
-        return None  # break out of recursive function
+        # Extract some values from cfg for readability
+        options = cfg['options']
+        out_dir = options['out_dir']
+        subject_stem = options['subject_stem']
+
+        # All external tools share a single scheduler with a global CPU budget
+        if configure:
+            self.scheduler = get_scheduler(n_cores=options['n_cores'],
+                                           tool_limits=options['tool_limits'])
+        else:
+            self.scheduler = get_scheduler()
+        self.n_usage = len(self.scheduler.usage)  # to report this run only
+        if options['metrics_port'] is not None:
+            # Only imported when needed (it starts an HTTP server)
+            from .metrics import get_metrics, start_metrics_server
+            start_metrics_server(int(options['metrics_port']))
+            self.scheduler.metrics = get_metrics()
+
+        # Find subject directories (or archives)
+        sub_dirs = [d for d in sorted(glob(op.join(directory, '%s*' % subject_stem)))
+                    if op.isdir(d) or is_archive(d)]
+        sub_dirs = drop_duplicate_sources(sub_dirs)
+
+        if not sub_dirs:
+            msg = ("Could not find subject dirs in directory %s with subject stem "
+                   "'%s'." % (directory, subject_stem))
+            raise ValueError(msg)
+
+        if options['participant_label'] is not None:
+            sub_dirs = [d for d in sub_dirs if _match_label(
+                _extract_sub_nr(subject_stem, archive_stem(d))[4:],
+                options['participant_label'])]
+            if not sub_dirs:
+                raise ValueError("None of the subjects in directory %s matches "
+                                 "participant_label %r." %
+                                 (directory, options['participant_label']))
+
+        # State shared by all sessions: a registry of raw scans (to avoid
+        # converting duplicates), the index of output files, and (optionally)
+        # the archive to stream converted sessions into
+        _make_dir(out_dir)
+        ctx = dict(registry=ScanRegistry(), index=BIDSIndex.load(out_dir),
+                   archive=None, scratch=None, protocols=dict(), cache=None)
+        ctx['inherited'] = InheritedMetadata(out_dir, ctx['index'])
+        if options['cache_dir'] is not None:
+            ctx['cache'] = ConversionCache(options['cache_dir'],
+                                           max_size=options['cache_size'])
+        if options['archive']:
+            ctx['archive'] = BIDSArchive(out_dir, mode=options['archive'],
+                                         archive_dir=options['archive_dir'])
+
+        self.cfg = cfg
+        self.ctx = ctx
+        self.ledger = FailureLedger(out_dir)
+        self.directory = directory
+        self.out_dir = out_dir
+        self.validate = validate
+        self.sub_dirs = sub_dirs
+
+    def sessions(self):
+        """ Processes the sessions one by one and yields their results. """
+
+        options = self.cfg['options']
+        ctx = self.ctx
+        if options['scratch_dir'] is not None:
+            ctx['scratch'] = tempfile.mkdtemp(prefix='bidsify_',
+                                              dir=_make_dir(options['scratch_dir']))
+        elif options['datatypes'] is not None:
+            # Sessions converted before are updated from a staging dir
+            ctx['scratch'] = tempfile.mkdtemp(prefix='.bidsify_partial_',
+                                              dir=self.out_dir)
+
+        # Sessions may be directories or archives
+        metrics = self.scheduler.metrics
+        sources = [(sub_dir, find_session_sources(sub_dir))
+                   for sub_dir in self.sub_dirs]
+        if options['rerun_failed']:
+            failed = self.ledger.sessions()
+            print("Re-running %i failed session(s) ..." % len(failed))
+            sources = [(sub_dir, [s for s in sessions
+                                  if _get_session(s[0], options, s[1])[1] in failed])
+                       for sub_dir, sessions in sources]
+
+        if options['session_label'] is not None:
+            # Subjects without sessions are skipped as well
+            sources = [(sub_dir, [s for s in sessions if s[1] and _match_label(
+                           op.basename(s[0])[4:], options['session_label'])])
+                       for sub_dir, sessions in sources]
+
+        if metrics is not None:
+            metrics.session_queued(sum(len(s) for _, s in sources))
+
+        # Read the raw files of the next sessions while converting
+        prefetcher = None
+        if options['prefetch']:
+            prefetch_dir = options['scratch_dir'] and _make_dir(options['scratch_dir'])
+            prefetcher = Prefetcher(tempfile.mkdtemp(prefix='bidsify_prefetch_',
+                                                     dir=prefetch_dir),
+                                    float(options['prefetch']))
+            prefetcher.start([(cdir, source) for _, sessions in sources
+                              for cdir, is_sess, source in sessions
+                              if not self._is_skipped(cdir, is_sess)])
+
+        # Process directories of each subject
+        try:
+            for sub_dir, sessions in sources:
+                for cdir, is_sess, source in sessions:
+                    if prefetcher is not None:
+                        source = prefetcher.take(cdir, source)
+
+                    if metrics is not None:
+                        metrics.session_started()
+                    try:
+                        with self._admit(cdir, is_sess, source):
+                            result = _process_directory(cdir, self.out_dir, self.cfg,
+                                                        is_sess=is_sess, ctx=ctx,
+                                                        source=source)
+                    except Exception as e:
+                        if metrics is not None:
+                            metrics.session_finished('failed')
+                        if options['on_error'] != 'continue':
+                            raise
+                        result = self._fail_session(cdir, is_sess, source, e)
+                    else:
+                        if metrics is not None:
+                            n_bytes = sum(op.getsize(f) for f in result['outputs']
+                                          if op.isfile(f))
+                            state = ('done' if result['status'] == 'converted'
+                                     else result['status'])
+                            metrics.session_finished(state, n_bytes=n_bytes)
+                        if result['status'] == 'converted':
+                            self.ledger.resolve(result['session'])
+
+                    if prefetcher is not None:
+                        prefetcher.release(cdir)
+
+                    yield result
+
+                if ctx['archive'] is not None:
+                    sub_name = _extract_sub_nr(options['subject_stem'],
+                                               archive_stem(sub_dir))
+                    ctx['archive'].close_subject(sub_name)
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+
+            if ctx['scratch'] is not None:
+                shutil.rmtree(ctx['scratch'], ignore_errors=True)
+                ctx['scratch'] = None
+
+    def _is_skipped(self, cdir, is_sess):
+        """ Whether a session will be skipped, because it was converted
+        before (and not only some datatypes are (re)converted). """
+        _, session = _get_session(cdir, self.cfg['options'], is_sess=is_sess)
+        return (self.cfg['options']['datatypes'] is None and
+                op.isdir(op.join(self.out_dir, session)))
+
+    def _admit(self, cdir, is_sess, source):
+        """ Returns a context that waits until the estimated peak disk usage
+        and memory of a session fit, e.g. next to the sessions of other runs
+        in a batch (see ToolScheduler.admit). """
+        if self._is_skipped(cdir, is_sess):
+            return contextlib.ExitStack()  # no-op (nullcontext needs Python 3.7)
+
+        _, session = _get_session(cdir, self.cfg['options'], is_sess=is_sess)
+        disk, memory = estimate_session(source, self.cfg,
+                                        n_cores=self.scheduler.n_cores)
+        return self.scheduler.admit(disk=disk, memory=memory, name=session,
+                                    path=self.ctx['scratch'] or self.out_dir)
+
+    def _fail_session(self, cdir, is_sess, source, exc):
+        """ Quarantines the partial output of a failed session, records the
+        error in the failure ledger, and returns the result of the session
+        (with status 'failed'). Should be called while handling exc. """
+
+        _, session = _get_session(cdir, self.cfg['options'], is_sess=is_sess)
+        quarantine = _quarantine_session(
+            session, self.out_dir, self.ctx,
+            partial=self.cfg['options']['datatypes'] is not None)
+        self.ledger.record(session, cdir if source is None else source.path,
+                           exc, quarantine=quarantine)
+        print("Failed to convert %s (%s: %s); see %s - continuing ..." %
+              (session, type(exc).__name__, exc, self.ledger.path))
+        return dict(session=session, status='failed', outputs=[],
+                    wall_time=None, error=traceback.format_exc())
+
+    def finish(self):
+        """ Writes the dataset-level files and reports, and (optionally)
+        validates the dataset. Returns the index of the dataset. """
+
+        out_dir, directory = self.out_dir, self.directory
+        registry, archive, index = (self.ctx['registry'], self.ctx['archive'],
+                                    self.ctx['index'])
+        if registry.records:
+            unall_dir = _make_dir(op.join(out_dir, 'unallocated'))
+            registry.write_report(op.join(unall_dir, 'duplicates.tsv'))
+
+        # Write example description_dataset.json to disk
+        desc_json = op.join(op.dirname(__file__), 'data',
+                            'dataset_description.json')
+        dst = op.join(out_dir, 'dataset_description.json')
+        copy_hashed(desc_json, dst)
+
+        # Copy .bidsignore (if any)
+        bidsignore_file = op.join(directory, '.bidsignore')
+        if op.isfile(bidsignore_file):
+            copy_hashed(bidsignore_file, op.join(out_dir, '.bidsignore'))
+
+        # Write participants.tsv to disk
+        found_sub_dirs = sorted(glob(op.join(out_dir, 'sub-*')))
+        sub_names = [op.basename(s) for s in found_sub_dirs]
+
+        participants_tsv = pd.DataFrame(index=range(len(sub_names)),
+                                        columns=['participant_id'])
+        participants_tsv['participant_id'] = sub_names
+        f_out = op.join(out_dir, 'participants.tsv')
+        write_text(f_out, participants_tsv.to_csv(sep='\t', index=False))
+
+        toplevel = [dst, f_out, op.join(out_dir, '.bidsignore')]
+        toplevel.extend(_write_inherited_metadata(out_dir, self.ctx['inherited']))
+
+        # Merge the checksums of all sessions and the files above
+        manifest = write_dataset_manifest(out_dir, toplevel=toplevel)
+        if archive is not None:
+            archive.close()
+            archive.write_toplevel([f for f in toplevel + [manifest] if op.isfile(f)])
+
+        index.save()
+
+        # Write resource usage of the external tools of this run
+        usage = self.scheduler.usage_report(start=self.n_usage, dataset=out_dir)
+        if len(usage):
+            f_usage = op.join(out_dir, '.bidsify_resources.tsv')
+            usage.to_csv(f_usage, sep='\t', index=False)
+            summary = self.scheduler.usage_report(start=self.n_usage, by='tool',
+                                                  dataset=out_dir)
+            print("Resource usage of external tools (see %s):" % f_usage)
+            print(summary.to_string(index=False))
+
+        if len(self.ledger):
+            print("%i session(s) failed to convert (see %s); fix the errors "
+                  "and convert them with --rerun-failed" %
+                  (len(self.ledger), self.ledger.path))
+
+        if self.validate:
+            bids_validator_log = op.join(out_dir, 'bids_validator_log.txt')
+            if op.isfile(bids_validator_log):
+                print("Removing old BIDS-validator log prior to validation ...")
+                os.remove(bids_validator_log)
+
+            cmd = ['bids-validator', '--ignoreNiftiHeaders', out_dir]
+
+            rs = _run_cmd(cmd, outfile=bids_validator_log, verbose=True)
+            if rs == 0:
+                msg = ("bidsify exited without errors and passed the "
+                       "bids-validator checks! For the complete bids-validator "
+                       "report, see %s." % bids_validator_log)
+                print(msg)
+            else:
+                msg = ("bidsify exited without errors but the bids-validator "
+                       "raised one or more errors. Check the complete "
+                       "bids-validator report here: %s." % bids_validator_log)
+                f = open(bids_validator_log, 'r')
+                file_contents = f.read()
+                print(file_contents)
+                f.close()
+                raise ValueError(msg)
 
+        return index
+
+
+def _process_directory(cdir, out_dir, cfg, is_sess=False, ctx=None,
+                       source=None):
+    """ Main workhorse of bidsify: converts a single session (or subject
+    without sessions). The raw files are read from source (a DirSource or
+    ArchiveSource; default: the directory cdir).
+
+    Returns
+    -------
+    result : dict
+        Session (e.g. sub-01/ses-1), status ('converted', 'skipped' if it
+        was converted before, or 'empty'), outputs (list of BIDS files),
+        and wall_time (in seconds)
+    """
+
+    options = cfg['options']
+    if ctx is None:
+        ctx = dict(registry=ScanRegistry(), index=BIDSIndex.load(out_dir),
+                   archive=None, scratch=None, protocols=dict(), cache=None)
+        ctx['inherited'] = InheritedMetadata(out_dir, ctx['index'])
+    archive = ctx['archive']
+    t_start = time.time()
+
+    sub_name, session = _get_session(cdir, options, is_sess=is_sess)
+    sess_name = op.basename(session)
+    this_out_dir = op.join(out_dir, session)
+    result = dict(session=session, status='skipped', outputs=[],
+                  wall_time=None)
+
+    # With a datatypes filter, sessions that were converted before are
+    # updated (only replacing the outputs of the selected datatypes)
+    datatypes = options['datatypes']
     already_exists = op.isdir(this_out_dir)
-    if already_exists:
+    if already_exists and datatypes is None:
         print('Data from %s has been converted already - skipping ...' % sub_name)
-        return None
+        return result
+    elif not already_exists and datatypes is not None:
+        # Otherwise, the session would look complete to later (full) runs
+        print('Data from %s has not been converted yet, so the datatypes cannot '
+              'be updated - skipping ...' % sub_name)
+        return result
     else:
         msg = 'Converting data from %s ...' % sub_name
         if is_sess:
             msg += ' (%s)' % sess_name
+        if datatypes is not None:
+            msg += ' [%s]' % ', '.join(datatypes)
         print(msg)
 
-    # Make dir and copy all files to this dir
-    _make_dir(this_out_dir)
-    all_files = sorted([f for f in glob(op.join(cdir, '*')) if op.isfile(f)])
-
-    if not all_files:
-        all_files = sorted([f for f in glob(op.join(cdir, '*', '*')) if op.isfile(f)])
-
-    if not all_files:
-        return None
+    # Process the session in the scratch dir (if any), using the same
+    # layout as the output dir, and publish it when it is done
+    work_root = out_dir if ctx['scratch'] is None else ctx['scratch']
+    work_dir = op.join(work_root, session)
 
-    for f in all_files:
-        dst = os.path.join(this_out_dir, op.basename(f))
-        if os.path.isdir(f):
-            shutil.copytree(f, dst)
-        else:
-            shutil.copy2(f, dst)
+    if source is None:
+        source = DirSource(cdir)
+    all_files = source.list_files()
 
-    # First, convert all MRI-files
-    convert_mri(this_out_dir, cfg)
+    if datatypes is not None:
+        all_files = _select_raw_files(all_files, cfg, datatypes)
 
-    # Remove weird ADC file(s); no clue what they represent ...
-    [os.remove(f) for f in glob(op.join(this_out_dir, '*ADC*.nii.gz'))]
-
-    # If spinoza-data (there is no specific config file), try to infer elements
-    # from converted data
-    if 'spinoza_cfg' in op.basename(cfg['orig_cfg_path']):
-        dtype_elements = _infer_dtype_elements(this_out_dir, cfg)
-        cfg.update(dtype_elements)
-        if cfg['options']['debug']:
-            print("Creating the following config:")
-            print(json.dumps(cfg, indent = 4))
-
-    # Check which datatypes (dtypes) are available (func, anat, fmap, dwi)
-    cfg['data_types'] = [c for c in cfg.keys() if c in DTYPES]
-    cfg = _extract_metadata_from_cfg(cfg)
-
-    # Rename and move stuff
-    data_dirs = []
-    for dtype in cfg['data_types']:
-        ddir = _rename(this_out_dir, dtype, sub_name, cfg)
-        if ddir is not None:
-            data_dirs.append(ddir)
+    if not all_files:
+        result['status'] = 'empty'
+        return result
 
-    # 2. Transform PHYS (if any)
-    if cfg['mappings']['physio'] is not None:
-        idf = cfg['mappings']['physio']
-        phys = sorted(glob(op.join(this_out_dir, '*', '*%s*' % idf)))
-        Parallel(n_jobs=n_cores)(delayed(convert_phy)(f) for f in phys)
+    # Make dir and copy all files to this dir
+    _make_dir(work_dir)
+
+    if source.is_archive:
+        # Only extract the members that can end up in the dataset
+        members = select_files(all_files, cfg)
+        if len(members) < len(all_files):
+            print("Skipping %i file(s) in %s that match none of the mappings" %
+                  (len(all_files) - len(members), source.path))
+        all_files = source.copy_files(members, work_dir)
+
+    # Fingerprints of the raw files (by basename), which are also the keys
+    # of the conversion cache
+    fingerprints = dict()
+    if options['deduplicate']:
+        # Don't copy/convert scans that are in this session more than once
+        duplicates = find_duplicate_scans(all_files, cfg, session,
+                                          ctx['registry'],
+                                          fingerprints=fingerprints)
+        if duplicates:
+            print("Skipping duplicate scan(s) for %s:" % session)
+            print('\n'.join(duplicates))
+        all_files = [f for f in all_files if f not in duplicates]
+        if source.is_archive:
+            [os.remove(f) for f in duplicates]
+
+    if not source.is_archive:
+        source.copy_files(all_files, work_dir)
+
+    # The other outputs of the session (e.g. the functional files for the
+    # IntendedFor field of fieldmaps) are known from the index
+    existing = None
+    if already_exists:
+        prefix = session.replace(os.sep, '/') + '/'
+        existing = [row for row in ctx['index'].get(return_type='dict')
+                    if row['path'].startswith(prefix)
+                    and not _is_selected(row['path'], datatypes)]
+
+    # Convert, rename, add metadata, reorient, deface, and compress
+    index = BIDSIndex(work_root)
+    inherited = ctx['inherited'] if options['inherit_metadata'] else None
+    with usage_tags(dataset=out_dir, session=session):
+        scans = _run_session_pipeline(work_dir, sub_name, cfg, index=index,
+                                      protocols=ctx['protocols'],
+                                      cache=ctx['cache'], inherited=inherited,
+                                      datatypes=datatypes, existing=existing,
+                                      fingerprints=fingerprints)
 
     # Also, while we're at it, remove bval/bvecs of dwi topups
-    epi_bvals_bvecs = glob(op.join(this_out_dir, 'fmap', '*_epi.bv[e,a][c,l]'))
+    epi_bvals_bvecs = glob(op.join(work_dir, 'fmap', '*_epi.bv[e,a][c,l]'))
     [os.remove(f) for f in epi_bvals_bvecs]
+    [index.remove_file(f) for f in epi_bvals_bvecs]
 
     # Let's move stuff that's never allocated to a dtype to the unall dir
-    unallocated = [f for f in glob(op.join(this_out_dir, '*')) if op.isfile(f)]
-    if unallocated:
+    unallocated = [f for f in glob(op.join(work_dir, '*')) if op.isfile(f)]
+    if unallocated and datatypes is not None:
+        # Were dealt with when converting all datatypes
+        [os.remove(f) for f in unallocated]
+    elif unallocated:
         print('Unallocated files for %s:' % sub_name)
         print('\n'.join(unallocated))
 
@@ -346,26 +713,556 @@ def _process_directory(cdir, out_dir, cfg, is_sess=False):
             else:
                 os.remove(f)
 
-    # ... and extract some extra meta-data
-    for data_dir in data_dirs:
-        _add_missing_BIDS_metadata_and_save_to_disk(data_dir, cfg)
+    if already_exists:
+        # Replace the outputs of the selected datatypes in the session
+        _update_session(work_dir, this_out_dir, out_dir, scans, datatypes,
+                        ctx['index'])
+    else:
+        if scans:
+            _write_scans_tsv(work_dir, scans)
+
+        # Checksums of the session's files (mostly computed while writing them)
+        write_session_manifest(work_dir, work_root)
+
+        if ctx['scratch'] is not None:
+            _make_dir(op.dirname(this_out_dir))
+            _publish_dir(work_dir, this_out_dir)
+
+    # The manifest has the digests now (and other files were (re)moved)
+    forget_digests(work_dir)
+
+    ctx['index'].update(index)
+    ctx['index'].save()
+
+    if archive is not None:
+        archive.add_session(this_out_dir)
+
+    result.update(status='converted', wall_time=time.time() - t_start,
+                  outputs=[op.join(out_dir, row['path'])
+                           for row in index.get(return_type='dict')])
+    return result
+
+
+def _get_session(cdir, options, is_sess=False):
+    """ Returns the subject (e.g. sub-01) and session (e.g. sub-01/ses-1,
+    or sub-01 for subjects without sessions) of a raw session dir. """
+
+    if is_sess:
+        sub_name = _extract_sub_nr(options['subject_stem'],
+                                   op.basename(op.dirname(cdir)))
+        return sub_name, op.join(sub_name, op.basename(cdir))
+
+    sub_name = _extract_sub_nr(options['subject_stem'], op.basename(cdir))
+    return sub_name, sub_name
+
+
+def _match_label(label, patterns):
+    """ Whether a subject or session label (e.g. 01 for sub-01) matches one
+    of the labels or globs (e.g. 0*) in patterns. """
+    return any(fnmatch.fnmatch(label, p) for p in patterns)
+
+
+def _get_selected_dtypes(datatypes):
+    """ Returns the dtypes (e.g. fmap) of the selected datatypes and mtypes
+    (e.g. phasediff). """
+    return set(dtype for dtype, mtypes in MTYPE_PER_DTYPE.items()
+               if dtype in datatypes or set(mtypes) & set(datatypes))
+
+
+def _is_selected(f, datatypes):
+    """ Whether a BIDS file (in a datatype dir) is of one of the selected
+    datatypes or mtypes. """
+    dtype = op.basename(op.dirname(f))
+    if dtype in datatypes:
+        return True
+
+    suffix = parse_bids_name(op.basename(f)).get('suffix')
+    return suffix in datatypes and suffix in MTYPE_PER_DTYPE.get(dtype, [])
+
+
+def _select_raw_files(files, cfg, datatypes):
+    """ Selects the raw files of the selected datatypes, i.e., files that
+    match the identifier of one of their elements. (Enhanced) DICOM files and
+    data without elements in the config (Spinoza data) are only selected
+    after conversion, by their BIDS names. """
+
+    if cfg['options']['mri_ext'] in ['DICOM', 'dcm'] or not any(d in cfg for d in DTYPES):
+        return list(files)
+
+    idfs = ['*%s*' % elem['id'] for dtype in _get_selected_dtypes(datatypes)
+            for elem in cfg.get(dtype, dict()).values()
+            if isinstance(elem, dict) and 'id' in elem]
+    return [f for f in files
+            if any(fnmatch.fnmatch(op.basename(f), idf) for idf in idfs)]
+
+
+def _update_session(work_dir, session_dir, out_dir, scans, datatypes, index):
+    """ Replaces the outputs of the selected datatypes of a session that was
+    converted before by the re-converted ones (in work_dir), and updates its
+    scans.tsv, manifest, and the index. """
+
+    old = [f for dtype in DTYPES
+           for f in sorted(glob(op.join(session_dir, dtype, '*')))
+           if _is_selected(f, datatypes)]
+    for f in old:
+        os.remove(f)
+        index.remove_file(f)
+
+    new = []
+    for dirpath, _, fnames in os.walk(work_dir):
+        new.extend(op.join(dirpath, f) for f in fnames if not f.startswith('.'))
+
+    digests = dict()
+    for f, digest in get_digests(new).items():
+        dst = op.join(session_dir, op.relpath(f, work_dir))
+        _make_dir(op.dirname(dst))
+        shutil.move(f, dst)
+        digests[dst] = digest
+
+    # Keep the rows of the other scans in scans.tsv
+    f_scans = glob(op.join(session_dir, '*_scans.tsv'))
+    if f_scans:
+        rows = pd.read_csv(f_scans[0], sep='\t', keep_default_na=False)
+        rows = [row for row in rows.to_dict(orient='records')
+                if not _is_selected(op.join(session_dir, row['filename']), datatypes)]
+        scans = rows + list(scans)
+
+    if scans:
+        f_scans = _write_scans_tsv(session_dir, scans)
+        digests.update(get_digests([f_scans]))
+
+    update_session_manifest(session_dir, out_dir, digests, removed=old)
+    shutil.rmtree(work_dir)
+
+
+def _quarantine_session(session, out_dir, ctx, partial=False):
+    """ Moves the partial output of a failed session (from the scratch or
+    output dir) to the quarantine dir and removes its files from the index,
+    so that the session can be converted again. If only some datatypes were
+    converted (partial), only the staged output is moved, and the session
+    in the output dir is left as it was.
+
+    Returns
+    -------
+    quarantine : str or None
+        Directory with the partial output (None if there was none)
+    """
+
+    index = ctx['index']
+    prefix = session.replace(os.sep, '/') + '/'
+    stale = [row['path'] for row in index.get(return_type='dict')
+             if row['path'].startswith(prefix)]
+    if stale and not partial:
+        [index.remove_file(op.join(out_dir, f)) for f in stale]
+        index.save()
+
+    dst = op.join(out_dir, QUARANTINE_DIR, session)
+    for root in [ctx['scratch']] + ([] if partial else [out_dir]):
+        src = None if root is None else op.join(root, session)
+        if src is not None and op.isdir(src):
+            break
+    else:
+        return None
+
+    if op.isdir(dst):  # from an earlier attempt
+        shutil.rmtree(dst)
+
+    forget_digests(src)
+    _make_dir(op.dirname(dst))
+    shutil.move(src, dst)
+
+    # Don't leave an empty subject dir behind (e.g. of sub-01/ses-1)
+    parent = op.dirname(src)
+    if parent != root and not os.listdir(parent):
+        os.rmdir(parent)
+
+    return dst
+
+
+def _run_session_pipeline(cdir, sub_name, cfg, index=None, protocols=None,
+                          cache=None, inherited=None, datatypes=None,
+                          existing=None, fingerprints=None):
+    """ Processes the files of a single session as a dependency graph.
+
+    Each raw file goes through convert -> rename -> sidecar -> reorient ->
+    deface -> compress, but files do not wait for each other unless they
+    really have to (e.g., the IntendedFor field of fieldmaps needs all
+    functional files to be renamed), so different files can be in different
+    stages at the same time.
+
+    If an index (BIDSIndex) is given, renamed files and their key sidecar
+    fields are added to it. The protocols dict caches the completed config
+    of Spinoza-data per protocol across sessions. If a cache
+    (ConversionCache) is given, raw files that were processed before are
+    restored from the cache (and only renamed and given metadata) and newly
+    processed files are added; raw files are looked up by their fingerprints
+    (by basename), which are computed if they are not given.
+    If inherited (InheritedMetadata) is given, metadata shared by files is
+    written to dataset-level sidecars instead of to each sidecar. If
+    datatypes (dtypes and/or mtypes) are given, only files of these
+    datatypes are renamed and processed further; other outputs are removed.
+    The IntendedFor field of fieldmaps is resolved against the renamed
+    files plus the existing index rows of the session (if any).
+
+    Returns
+    -------
+    scans : list
+        Rows of the session's scans.tsv (collected while renaming files and
+        writing sidecars, so no extra pass over the data is needed)
+    """
+
+    options = cfg['options']
+    if datatypes is not None:
+        # Only files of the selected dtypes are matched to elements
+        cfg = deepcopy(cfg)
+
+    spinoza = 'spinoza_cfg' in op.basename(cfg['orig_cfg_path'])
+    # only reorient when not on Travis CI (on which FSL is not installed)
+    # and if FSL is available at all
+    reorient = 'TRAVIS' not in os.environ and check_executable('fslreorient2std')
+
+    if index is None:
+        # Only used to resolve the IntendedFor field of fieldmaps
+        root = op.dirname(cdir)
+        index = BIDSIndex(op.dirname(root) if op.basename(cdir).startswith('ses-') else root)
+
+    graph = TaskGraph()
+    state = dict(renamed=dict(), matched=set(), to_deface=[],
+                 lock=threading.Lock(),
+                 tmp_dirs=[], sources=dict(), scans=dict(), finals=dict(),
+                 cached=set(), to_cache=dict(), dropped=set(), targets=None)
+
+    mri_ext = options['mri_ext']
+    mri_files = find_mri_files(cdir, cfg)
+    if mri_ext == 'nifti':
+        _rename_phasediff_files(cdir, cfg, idf=_get_fmap_idfs(cfg))
+
+    # Files that do not need conversion (logs, physio, niftis, etc.)
+    mri_stems = [op.splitext(f)[0] for f in mri_files]
+    other_files = [f for f in sorted(glob(op.join(cdir, '*')))
+                   if op.isfile(f) and op.splitext(f)[0] not in mri_stems]
+
+    def _layout():
+        nonlocal cfg
+        # If spinoza-data (there is no specific config file), try to infer
+        # elements from converted data; sessions with a known protocol get
+        # the (shared) config of the first session with that protocol
+        if spinoza:
+            cfg = _infer_session_cfg(cdir, cfg, renamed=state['renamed'],
+                                     cache=protocols)
+            if options['debug']:
+                print("Creating the following config:")
+                print(json.dumps(cfg, indent = 4))
+        else:
+            # Check which datatypes (dtypes) are available (func, anat, fmap, dwi)
+            cfg['data_types'] = [c for c in cfg.keys() if c in DTYPES]
+            _extract_metadata_from_cfg(cfg)
+
+        if datatypes is not None:
+            # Not in place, as the config may be shared by sessions
+            selected = _get_selected_dtypes(datatypes)
+            cfg = dict((key, value) for key, value in cfg.items()
+                       if key not in DTYPES or key in selected)
+            cfg['data_types'] = [c for c in cfg['data_types'] if c in selected]
+
+        for dtype in cfg['data_types']:
+            if len(cfg[dtype]) == 0:
+                # If there are for some reason no elements, raise error
+                raise ValueError("The category '%s' does not have any entries in "
+                                 "your config-file!" % dtype)
+
+    # Without later processing (and a per-datatype storage policy), images
+    # can be compressed when converting
+    compress_direct = (options['compression'] is None and not options['debug']
+                       and not reorient and not options['deface'])
+
+    # Options that affect the processed images (not their names/metadata)
+    compression = 0 if options['debug'] else options['compression']
+    if mri_ext == 'PAR' and options['par_engine'] == 'nibabel':
+        converter = 'nibabel'
+    else:
+        converter = 'dcm2niix %s' % _dcm2niix_version()
+    cache_options = dict(mri_ext=mri_ext, compression=compression, reorient=reorient,
+                         deface=options['deface'], fmap=_get_fmap_idfs(cfg),
+                         converter=converter, version=__version__)
+
+    def _convert(f):
+        key, outputs, scan_info = None, None, dict()
+        if cache is not None and mri_ext in ['PAR', 'dcm']:
+            raw = [f] + ([_get_data_file(f)] if mri_ext == 'PAR' else [])
+            raw = [r for r in raw if r is not None]
+            fingerprint = (fingerprints or dict()).get(op.basename(f))
+            if fingerprint is None:
+                fingerprint = fingerprint_scan(f, mri_ext)
+            key = cache.key(raw, cache_options, fingerprint=fingerprint)
+            outputs, scan_info = cache.get(key, cdir)
+            if outputs is not None:
+                [os.remove(r) for r in raw]
+
+        if outputs is None:
+            scan_info = dict()
+            outputs = convert_mri_file(f, cfg, compress=compress_direct,
+                                       scan_info=scan_info)
+            if key is not None:
+                # Keep the raw sidecars, as metadata is added in place
+                jsons = dict()
+                for out in outputs:
+                    if out.endswith('.json'):
+                        with open(out, 'rb') as f_in:
+                            jsons[out] = f_in.read()
+                with state['lock']:
+                    state['to_cache'][key] = (outputs, jsons, scan_info)
+        else:
+            with state['lock']:
+                state['cached'].update(o for o in outputs if _is_nifti(o))
+
+        with state['lock']:
+            for out in outputs:
+                state['sources'][out] = dict(scan_info, source=op.basename(f))
+
+        name = 'rename:%s' % op.basename(f)
+        graph.add(name, _rename_group, args=(name, outputs),
+                  deps=['layout'])
+        graph.add_dependency('renamed', name)
+
+    def _rename_group(name, files):
+        dsts = []
+        for f in files:
+            orig = f
+            while f in state['renamed']:
+                f = state['renamed'][f]
+
+            if not op.isfile(f):
+                continue
+
+            with state['lock']:
+                dst = _rename_file(f, cdir, sub_name, cfg,
+                                   matched=state['matched'])
+                info = state['sources'].get(orig, dict(source=op.basename(orig)))
+
+            allocated = dst is not None
+            if not allocated:
+                dst = f  # ends up in unallocated (later)
+            elif datatypes is not None and not _is_selected(dst, datatypes):
+                os.remove(dst)
+                with state['lock']:
+                    state['dropped'].add(orig)
+                continue
+
+            # The final (compressed or uncompressed) name of the file
+            final = _get_final_name(dst, _get_compression(dst, options))
+            with state['lock']:
+                state['finals'][orig] = final
+                if orig in state['cached']:
+                    state['cached'].add(dst)
+
+            if allocated:
+                index.add_file(final)
+
+            if allocated and _is_nifti(dst) and op.basename(op.dirname(dst)) in DTYPES:
+                _add_scan(dst, final, info)
+
+            dsts.append(dst)
+
+        for dst in dsts:
+            _add_file_tasks(dst, name, dsts)
+
+    def _add_file_tasks(f, after, group):
+        dtype = op.basename(op.dirname(f))
+        if f.endswith('.json') and dtype in DTYPES:
+            # Fieldmaps need the images they are intended for (and their
+            # acquisition times)
+            deps = [after, 'targets'] if dtype == 'fmap' else [after]
+            graph.add('sidecar:%s' % f, _sidecar, args=(f,), deps=deps,
+                      tags=dict(input_file=op.basename(f)))
+            if dtype in ['func', 'dwi']:
+                graph.add_dependency('targets', 'sidecar:%s' % f)
+            return None
+
+        if _is_events_log(f) and dtype in DTYPES:
+            graph.add('events:%s' % f, _events, args=(f,), deps=[after],
+                      tags=dict(input_file=op.basename(f)))
+            return None
+
+        if not _is_nifti(f):
+            return None
+
+        deps = [after]
+        this_json = _strip_nii_ext(f) + '.json'
+        if this_json in group and dtype in DTYPES:
+            # Sidecar may need the (unreoriented) image header
+            deps.append('sidecar:%s' % this_json)
+
+        # Images from the cache have been processed already (but may have
+        # to be stored differently, e.g. if their datatype changed)
+        processed = f in state['cached']
+        if reorient and dtype in DTYPES and not processed:
+            graph.add('reorient:%s' % f, _reorient_file, args=(f,), deps=deps,
+                      tags=dict(input_file=op.basename(f)))
+            deps = ['reorient:%s' % f]
+
+        if options['deface'] and _is_deface_target(f) and not processed:
+            with state['lock']:
+                state['to_deface'].append(f)
+            deps.append('deface:%s' % f)
+
+        level = _get_compression(f, options)
+        if level != 0 and f.endswith('.nii'):
+            graph.add('compress:%s' % f, _compress, args=(f, PIGZ, level), deps=deps,
+                      tags=dict(input_file=op.basename(f)))
+        elif level == 0 and f.endswith('.nii.gz'):
+            graph.add('decompress:%s' % f, _decompress, args=(f,), deps=deps,
+                      tags=dict(input_file=op.basename(f)))
+
+    def _add_scan(f, final, info):
+        n_volumes = info.get('n_volumes')
+        if n_volumes is None:
+            # Only reads the header
+            shape = nib.load(f).shape
+            n_volumes = shape[3] if len(shape) > 3 else 1
+
+        with state['lock']:
+            state['scans'][_strip_nii_ext(f)] = dict(
+                filename=op.relpath(final, cdir).replace(os.sep, '/'),
+                acq_time='n/a', n_volumes=n_volumes, source=info['source'],
+                acq_date=info.get('acq_date')
+            )
+
+    def _targets():
+        rows = index.get(return_type='dict') + list(existing or [])
+        state['targets'] = FieldmapTargets(rows, nearest=options['intended_for_nearest'])
+
+    def _sidecar(f):
+        metadata = _add_metadata_to_json(f, cfg, inherited=inherited,
+                                         targets=state['targets'])
+        if metadata is None:
+            return None
+
+        index.update_metadata(f, metadata)
+
+        with state['lock']:
+            scan = state['scans'].get(op.splitext(f)[0])
+            if scan is not None:
+                scan['acq_time'] = _get_acq_time(metadata, scan['acq_date'])
+
+    def _events(f):
+        f_out = convert_log(f, options['events'])
+        if f_out is not None:
+            index.remove_file(f)
+            index.add_file(f_out)
+
+    def _plan_deface():
+        # Can only select the session's reference once all files are renamed
+        to_deface = sorted(state['to_deface'])
+        if not to_deface:
+            return None
+
+        ref = select_reference(to_deface)
+        tmp_dir = tempfile.mkdtemp(prefix='bidsify_deface_')
+        state['tmp_dirs'].append(tmp_dir)
+        deps = ['reorient:%s' % ref] if reorient else []
+        graph.add('deface-ref', register_template, args=(ref, tmp_dir),
+                  deps=deps, tags=dict(input_file=op.basename(ref)))
+        for i, f in enumerate(to_deface):
+            deps = ['deface-ref'] + (['reorient:%s' % f] if reorient else [])
+            graph.add('deface:%s' % f, _deface, args=(f, ref, tmp_dir, i),
+                      deps=deps, tags=dict(input_file=op.basename(f)))
+
+    def _deface(f, ref, tmp_dir, idx):
+        deface_file(f, ref, graph.result('deface-ref'), tmp_dir, idx)
+
+    def _physio():
+        if cfg['mappings']['physio'] is not None:
+            idf = cfg['mappings']['physio']
+            phys = sorted(glob(op.join(cdir, '*', '*%s*' % idf)))
+            [convert_phy(f) for f in phys]
+
+    # Spinoza elements are inferred from the converted files; otherwise,
+    # the config is completed first (converting doesn't need it)
+    converts = ['convert:%s' % op.basename(f) for f in mri_files]
+    graph.add('layout', _layout, deps=converts if spinoza else [])
+    graph.add('renamed', None, deps=['layout'] + converts)
+    for f, name in zip(mri_files, converts):
+        graph.add(name, _convert, args=(f,), deps=[] if spinoza else ['layout'],
+                  tags=dict(input_file=op.basename(f)))
+
+    # Enhanced DICOM conversion (and cleanup) happens in the session dir
+    # itself, so only rename other files afterwards
+    name = 'rename:other'
+    graph.add(name, _rename_group, args=(name, other_files),
+              deps=['layout'] + (['convert:%s' % op.basename(cdir)]
+                                 if mri_ext == 'DICOM' else []))
+    graph.add_dependency('renamed', name)
+    graph.add('targets', _targets, deps=['renamed'])
+    graph.add('deface-plan', _plan_deface, deps=['renamed'])
+    graph.add('physio', _physio, deps=['renamed'])
+
+    try:
+        graph.run()
+    finally:
+        [shutil.rmtree(d, ignore_errors=True) for d in state['tmp_dirs']]
+
+    _report_missing_elements(cfg, state['matched'])
+
+    for key, (outputs, jsons, scan_info) in state['to_cache'].items():
+        if state['dropped'] & set(outputs):
+            continue  # the cache should have all outputs
+
+        _add_to_cache(cache, key, outputs, jsons, state['finals'], scan_info)
+
+    return list(state['scans'].values())
+
+
+def _add_to_cache(cache, key, outputs, jsons, finals, scan_info):
+    """ Adds the processed outputs of a raw file to the cache, under the
+    names that the conversion gave them. """
+
+    files = dict()
+    for out in outputs:
+        name = op.basename(out)
+        if out in jsons:
+            # Raw sidecar (before metadata was added)
+            files[name] = jsons[out]
+            continue
+
+        final = finals.get(out)
+        if final is None or not op.isfile(final):
+            continue
+
+        if final.endswith('.gz') and not name.endswith('.gz'):
+            name += '.gz'
+        files[name] = final
+
+    cache.put(key, files, info=scan_info)
+
+
+def _write_scans_tsv(session_dir, scans):
+    """ Writes sub-XX[_ses-YY]_scans.tsv (with filename, acq_time, n_volumes,
+    and source columns) to the session dir. """
+
+    parts = op.normpath(session_dir).split(os.sep)
+    name = '_'.join(parts[-2:] if parts[-1].startswith('ses-') else parts[-1:])
+    df = pd.DataFrame(list(scans), columns=['filename', 'acq_time', 'n_volumes',
+                                            'source'])
+    df = df.sort_values('filename').reset_index(drop=True)
+    f_out = op.join(session_dir, name + '_scans.tsv')
+    write_text(f_out, df.to_csv(sep='\t', index=False, na_rep='n/a'))
+    return f_out
+
+
+def _get_acq_time(metadata, acq_date=None):
+    """ Gets the acquisition time (for scans.tsv) from sidecar metadata
+    (AcquisitionDateTime, or AcquisitionTime combined with the date from the
+    raw header); returns 'n/a' if the date or time is unknown. """
+
+    if metadata.get('AcquisitionDateTime'):
+        return metadata['AcquisitionDateTime']
+
+    if metadata.get('AcquisitionTime') and acq_date:
+        return '%sT%s' % (acq_date, metadata['AcquisitionTime'])
+
+    return 'n/a'
 
-    # Reorient2std 
-    if not 'TRAVIS' in os.environ:
-        # only run when not on Travis CI (on which FSL is not installed)
-        all_niis = glob(op.join(this_out_dir, '*', '*.nii.gz'))
-        Parallel(n_jobs=n_cores)(delayed(_reorient_file)(f) for f in all_niis)
-    
-    # Deface the anatomical data
-    if options['deface']:
-        anat_files = glob(op.join(this_out_dir, 'anat', '*.nii.gz'))
-        magn_files = glob(op.join(this_out_dir, 'fmap', '*magnitude*.nii.gz'))
-        to_deface = anat_files + magn_files
-        Parallel(n_jobs=n_cores)(delayed(_deface)(f) for f in to_deface)
-    
-    if 'spinoza_cfg' in op.basename(cfg['orig_cfg_path']):
-        for key in dtype_elements:
-            cfg.pop(key)
 
 def _parse_cfg(cfg_file, raw_data_dir, out_dir):
     """ Parses config file and sets defaults. """
@@ -392,11 +1289,71 @@ def _parse_cfg(cfg_file, raw_data_dir, out_dir):
     if 'debug' not in options:
         cfg['options']['debug'] = False
 
+    if 'compression' not in options:
+        cfg['options']['compression'] = None
+    else:
+        _check_compression(cfg['options']['compression'])
+
     if 'n_cores' not in options:
         cfg['options']['n_cores'] = -1
     else:
         cfg['options']['n_cores'] = int(cfg['options']['n_cores'])
 
+    if 'archive' not in options:
+        cfg['options']['archive'] = None
+
+    if 'archive_dir' not in options:
+        cfg['options']['archive_dir'] = None
+
+    if 'deduplicate' not in options:
+        cfg['options']['deduplicate'] = True
+
+    if 'tool_limits' not in options:
+        cfg['options']['tool_limits'] = dict()
+
+    if 'scratch_dir' not in options:
+        cfg['options']['scratch_dir'] = None
+
+    if 'par_engine' not in options:
+        cfg['options']['par_engine'] = 'dcm2niix'
+    elif cfg['options']['par_engine'] not in ['dcm2niix', 'nibabel']:
+        raise ValueError("The par_engine option should be either 'dcm2niix' or "
+                         "'nibabel', not '%s'!" % cfg['options']['par_engine'])
+
+    if 'on_error' not in options:
+        cfg['options']['on_error'] = 'abort'
+    elif cfg['options']['on_error'] not in ['abort', 'continue']:
+        raise ValueError("The on_error option should be either 'abort' or "
+                         "'continue', not '%s'!" % cfg['options']['on_error'])
+
+    if 'rerun_failed' not in options:
+        cfg['options']['rerun_failed'] = False
+
+    if 'prefetch' not in options:
+        cfg['options']['prefetch'] = None
+
+    for key in ['participant_label', 'session_label', 'datatypes']:
+        if key not in options:
+            cfg['options'][key] = None
+
+    if 'metrics_port' not in options:
+        cfg['options']['metrics_port'] = None
+
+    if 'inherit_metadata' not in options:
+        cfg['options']['inherit_metadata'] = False
+
+    if 'intended_for_nearest' not in options:
+        cfg['options']['intended_for_nearest'] = False
+
+    if 'cache_dir' not in options:
+        cfg['options']['cache_dir'] = None
+
+    if 'cache_size' not in options:
+        cfg['options']['cache_size'] = 20
+
+    if 'events' not in options:
+        cfg['options']['events'] = dict()
+
     if 'subject_stem' not in options:
         cfg['options']['subject_stem'] = 'sub'
 
@@ -425,8 +1382,127 @@ def _parse_cfg(cfg_file, raw_data_dir, out_dir):
     return cfg
 
 
-def _infer_dtype_elements(directory, cfg):
-    """ Method to extract mtype/dtypes from data automatically. """
+def _parse_filters(options):
+    """ Checks the participant_label, session_label, and datatypes options
+    (which may be single values or lists) and converts them to lists. """
+
+    for key, prefix in [('participant_label', 'sub-'), ('session_label', 'ses-'),
+                        ('datatypes', '')]:
+        values = options[key]
+        if values is None:
+            continue
+
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+
+        # Labels may be given with their prefix (e.g. sub-01)
+        values = [str(v) for v in values]
+        options[key] = [v[len(prefix):] if prefix and v.startswith(prefix) else v
+                        for v in values]
+
+    if options['datatypes'] is not None:
+        allowed = DTYPES + sorted(set(m for ms in MTYPE_PER_DTYPE.values() for m in ms))
+        unknown = [d for d in options['datatypes'] if d not in allowed]
+        if unknown:
+            raise ValueError("Unknown datatype(s) %s; choose from %s!" %
+                             (unknown, allowed))
+
+        if options['archive']:
+            raise ValueError("Cannot convert selected datatypes (of sessions "
+                             "converted before) when writing archives!")
+
+
+def _check_compression(compression):
+    """ Checks the compression option: a gzip level (0-9, where 0 means
+    uncompressed) or a dict with levels per dtype, mtype, and/or 'default'. """
+
+    levels = compression if isinstance(compression, dict) else dict(default=compression)
+    allowed = DTYPES + sorted(set(m for ms in MTYPE_PER_DTYPE.values() for m in ms))
+    for key, level in levels.items():
+        if key != 'default' and key not in allowed:
+            raise ValueError("Unknown datatype '%s' in the compression option; "
+                             "choose from %s!" % (key, allowed))
+
+        if level is not None and (isinstance(level, bool) or level not in range(10)):
+            raise ValueError("The compression level of '%s' should be an "
+                             "integer from 0 (uncompressed) to 9, not %r!" % (key, level))
+
+
+def _infer_session_cfg(directory, cfg, renamed=None, cache=None):
+    """ Completes the config of a (Spinoza) session with the elements that
+    are inferred from its files (see `_infer_dtype_elements`).
+
+    If `renamed` (a dict) is given, files that are renamed to fix typos
+    are recorded in it (old path -> new path). If `cache` (a dict) is given,
+    the completed config is cached by the "protocol signature" of the
+    directory (the sorted names of the files that match a mapping, without
+    the subject-label), so sessions with a known protocol get the config of
+    the first session with that protocol (which should not be modified)
+    without inferring the elements and extracting the metadata again.
+    """
+
+    fnames = _fix_typos(directory, cfg, renamed=renamed)
+    ids = [cfg['mappings'][mtype] for dtype in DTYPES
+           for mtype in MTYPE_PER_DTYPE[dtype]]
+    fnames = [f for f in fnames
+              if any(fnmatch.fnmatch(f, '*%s*' % this_id) for this_id in ids)]
+    signature = tuple('_'.join(s for s in f.split('_') if 'sub' not in s)
+                      for f in fnames)
+
+    if cache is not None and signature in cache:
+        return cache[signature]
+
+    session_cfg = deepcopy(cfg)
+    session_cfg.update(_infer_dtype_elements(fnames, cfg))
+
+    # Check which datatypes (dtypes) are available (func, anat, fmap, dwi)
+    session_cfg['data_types'] = [c for c in session_cfg.keys() if c in DTYPES]
+    _extract_metadata_from_cfg(session_cfg)
+
+    if cache is not None:
+        cache[signature] = session_cfg
+
+    return session_cfg
+
+
+def _fix_typos(directory, cfg, renamed=None):
+    """ Fixes known typos in the names of the files in a directory and
+    returns the (sorted) names of all files. """
+
+    if renamed is None:
+        renamed = dict()
+
+    fnames = []
+    for fname in sorted(os.listdir(directory)):
+        f = op.join(directory, fname)
+        for dtype in DTYPES:
+            for mtype in MTYPE_PER_DTYPE[dtype]:
+                this_id = cfg['mappings'][mtype]
+                if not fnmatch.fnmatch(op.basename(f), '*%s*' % this_id):
+                    continue
+
+                # Very stupid hack to undo typo in test-dataset
+                if '-acq' in op.basename(f):
+                    new = op.join(directory, op.basename(f).replace('-acq', '_acq'))
+                    os.rename(f, new)
+                    renamed[f] = new
+                    f = new
+
+                # Another hack
+                if mtype == 'epi' and 'task-' in op.basename(f):
+                    new = op.join(directory, op.basename(f).replace('task', 'dir'))
+                    os.rename(f, new)
+                    renamed[f] = new
+                    f = new
+
+        fnames.append(op.basename(f))
+
+    return sorted(fnames)
+
+
+def _infer_dtype_elements(fnames, cfg):
+    """ Method to extract mtype/dtypes from (the names of) data
+    automatically. """
 
     # Keep track of elements in a dictionary
     dtype_elements = dict()
@@ -437,21 +1513,11 @@ def _infer_dtype_elements(directory, cfg):
         # Per dtype, loop over possible mtypes (modality types)
         for mtype in MTYPE_PER_DTYPE[dtype]:
             this_id = cfg['mappings'][mtype]
-            files_found = glob(op.join(directory, '*%s*' % this_id))
+            files_found = fnmatch.filter(fnames, '*%s*' % this_id)
             counter = 1
             for f in files_found:
 
-                # Very stupid hack to undo typo in test-dataset
-                if '-acq' in f:
-                    os.rename(f, f.replace('-acq', '_acq'))
-                    f = f.replace('-acq', '_acq')
-
-                # Another hack
-                if mtype == 'epi' and 'task-' in f:
-                    os.rename(f, f.replace('task', 'dir'))
-                    f = f.replace('task', 'dir')
-
-                info = op.basename(f).split('.')[0].split('_')
+                info = f.split('.')[0].split('_')
                 info = [s for s in info if 'sub' not in s]
                 info = [s for s in info if len(s.split('-')) > 1]
 
@@ -504,64 +1570,68 @@ def _extract_metadata_from_cfg(cfg):
     return cfg
 
 
-def _rename(cdir, dtype, sub_name, cfg):
-    """ Does the actual work of processing/renaming/conversion. """
+def _rename_file(f, cdir, sub_name, cfg, matched=None):
+    """ Does the actual work of renaming/moving a single file.
 
-    # Define out-Directory
-    dtype_out_dir = op.join(cdir, dtype)  # e.g. sub-01/ses-01/anat
-    data_dir = None
+    Parameters
+    ----------
+    f : str
+        File to rename
+    cdir : str
+        Session (or subject) output directory
+    sub_name : str
+        Subject name (e.g. sub-01)
+    cfg : dict
+        Config dictionary
+    matched : set or None
+        If given, (dtype, element) pairs whose identifier matched this file
+        are added to this set
+
+    Returns
+    -------
+    full_name : str or None
+        New path of file (None if it could not be allocated)
+    """
 
-    # The number of coherent elements for a given data-type (e.g. runs in
-    # bold-fmri, or different T1 acquisitions for anat) ...
     mappings, options = cfg['mappings'], cfg['options']
-    n_elem = len(cfg[dtype])
-
-    if n_elem == 0:
-        # If there are for some reason no elements, raise error
-        raise ValueError("The category '%s' does not have any entries in your "
-                         "config-file!" % dtype)
-
-    # Loop over contents of dtype (e.g. func)
-    for elem in cfg[dtype].keys():
-
-        # Extract "key-value" pairs (info about element)
-        kv_pairs = deepcopy(cfg[dtype][elem])
-
-        # Extract identifier (idf) from element ...
-        idf = copy(kv_pairs['id'])
-        # ... but delete the field, because we'll loop over the rest of the
-        # fields!
-        del kv_pairs['id']
-
-        common_kv_pairs = {sub_name.split('-')[0]: sub_name.split('-')[1]}
-        # Add session-id pair to name if there are sessions!
-        if 'ses-' in op.basename(cdir):
-            sess_id = op.basename(cdir).split('ses-')[-1]
-            common_kv_pairs.update(dict(ses=sess_id))
-
-        # Find files corresponding to func/anat/dwi/fieldmap
-        files = [f for f in glob(op.join(cdir, '*%s*' % idf))
-                 if op.isfile(f)]
-        if not files:
-            print("Could not find files for element %s (dtype %s) with "
-                  "identifier '%s'" % (elem, dtype, idf))
+    fbase = op.basename(f)
+
+    # Try to find (unique) modality type (e.g. bold, dwi)
+    types = []
+    for mtype, match in mappings.items():
+        if match is None:
+            # if there's no mapping given, skip it
             continue
-        else:
-            data_dir = _make_dir(dtype_out_dir)
 
-        for f in files:
-            # Rename files according to mapping
-            these_kv_pairs = deepcopy(common_kv_pairs)
-            types = []
-            for mtype, match in mappings.items():
-                if match is None:
-                    # if there's no mapping given, skip it
-                    continue
+        match = '*%s*' % match
+        if fnmatch.fnmatch(fbase, match):
+            types.append(mtype)
 
-                # Try to find (unique) modality type (e.g. bold, dwi)
-                match = '*%s*' % match
-                if fnmatch.fnmatch(op.basename(f), match):
-                    types.append(mtype)
+    common_kv_pairs = {sub_name.split('-')[0]: sub_name.split('-')[1]}
+    # Add session-id pair to name if there are sessions!
+    if 'ses-' in op.basename(cdir):
+        sess_id = op.basename(cdir).split('ses-')[-1]
+        common_kv_pairs.update(dict(ses=sess_id))
+
+    # Loop over contents of dtypes (e.g. func) to find the (first) element
+    # this file belongs to
+    for dtype in cfg['data_types']:
+        for elem in cfg[dtype].keys():
+
+            # Extract "key-value" pairs (info about element)
+            kv_pairs = deepcopy(cfg[dtype][elem])
+
+            # Extract identifier (idf) from element ...
+            idf = copy(kv_pairs['id'])
+            # ... but delete the field, because we'll loop over the rest of
+            # the fields!
+            del kv_pairs['id']
+
+            if not fnmatch.fnmatch(fbase, '*%s*' % idf):
+                continue
+
+            if matched is not None:
+                matched.add((dtype, elem))
 
             if len(types) > 1:
                 msg = ("Couldn't determine modality-type for file '%s' (i.e. "
@@ -570,80 +1640,132 @@ def _rename(cdir, dtype, sub_name, cfg):
                 raise ValueError(msg)
             elif len(types) == 0:
                 # No file found; ends up in unallocated (printed later).
-                continue
+                return None
             else:
                 mtype = types[0]
 
-            # Check if keys in config are allowed
-            allowed_keys = list(MTYPE_ORDERS[mtype].keys())
-            for key, value in kv_pairs.items():
-                # Append key-value pair if in allowed keys
-                if key in allowed_keys:
-                    these_kv_pairs.update({key: value})
-                else:
-                    print("Key '%s' in element '%s' (dtype %s) is not an "
-                          "allowed key! Choose from %r" %
-                          (key, elem, dtype, allowed_keys))
-
-            # Check if there are any keys in filename already
-            these_keys = these_kv_pairs.keys()
-            for key_value in op.basename(f).split('_'):
-                key_value = key_value.split('.')[0]  # remove extensions
-                if len(key_value.split('-')) == 2:
-                    key, value = key_value.split('-')
-                    # If allowed (part of BIDS-spec) and not already added ...
-                    if key in allowed_keys and key not in these_keys:
-                        these_kv_pairs.update({key: value})
-
-            # Small hack to fix topups ('task' is not allowed; 'dir' is)
-            if 'task' in these_kv_pairs.keys() and mtype == 'epi':
-                these_kv_pairs['dir'] = these_kv_pairs.pop('task')
-
-            if mtype == 'physio' and '.edf' in f:  # eyedata
-                these_kv_pairs['recording'] = 'eyetracker'
-            elif mtype == 'physio' and not '.edf' in f:  # ppu/resp
-                these_kv_pairs['recording'] = 'respcardiac'
-
-            # Sort kv-pairs using MTYPE_ORDERS
-            this_order = MTYPE_ORDERS[mtype]
-            ordered = sorted(zip(these_kv_pairs.keys(),
-                                 these_kv_pairs.values()),
-                             key=lambda x: this_order[x[0]])
-
-            # Convert all values to strings
-            ordered = [[str(s[0]), str(s[1])] for s in ordered]
-            kv_string = '_'.join(['-'.join(s) for s in ordered])
-
-            # Create full name as common_name + unique filetype + original ext
-            exts = op.basename(f).split('.')[1:]
-            clean_exts = '.'.join([e for e in exts if e in ALLOWED_EXTS])
-            full_name = kv_string + '_%s.%s' % (mtype, clean_exts)
-            full_name = op.join(data_dir, full_name)
-            if mtype == 'bold':
-                if 'task-' not in op.basename(full_name):
-                    msg = ("Could not assign task-name to file %s; please "
-                           "put this in the config-file under data-type 'func'"
-                           "and element '%s'" % (f, elem))
-                    raise ValueError(msg)
+            full_name = _get_bids_name(f, dtype, elem, mtype, kv_pairs,
+                                       common_kv_pairs)
+            full_name = op.join(cdir, dtype, full_name)
 
             if options['debug']:
                 print("Renaming '%s' to '%s'" % (f, full_name))
 
             if not op.isfile(full_name):
                 # only do it if it isn't already done
+                _make_dir(op.dirname(full_name))
                 shutil.move(f, full_name)
+                move_digest(f, full_name)
+                return full_name
+
+    return None
+
+
+def _get_bids_name(f, dtype, elem, mtype, kv_pairs, common_kv_pairs):
+    """ Creates the BIDS filename for a file belonging to a specific
+    element (e.g. 'restingstate') and modality type (e.g. 'bold'). """
+
+    these_kv_pairs = deepcopy(common_kv_pairs)
+
+    # Check if keys in config are allowed
+    allowed_keys = list(MTYPE_ORDERS[mtype].keys())
+    for key, value in kv_pairs.items():
+        # Append key-value pair if in allowed keys
+        if key in allowed_keys:
+            these_kv_pairs.update({key: value})
+        else:
+            print("Key '%s' in element '%s' (dtype %s) is not an "
+                  "allowed key! Choose from %r" %
+                  (key, elem, dtype, allowed_keys))
+
+    # Check if there are any keys in filename already
+    these_keys = these_kv_pairs.keys()
+    for key_value in op.basename(f).split('_'):
+        key_value = key_value.split('.')[0]  # remove extensions
+        if len(key_value.split('-')) == 2:
+            key, value = key_value.split('-')
+            # If allowed (part of BIDS-spec) and not already added ...
+            if key in allowed_keys and key not in these_keys:
+                these_kv_pairs.update({key: value})
+
+    # Small hack to fix topups ('task' is not allowed; 'dir' is)
+    if 'task' in these_kv_pairs.keys() and mtype == 'epi':
+        these_kv_pairs['dir'] = these_kv_pairs.pop('task')
+
+    if mtype == 'physio' and '.edf' in f:  # eyedata
+        these_kv_pairs['recording'] = 'eyetracker'
+    elif mtype == 'physio' and not '.edf' in f:  # ppu/resp
+        these_kv_pairs['recording'] = 'respcardiac'
+
+    # Sort kv-pairs using MTYPE_ORDERS
+    this_order = MTYPE_ORDERS[mtype]
+    ordered = sorted(zip(these_kv_pairs.keys(),
+                         these_kv_pairs.values()),
+                     key=lambda x: this_order[x[0]])
+
+    # Convert all values to strings
+    ordered = [[str(s[0]), str(s[1])] for s in ordered]
+    kv_string = '_'.join(['-'.join(s) for s in ordered])
+
+    # Create full name as common_name + unique filetype + original ext
+    exts = op.basename(f).split('.')[1:]
+    clean_exts = '.'.join([e for e in exts if e in ALLOWED_EXTS])
+    full_name = kv_string + '_%s.%s' % (mtype, clean_exts)
+    if mtype == 'bold':
+        if 'task-' not in full_name:
+            msg = ("Could not assign task-name to file %s; please "
+                   "put this in the config-file under data-type 'func'"
+                   "and element '%s'" % (f, elem))
+            raise ValueError(msg)
 
-    return data_dir
+    return full_name
 
 
-def _add_missing_BIDS_metadata_and_save_to_disk(data_dir, cfg):
+def _report_missing_elements(cfg, matched):
+    """ Prints elements from the config that did not match any file. """
+
+    for dtype in cfg['data_types']:
+        for elem in cfg[dtype].keys():
+            if (dtype, elem) not in matched:
+                print("Could not find files for element %s (dtype %s) with "
+                      "identifier '%s'" % (elem, dtype, cfg[dtype][elem]['id']))
+
+
+def _add_metadata_to_json(this_json, cfg, inherited=None, targets=None):
+    """ Adds missing BIDS metadata to a single sidecar json and saves it.
+
+    Parameters
+    ----------
+    this_json : str
+        Path to (renamed) json file
+    cfg : dict
+        Config dictionary
+    inherited : InheritedMetadata or None
+        If given, metadata from the config that the file shares with the
+        dataset-level sidecar that applies to it (e.g. task-rest_bold.json)
+        is not written to its own sidecar, following the BIDS inheritance
+        principle
+    targets : FieldmapTargets or None
+        Images of the session, to determine the IntendedFor field of
+        fieldmaps (if None, it is not added)
+
+    Returns
+    -------
+    metadata : dict or None
+        All (inherited and own) metadata of the file
+    """
 
     # Get metadata dict
-    metadata, mappings = cfg['metadata'], cfg['mappings']
+    metadata = cfg['metadata']
     if 'spinoza_metadata' in cfg.keys():
         spi_md = cfg['spinoza_metadata']
 
+    data_dir = op.dirname(this_json)
     dtype = op.basename(data_dir)
+    fbase = op.basename(this_json)
+    mtype = fbase.split('_')[-1].split('.')[0]
+    if mtype not in cfg['mappings'].keys():
+        return None
 
     # Start with common metadata ("toplevel")
     common_metadata = {key: value for key, value in metadata.items()
@@ -653,143 +1775,210 @@ def _add_missing_BIDS_metadata_and_save_to_disk(data_dir, cfg):
     if metadata.get(dtype, None) is not None:
         common_metadata.update(metadata.get(dtype))
 
-    # Used later for the IntendedFor field
-    if 'ses-' in op.basename(op.dirname(data_dir)):
-        ses2append = op.basename(op.dirname(data_dir))
+    if dtype == 'fmap' and mtype == 'phasediff' and targets is not None:
+        # Assuming a single phasediff file for all bold-files
+        common_metadata['IntendedFor'] = targets.match(fbase)
+
+    if 'acq' in fbase:
+        acqtype = fbase.split('acq-')[-1].split('_')[0]
     else:
-        ses2append = ''
+        acqtype = None
 
-    # Now loop over ftypes ('filetypes', e.g. bold, physio, etc.)
-    for mtype in mappings.keys():
+    # this_metadata refers to metadata meant for current json
+    current_metadata = copy(common_metadata)
+    if 'spinoza_metadata' in cfg.keys():
+        # Append spinoza metadata to current json according to dtype
+        # (anat, func, etc.) and mtype (phasediff, bold, etc.)
+        if spi_md.get(dtype, None) is not None:
+            tmp_metadata = spi_md.get(dtype)
+            if tmp_metadata.get(mtype, None) is not None:
+                tmp_metadata = tmp_metadata.get(mtype)
+                if tmp_metadata.get(acqtype, None) is not None:
+                    tmp_metadata = tmp_metadata.get(acqtype)
+                else:
+                    msg = ("Trying to append metadata from dtype=%s, mtype=%s, "
+                           "acq=%s, but %s does not exist in spinoza_metadata.yml!" %
+                            (dtype, mtype, acqtype, acqtype))
+                    raise ValueError(msg)
+            else:
+                # if there is no metadata, just append an empty dict
+                tmp_metadata = dict()
+            current_metadata.update(tmp_metadata)
+
+    if mtype == 'epi' and targets is not None:
+        # The acquisition time of the epi itself (from dcm2niix) is used to
+        # pick the nearest image (if enabled)
+        with open(this_json, 'r') as metadata_file:
+            acq_time = json.load(metadata_file).get('AcquisitionTime')
+
+        int_for = targets.match(fbase, acq_time=acq_time)
+        if int_for:
+            current_metadata['IntendedFor'] = int_for[0]
+        else:
+            warnings.warn("Could not find image corresponding to topup (%s)!" % this_json)
+            current_metadata['IntendedFor'] = 'Could not find corresponding file; add this yourself!'
 
-        if dtype == 'fmap' and mtype == 'phasediff':
-            # Find 'bold' files, needed for IntendedFor field of fmaps,
-            # assuming a single phasediff file for all bold-files
-            func_files = glob(op.join(op.dirname(data_dir),
-                                      'func', '*_bold.nii.gz'))
+    if mtype == 'bold':
+        task_name = fbase.split('task-')[1].split('_')[0]
+        current_metadata.update({'TaskName': task_name})
 
-            common_metadata['IntendedFor'] = [op.join(ses2append, 'func', op.basename(f))
-                                              for f in func_files]
+        # Slicetiming info. Note: we assume ascending order!
+        with open(this_json, 'r') as to_read:
+            this_json_opened = json.load(to_read)
 
-        # Find relevant jsons
-        jsons = glob(op.join(data_dir, '*_%s.json' % mtype))
+        if 'SliceEncodingDirection' in this_json_opened.keys():
+            sed = this_json_opened['SliceEncodingDirection']
+        else:
+            sed = 'none'
+        
+        if 'SliceEncodingDirection' in current_metadata.keys():
+            sed = current_metadata['SliceEncodingDirection']
+        else:
+            sed = 'none'
+        
+        if 'spinoza_metadata' in cfg.keys():
+            this_tr = this_json_opened['RepetitionTime']
+            corresp_func = _find_nifti(this_json)
+            nr_slices = nib.load(corresp_func).header.get_data_shape()[2]
+            if 'MultibandAccelerationFactor' in this_json_opened.keys():
+                mb_factor = int(this_json_opened['MultibandAccelerationFactor'])
+            else:
+                mb_factor = 0
+            
+            if 'MultibandAccelerationFactor' in current_metadata.keys():
+                mb_factor = int(current_metadata['MultibandAccelerationFactor'])
+            else:
+                mb_factor = 0
 
-        for this_json in jsons:
-            # Loop over jsons
-            fbase = op.basename(this_json)
-            if 'acq' in fbase:
-                acqtype = fbase.split('acq-')[-1].split('_')[0]
+            if mb_factor > 0:
+                slice_timing = np.tile(np.linspace(0, this_tr, int(nr_slices/mb_factor)+1)[:-1], mb_factor)
             else:
-                acqtype = None
-
-            # this_metadata refers to metadata meant for current json
-            current_metadata = copy(common_metadata)
-            if 'spinoza_metadata' in cfg.keys():
-                # Append spinoza metadata to current json according to dtype
-                # (anat, func, etc.) and mtype (phasediff, bold, etc.)
-                if spi_md.get(dtype, None) is not None:
-                    tmp_metadata = spi_md.get(dtype)
-                    if tmp_metadata.get(mtype, None) is not None:
-                        tmp_metadata = tmp_metadata.get(mtype)
-                        if tmp_metadata.get(acqtype, None) is not None:
-                            tmp_metadata = tmp_metadata.get(acqtype)
-                        else:
-                            msg = ("Trying to append metadata from dtype=%s, mtype=%s, "
-                                   "acq=%s, but %s does not exist in spinoza_metadata.yml!" %
-                                    (dtype, mtype, acqtype, acqtype))
-                            raise ValueError(msg)
-                    else:
-                        # if there is no metadata, just append an empty dict
-                        tmp_metadata = dict()
-                    current_metadata.update(tmp_metadata)
+                slice_timing = np.linspace(0, this_tr, nr_slices+1)[:-1]
 
-            if mtype == 'epi':
+            slice_timing = slice_timing.tolist()
+            current_metadata.update({'SliceTiming': slice_timing})
 
-                pardir = op.dirname(op.dirname(this_json))
-                acq_idf = fbase.split('acq-')[1].split('_')[0]
+    if inherited is None:
+        return _append_to_json(this_json, current_metadata)
 
-                # Stupid hack, but it works
-                if 'Dirs' in acq_idf:
-                    cdwi = glob(op.join(pardir, 'dwi', '*%s*_dwi.nii.gz' % acq_idf))
+    with open(this_json, 'r') as to_read:
+        own_metadata = json.load(to_read)
 
-                    if not cdwi:
-                        warnings.warn("Could not find DWI-file corresponding to topup (%s)!" % this_json)
-                        int_for = 'Could not find corresponding file; add this yourself!'
-                    else:
-                        cdwi = op.basename(cdwi[0])
-                        int_for = op.join(ses2append, 'dwi', cdwi)
-                else:  # assume bold
-                    dir_idf = fbase.split('dir-')[1].split('_')[0]
-                    run_idf = fbase.split('run-')
-                    if len(run_idf) > 1:
-                        run_idf = run_idf[1].split('_')[0]
-                        cbold = glob(op.join(pardir, 'func', '*task-%s*acq-%s*_run-%s*_bold.nii.gz' % (dir_idf, acq_idf, run_idf)))
-                    else:
-                        cbold = glob(op.join(pardir, 'func', '*task-%s*acq-%s*_bold.nii.gz' % (dir_idf, acq_idf)))
-                    if not cbold:
-                        warnings.warn("Cound not find bold-file corresponding to topup (%s)!" % this_json)
-                        int_for = 'Could not find corresponding file; add this yourself!'
-                    elif len(cbold) > 1:
-                        warnings.warn("Found multiple bold-files (%s) corresponding to topup (%s)!" % (cbold, this_json))
-
-                    cbold = op.basename(cbold[0])
-                    int_for = op.join(ses2append, 'func', cbold)
-                current_metadata['IntendedFor'] = int_for
-
-            if mtype == 'bold':
-                task_name = fbase.split('task-')[1].split('_')[0]
-                current_metadata.update({'TaskName': task_name})
-
-                # Slicetiming info. Note: we assume ascending order!
-                with open(this_json, 'r') as to_read:
-                    this_json_opened = json.load(to_read)
-
-                if 'SliceEncodingDirection' in this_json_opened.keys():
-                    sed = this_json_opened['SliceEncodingDirection']
-                else:
-                    sed = 'none'
-                
-                if 'SliceEncodingDirection' in current_metadata.keys():
-                    sed = current_metadata['SliceEncodingDirection']
-                else:
-                    sed = 'none'
-                
-                if 'spinoza_metadata' in cfg.keys():
-                    this_tr = this_json_opened['RepetitionTime']
-                    corresp_func = this_json.replace('.json', '.nii.gz')
-                    nr_slices = nib.load(corresp_func).header.get_data_shape()[2]
-                    if 'MultibandAccelerationFactor' in this_json_opened.keys():
-                        mb_factor = int(this_json_opened['MultibandAccelerationFactor'])
-                    else:
-                        mb_factor = 0
-                    
-                    if 'MultibandAccelerationFactor' in current_metadata.keys():
-                        mb_factor = int(current_metadata['MultibandAccelerationFactor'])
-                    else:
-                        mb_factor = 0
+    # Fields that differ from the file's own (e.g. dcm2niix) fields should
+    # override them, so they stay in the file itself
+    shared = dict((key, value) for key, value in current_metadata.items()
+                  if key not in FILE_SPECIFIC_METADATA
+                  and own_metadata.get(key, value) == value)
+    shared = inherited.share(fbase, shared, own=own_metadata)
+    specific = dict((key, value) for key, value in current_metadata.items()
+                    if key not in shared)
 
-                    if mb_factor > 0:
-                        slice_timing = np.tile(np.linspace(0, this_tr, int(nr_slices/mb_factor)+1)[:-1], mb_factor)
-                    else:
-                        slice_timing = np.linspace(0, this_tr, nr_slices+1)[:-1]
+    if specific:
+        own_metadata = _append_to_json(this_json, specific)
+
+    return dict(shared, **own_metadata)
 
-                    slice_timing = slice_timing.tolist()
-                    current_metadata.update({'SliceTiming': slice_timing})
-            
-            _append_to_json(this_json, current_metadata)
+
+def _write_inherited_metadata(out_dir, inherited):
+    """ Writes the dataset-level sidecars (see InheritedMetadata). """
+
+    files = []
+    for name, metadata in inherited.items():
+        f = op.join(out_dir, name)
+        write_text(f, json.dumps(metadata, indent=4))
+        files.append(f)
+
+    return files
 
 
 def _reorient_file(f):
-    """ Reorient MRI file """ 
-    _run_cmd(['fslreorient2std', f, f])
+    """ Reorient MRI file """
+    # Make sure FSL keeps the (un)compressed extension
+    out_type = 'NIFTI_GZ' if f.endswith('.gz') else 'NIFTI'
+
+    # Write to a temporary file (instead of in place), so that the input is
+    # intact if fslreorient2std is killed and retried
+    tmp_out = op.join(op.dirname(f), '.reoriented_' + op.basename(f))
+    rs = _run_cmd(['fslreorient2std', f, tmp_out], env=dict(FSLOUTPUTTYPE=out_type))
+    if rs != 0:
+        # Never replace the image by a partial output
+        if op.isfile(tmp_out):
+            os.remove(tmp_out)
+        raise ValueError("fslreorient2std could not reorient %s (return code "
+                         "%i)!" % (f, rs))
+    os.rename(tmp_out, f)
+    forget_digest(f)
+
+
+def _is_nifti(f):
+    return f.endswith('.nii') or f.endswith('.nii.gz')
+
+
+def _strip_nii_ext(f):
+    """ Removes .nii or .nii.gz extension. """
+    return f[:-7] if f.endswith('.nii.gz') else op.splitext(f)[0]
+
+
+def _get_compression(f, options):
+    """ Gzip level of a (renamed) nifti according to the compression option:
+    the level of its mtype, dtype, or the default (in that order). Returns 0
+    for an uncompressed nifti and None for the default level of pigz/gzip. """
+
+    if options['debug']:
+        return 0
+
+    compression = options['compression']
+    if not isinstance(compression, dict):
+        return compression
+
+    dtype = op.basename(op.dirname(f))
+    mtype = _strip_nii_ext(op.basename(f)).split('_')[-1]
+    for key in [mtype, dtype, 'default']:
+        if key in compression:
+            return compression[key]
+
+    return None
+
+
+def _get_final_name(f, level):
+    """ Final name of a file, given the gzip level of niftis (see
+    _get_compression). """
+
+    if not _is_nifti(f):
+        return f
+
+    return _strip_nii_ext(f) + ('.nii' if level == 0 else '.nii.gz')
+
+
+def _find_nifti(this_json):
+    """ Finds the nifti file (compressed or not) belonging to a json. """
+    base = op.splitext(this_json)[0]
+    for ext in ['.nii', '.nii.gz']:
+        if op.isfile(base + ext):
+            return base + ext
+
+    return base + '.nii.gz'
+
+
+def _is_events_log(f):
+    """ Checks whether a (renamed) file is a stimulus log that should be
+    converted to an events-file. """
+    stem, _, ext = op.basename(f).partition('.')
+    if not stem.endswith('_events') or '.' + ext not in LOG_EXTS:
+        return False
+
+    if ext == 'tsv':  # only if not a BIDS events-file already
+        with open(f, errors='replace') as f_in:
+            header = f_in.readline().rstrip('\n').split('\t')
+        return header[:2] != ['onset', 'duration']
 
+    return True
 
-def _deface(f):
-    """ Deface anat data. """
 
-    _run_cmd(['pydeface', f])  # Run pydeface
-    if op.isfile(f.replace('.nii.gz', '_defaced.nii.gz')):
-        os.rename(f.replace('.nii.gz', '_defaced.nii.gz'), f)  # Revert to old name
+def _is_deface_target(f):
+    """ Whether a (renamed) file should be defaced (anat or magnitude). """
+    dtype = op.basename(op.dirname(f))
+    return dtype == 'anat' or (dtype == 'fmap' and 'magnitude' in op.basename(f))
 
 
 def _extract_sub_nr(sub_stem, sub_name):
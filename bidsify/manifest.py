@@ -0,0 +1,222 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import hashlib
+import threading
+from contextlib import contextmanager
+from glob import glob
+
+MANIFEST_FILE = '.bidsify_manifest.sha256'
+CHUNK_SIZE = 2 ** 20
+
+# Digests of files that were hashed while being written (abspath -> digest)
+_DIGESTS = dict()
+_DIGESTS_LOCK = threading.Lock()
+
+
+class HashingWriter(object):
+    """ Wraps a (binary) file object and hashes all data written to it. """
+
+    def __init__(self, f_out):
+        self._f_out = f_out
+        self._hash = hashlib.sha256()
+        self.name = getattr(f_out, 'name', '')
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._f_out.write(data)
+
+    def flush(self):
+        self._f_out.flush()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+@contextmanager
+def open_hashed(path):
+    """ Opens a file for (binary) writing and records the digest of the
+    written data when it is closed. """
+    with open(path, 'wb') as f_out:
+        writer = HashingWriter(f_out)
+        yield writer
+
+    record_digest(path, writer.hexdigest())
+
+
+def write_text(path, text):
+    """ Writes text to a file and records its digest. """
+    with open_hashed(path) as f_out:
+        f_out.write(text.encode())
+
+
+def copy_hashed(src, dst):
+    """ Copies a file and records the digest of the copy. """
+    with open(src, 'rb') as f_in, open_hashed(dst) as f_out:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+            f_out.write(chunk)
+
+
+def record_digest(path, digest):
+    with _DIGESTS_LOCK:
+        _DIGESTS[op.abspath(path)] = digest
+
+
+def move_digest(src, dst):
+    """ Moves the recorded digest (if any) of a file that was moved or
+    renamed to its new path. """
+    with _DIGESTS_LOCK:
+        digest = _DIGESTS.pop(op.abspath(src), None)
+        if digest is not None:
+            _DIGESTS[op.abspath(dst)] = digest
+
+
+def forget_digest(path):
+    """ Drops the recorded digest (if any) of a file that is rewritten by
+    a tool that does not hash its output (e.g. when reorienting), so that
+    it is hashed from disk instead. """
+    with _DIGESTS_LOCK:
+        _DIGESTS.pop(op.abspath(path), None)
+
+
+def forget_digests(directory):
+    """ Drops the recorded digests of all files in a directory, e.g. of
+    files that were removed or moved elsewhere once the manifest of a
+    session has been written (or the session failed). """
+    prefix = op.join(op.abspath(directory), '')
+    with _DIGESTS_LOCK:
+        for path in [p for p in _DIGESTS if p.startswith(prefix)]:
+            del _DIGESTS[path]
+
+
+def hash_file(path):
+    """ Hashes a file from disk. """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_digests(files):
+    """ Returns the digests of files (removing them from the record); files
+    that were not hashed while being written (e.g., written by external
+    tools) are hashed from disk, right after they were written. """
+    digests = dict()
+    with _DIGESTS_LOCK:
+        for f in files:
+            digests[f] = _DIGESTS.pop(op.abspath(f), None)
+
+    for f, digest in digests.items():
+        if digest is None:
+            digests[f] = hash_file(f)
+
+    return digests
+
+
+def write_session_manifest(session_dir, root):
+    """ Writes the manifest of a session (``.bidsify_manifest.sha256`` in
+    the session dir, with paths relative to the dataset root, so it can be
+    checked with ``sha256sum -c`` from the root).
+
+    Parameters
+    ----------
+    session_dir : str
+        Directory of the session (or subject without sessions)
+    root : str
+        Root of the dataset
+
+    Returns
+    -------
+    manifest : str
+        Path to the manifest
+    """
+    files = []
+    for dirpath, _, fnames in os.walk(session_dir):
+        files.extend(op.join(dirpath, f) for f in fnames if not f.startswith('.'))
+
+    digests = get_digests(files)
+    lines = sorted('%s  %s' % (digest, op.relpath(f, root).replace(os.sep, '/'))
+                   for f, digest in digests.items())
+    manifest = op.join(session_dir, MANIFEST_FILE)
+    with open(manifest, 'w') as f_out:
+        f_out.write(''.join(line + '\n' for line in lines))
+
+    return manifest
+
+
+def update_session_manifest(session_dir, root, digests, removed=()):
+    """ Updates the manifest of a session of which some files were replaced
+    (e.g., when re-converting only some datatypes).
+
+    Parameters
+    ----------
+    session_dir : str
+        Directory of the session (or subject without sessions)
+    root : str
+        Root of the dataset
+    digests : dict
+        Digests of new (or replaced) files of the session (path -> digest)
+    removed : list
+        Files that were removed from the session
+
+    Returns
+    -------
+    manifest : str
+        Path to the manifest
+    """
+    def _rel(f):
+        return op.relpath(f, root).replace(os.sep, '/')
+
+    manifest = op.join(session_dir, MANIFEST_FILE)
+    entries = dict()
+    if op.isfile(manifest):
+        with open(manifest) as f_in:
+            for line in f_in:
+                if line.strip():
+                    digest, path = line.rstrip('\n').split('  ', 1)
+                    entries[path] = digest
+
+    for f in removed:
+        entries.pop(_rel(f), None)
+
+    entries.update((_rel(f), digest) for f, digest in digests.items())
+    lines = sorted('%s  %s' % (digest, path) for path, digest in entries.items())
+    with open(manifest, 'w') as f_out:
+        f_out.write(''.join(line + '\n' for line in lines))
+
+    return manifest
+
+
+def write_dataset_manifest(root, toplevel=()):
+    """ Merges the manifests of all sessions and the digests of the
+    dataset-level files into a manifest in the dataset root.
+
+    Parameters
+    ----------
+    root : str
+        Root of the dataset
+    toplevel : list
+        Dataset-level files (e.g. participants.tsv)
+
+    Returns
+    -------
+    manifest : str
+        Path to the manifest
+    """
+    lines = []
+    for pattern in [('sub-*',), ('sub-*', 'ses-*')]:
+        for f in glob(op.join(root, *(pattern + (MANIFEST_FILE,)))):
+            with open(f) as f_in:
+                lines.extend(line.rstrip('\n') for line in f_in if line.strip())
+
+    toplevel = [f for f in toplevel if op.isfile(f)]
+    for f, digest in get_digests(toplevel).items():
+        lines.append('%s  %s' % (digest, op.relpath(f, root).replace(os.sep, '/')))
+
+    manifest = op.join(root, MANIFEST_FILE)
+    with open(manifest, 'w') as f_out:
+        f_out.write(''.join(line + '\n' for line in sorted(set(lines),
+                                                           key=lambda l: l[66:])))
+
+    return manifest
@@ -0,0 +1,186 @@
+from __future__ import print_function, division
+import os
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from .scheduler import get_scheduler
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:  # Python < 3.7
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+# Upper bounds (in seconds) of the buckets of the stage latency histograms
+STAGE_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900]
+
+# Sessions that were converted before (skipped) or had no files to convert
+# (empty) are not done, as they do not contribute to the converted bytes
+SESSION_STATES = ['queued', 'running', 'done', 'skipped', 'empty', 'failed']
+
+_METRICS = None
+_SERVERS = dict()
+_LOCK = threading.Lock()
+
+
+def get_metrics():
+    """ Returns the (process-wide) metrics of bidsify. """
+    global _METRICS
+    with _LOCK:
+        if _METRICS is None:
+            _METRICS = Metrics()
+        return _METRICS
+
+
+class Metrics(object):
+    """ Counters and histograms of the progress of conversions, which can
+    be rendered in the Prometheus text format. """
+
+    def __init__(self):
+        self.sessions = dict((state, 0) for state in SESSION_STATES)
+        self.bytes_converted = 0
+        self._stages = dict()  # stage -> (bucket counts, sum, count)
+        self._lock = threading.Lock()
+
+    def session_queued(self, n=1):
+        with self._lock:
+            self.sessions['queued'] += n
+
+    def session_started(self):
+        with self._lock:
+            self.sessions['queued'] = max(self.sessions['queued'] - 1, 0)
+            self.sessions['running'] += 1
+
+    def session_finished(self, state='done', n_bytes=0):
+        """ Moves a running session to a final state (done, skipped, empty,
+        or failed). """
+        with self._lock:
+            self.sessions['running'] -= 1
+            self.sessions[state] += 1
+            self.bytes_converted += n_bytes
+
+    def observe_stage(self, stage, seconds):
+        """ Adds the duration of a pipeline stage (e.g. convert). """
+        with self._lock:
+            counts, total, n = self._stages.get(stage, ([0] * (len(STAGE_BUCKETS) + 1), 0., 0))
+            counts[bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+            self._stages[stage] = (counts, total + seconds, n + 1)
+
+    def render(self):
+        """ Renders all metrics in the Prometheus text format. """
+        with self._lock:
+            sessions = dict(self.sessions)
+            n_bytes = self.bytes_converted
+            stages = dict((stage, (list(c), t, n))
+                          for stage, (c, t, n) in self._stages.items())
+
+        lines = ['# HELP bidsify_sessions Number of sessions per state.',
+                 '# TYPE bidsify_sessions gauge']
+        lines.extend('bidsify_sessions{state="%s"} %i' % (state, sessions[state])
+                     for state in SESSION_STATES)
+
+        lines.extend(['# HELP bidsify_converted_bytes_total Size of the converted output files.',
+                      '# TYPE bidsify_converted_bytes_total counter',
+                      'bidsify_converted_bytes_total %i' % n_bytes])
+
+        lines.extend(['# HELP bidsify_stage_seconds Duration of pipeline stages.',
+                      '# TYPE bidsify_stage_seconds histogram'])
+        for stage, (counts, total, n) in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(STAGE_BUCKETS + ['+Inf'], counts):
+                cumulative += count
+                lines.append('bidsify_stage_seconds_bucket{stage="%s",le="%s"} %i' %
+                             (stage, bound, cumulative))
+            lines.append('bidsify_stage_seconds_sum{stage="%s"} %.6f' % (stage, total))
+            lines.append('bidsify_stage_seconds_count{stage="%s"} %i' % (stage, n))
+
+        slots = get_scheduler().slot_usage()
+        lines.extend(['# HELP bidsify_cpus CPUs in use by external tools and the CPU budget.',
+                      '# TYPE bidsify_cpus gauge',
+                      'bidsify_cpus{kind="in_use"} %i' % slots['cpus_in_use'],
+                      'bidsify_cpus{kind="budget"} %i' % slots['n_cores'],
+                      '# HELP bidsify_tool_processes Running processes per external tool.',
+                      '# TYPE bidsify_tool_processes gauge'])
+        lines.extend('bidsify_tool_processes{tool="%s"} %i' % (tool, info['in_use'])
+                     for tool, info in sorted(slots['tools'].items()))
+        lines.extend(['# HELP bidsify_tool_slots Max. concurrent processes per external tool.',
+                      '# TYPE bidsify_tool_slots gauge'])
+        lines.extend('bidsify_tool_slots{tool="%s"} %i' % (tool, info['slots'])
+                     for tool, info in sorted(slots['tools'].items())
+                     if info['slots'] is not None)
+
+        lines.extend(['# HELP bidsify_memory_bytes Memory of the bidsify process.',
+                      '# TYPE bidsify_memory_bytes gauge'])
+        rss = _current_rss()
+        if rss is not None:
+            lines.append('bidsify_memory_bytes{kind="rss"} %i' % rss)
+        if resource is not None:
+            # ru_maxrss is in kB (on Linux)
+            lines.append('bidsify_memory_bytes{kind="max_rss"} %i' %
+                         (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """ Starts (once per port) an HTTP server in a background thread that
+    serves the metrics at /metrics.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on (0 picks a free port)
+    host : str
+        Address to listen on (default: localhost only)
+
+    Returns
+    -------
+    server : ThreadingHTTPServer
+        The server (server.server_address gives the actual port)
+    """
+    with _LOCK:
+        if port in _SERVERS:
+            return _SERVERS[port]
+
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='bidsify-metrics', daemon=True)
+        thread.start()
+        _SERVERS[port] = server
+
+    return server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = get_metrics().render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # don't clutter the output of bidsify
+
+
+def _current_rss():
+    """ Current resident set size (Linux only). """
+    try:
+        with open('/proc/self/statm') as f_in:
+            return int(f_in.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None  # os.sysconf does not exist on Windows
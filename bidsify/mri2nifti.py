@@ -1,81 +1,204 @@
 from __future__ import print_function, division
 import os
 import warnings
+import subprocess
 import os.path as op
 from glob import glob
-from .utils import check_executable, _compress, _run_cmd
+from functools import lru_cache
+from .utils import check_executable, _make_dir, _run_cmd
+from .dedup import _get_data_file
+from .par2nifti import convert_par
 from shutil import rmtree
 
 PIGZ = check_executable('pigz')
 
 
-def convert_mri(directory, cfg):
+def find_mri_files(directory, cfg):
+    """ Finds the raw MRI "units" that need to be converted separately,
+    i.e., PAR/dcm files or (for enhanced DICOM) the directory itself. """
 
-    compress = not cfg['options']['debug']
     mri_ext = cfg['options']['mri_ext']
-
-    base_cmd = "dcm2niix -ba y"
-    if compress:
-        base_cmd += " -z y" if PIGZ else " -z i"
+    if mri_ext in ['PAR', 'dcm']:
+        return sorted(glob(op.join(directory, '*.%s' % mri_ext)))
+    elif mri_ext == 'DICOM':
+        return [directory]
+    elif mri_ext == 'nifti':
+        return []
     else:
-        base_cmd += " -z n"
+        raise ValueError('Please select either PAR, dcm, DICOM or nifti for mri_ext!')
 
-    if mri_ext in ['PAR', 'dcm']:
-        mri_files = glob(op.join(directory, '*.%s' % mri_ext))
-        for f in mri_files:
 
-            if '.PAR' in f:
-                info = _get_extra_info_from_par_header(f)
+def convert_mri_file(f, cfg, compress=True, scan_info=None):
+    """ Converts a single PAR/dcm file (or a directory with enhanced DICOM
+    files) to nifti.
+
+    Parameters
+    ----------
+    f : str
+        Path to PAR/dcm file or directory with DICOM files
+    cfg : dict
+        Config dictionary
+    compress : bool
+        Whether dcm2niix should compress the output
+    scan_info : dict or None
+        If given, it is updated with what is known about the scan from the
+        raw header (acq_date for PAR files, and n_volumes with the nibabel
+        par_engine)
+
+    Returns
+    -------
+    outputs : list
+        List with paths to the converted files (nifti, json, bval, bvec)
+    """
 
-            basename, ext = op.splitext(op.basename(f))
-            if info['n_echoes'] > 1:
-                basename += '_echo-%e'
+    if op.isdir(f):
+        return _convert_dicom_dir(f, cfg, compress)
 
-            par_cmd = base_cmd + " -f %s %s" % (basename, f)
-            # if debug, print dcm2niix output
-            _run_cmd(par_cmd.split(' '), verbose=cfg['options']['debug'])
-            os.remove(f)
+    directory = op.dirname(f)
+    basename, ext = op.splitext(op.basename(f))
 
-    if mri_ext == 'PAR':
-        [os.remove(f) for f in glob(op.join(directory, '*.REC'))]
+    if ext == '.PAR' and cfg['options']['par_engine'] == 'nibabel':
+        return _convert_par_native(f, cfg, compress, scan_info)
 
-    elif mri_ext == 'DICOM':
-        # Experimental enh DICOM conversion
-        dcm_cmd = base_cmd + " -f %n_%p " + directory
-        _run_cmd(dcm_cmd.split(' '))
+    info = dict(n_echoes=1)
+    if ext == '.PAR':
+        info = _get_extra_info_from_par_header(f)
+        if scan_info is not None:
+            # The number of volumes is read from the header of each output
+            # (e.g., a DWI scan has a single dynamic, but many volumes)
+            scan_info.update(acq_date=info.get('acq_date'))
 
-        if op.isdir(op.join(directory, 'DICOM')):
-            rmtree(op.join(directory, 'DICOM'))
-        
-        if op.isfile(op.join(directory, 'DICOMDIR')):
-            os.remove(op.join(directory, 'DICOMDIR'))
+    fname = basename
+    if info['n_echoes'] > 1:
+        fname += '_echo-%e'
+
+    # Convert to a separate dir, so that we know exactly which files
+    # belong to this conversion (even if other files are converted
+    # at the same time)
+    tmp_dir = _make_dir(op.join(directory, '.convert_%s' % basename))
+    cmd = _dcm2niix_cmd(compress) + ['-o', tmp_dir, '-f', fname, f]
+
+    def _clean():
+        # dcm2niix does not overwrite the partial output of a killed attempt
+        rmtree(tmp_dir)
+        _make_dir(tmp_dir)
+
+    # if debug, print dcm2niix output
+    rs = _run_cmd(cmd, verbose=cfg['options']['debug'], before_retry=_clean)
+    if rs != 0:
+        # Do not let the partial output end up in the dataset
+        rmtree(tmp_dir)
+        raise ValueError("dcm2niix could not convert %s (return code %i)!"
+                         % (f, rs))
+    os.remove(f)
+    if ext == '.PAR':
+        for rec in glob(op.join(directory, basename + '.[Rr][Ee][Cc]')):
+            os.remove(rec)
+
+    _rename_phasediff_files(tmp_dir, cfg, idf=_get_fmap_idfs(cfg))
+    [os.remove(adc) for adc in glob(op.join(tmp_dir, '*ADC*.nii*'))]
+
+    outputs = []
+    for out in sorted(glob(op.join(tmp_dir, '*'))):
+        dst = op.join(directory, op.basename(out))
+        os.rename(out, dst)
+        outputs.append(dst)
+
+    rmtree(tmp_dir)
+    return outputs
+
+
+def _convert_par_native(f, cfg, compress, scan_info=None):
+    """ Converts a PAR/REC pair in-process, which directly gives the
+    final names of fieldmap files and does not need to fix the PAR header
+    of scans with dropped frames. """
+
+    rec = _get_data_file(f)
+    if rec is None:
+        raise ValueError("Could not find REC file belonging to %s!" % f)
+
+    basename = op.splitext(op.basename(f))[0]
+    fmap = any(idf in basename for idf in _get_fmap_idfs(cfg))
+    outputs = convert_par(f, rec, op.dirname(f), basename, compress=compress,
+                          fmap=fmap, scan_info=scan_info)
+    os.remove(f)
+    os.remove(rec)
+    return outputs
+
+
+def _convert_dicom_dir(directory, cfg, compress):
+    """ Experimental enh DICOM conversion. """
+
+    before = set(glob(op.join(directory, '*')))
+    dcm_cmd = _dcm2niix_cmd(compress) + ['-f', '%n_%p', directory]
+
+    def _clean():
+        # Removes the partial output of a killed attempt
+        [os.remove(f) for f in set(glob(op.join(directory, '*'))) - before
+         if op.isfile(f)]
+
+    rs = _run_cmd(dcm_cmd, before_retry=_clean)
+    if rs != 0:
+        _clean()
+        raise ValueError("dcm2niix could not convert %s (return code %i)!"
+                         % (directory, rs))
+
+    if op.isdir(op.join(directory, 'DICOM')):
+        rmtree(op.join(directory, 'DICOM'))
+    
+    if op.isfile(op.join(directory, 'DICOMDIR')):
+        os.remove(op.join(directory, 'DICOMDIR'))
 
-        im_files = glob(op.join(directory, 'IM_????'))
-        _ = [os.remove(f) for f in im_files]
+    im_files = glob(op.join(directory, 'IM_????'))
+    _ = [os.remove(f) for f in im_files]
 
-        ps_files = glob(op.join(directory, 'PS_????'))
-        _ = [os.remove(f) for f in ps_files]
+    ps_files = glob(op.join(directory, 'PS_????'))
+    _ = [os.remove(f) for f in ps_files]
 
-        xx_files = glob(op.join(directory, 'XX_????'))
-        _ = [os.remove(f) for f in xx_files]
-    elif mri_ext == 'nifti':
-        pass
-    else:
-        raise ValueError('Please select either PAR, dcm, DICOM or nifti for mri_ext!')
+    xx_files = glob(op.join(directory, 'XX_????'))
+    _ = [os.remove(f) for f in xx_files]
 
-    niis = glob(op.join(directory, '*.nii'))
-    if compress:
-        for nii in niis:
-            _compress(nii, PIGZ)
-            os.remove(nii)
+    _rename_phasediff_files(directory, cfg, idf=_get_fmap_idfs(cfg))
+    [os.remove(adc) for adc in glob(op.join(directory, '*ADC*.nii*'))]
+    return sorted(set(glob(op.join(directory, '*'))) - before)
+
+
+def _dcm2niix_cmd(compress):
+    """ Base dcm2niix command. Output is compressed with the internal gzip
+    of dcm2niix, because the pigz that dcm2niix would start uses all CPUs
+    (and cannot be given a thread count), whereas dcm2niix is scheduled as
+    a single-threaded tool. """
+
+    cmd = ['dcm2niix', '-ba', 'y', '-z']
+    cmd.append('i' if compress else 'n')
+
+    return cmd
+
+
+@lru_cache(maxsize=None)
+def _dcm2niix_version():
+    """ Version of dcm2niix (None if it is not available); the result is
+    cached. """
+
+    if not check_executable('dcm2niix'):
+        return None
+
+    res = subprocess.run(['dcm2niix', '-v'], stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    lines = res.stdout.decode(errors='replace').splitlines()
+    versions = [line for line in lines if 'version' in line.lower()]
+    return (versions or lines or [''])[0].strip()
+
+
+def _get_fmap_idfs(cfg):
+    """ Identifiers of fieldmap files. """
 
     if 'fmap' in cfg.keys():
-        idf = [elem['id'] for elem in cfg['fmap'].values()]
+        idf = [elem['id'] for elem in cfg['fmap'].values() if 'id' in elem]
     else:
         idf = ['phasediff']
 
-    idf = list(set(idf))
-    _rename_phasediff_files(directory, cfg, idf=idf)
+    return list(set(idf))
 
 
 def _rename_phasediff_files(directory, cfg, idf):
@@ -92,19 +215,20 @@ def _rename_phasediff_files(directory, cfg, idf):
     
     new_files = []
     for f in b0_files:
-        fnew = f.replace('phasediff', '')
+        fnew = op.join(directory, op.basename(f).replace('phasediff', ''))
         os.rename(f, fnew)
         new_files.append(fnew)
     
     for fnew in new_files:
-        
-        if '_real' in op.basename(fnew):
-            os.rename(fnew, fnew.replace('_real', '_phasediff'))
+        fbase = op.basename(fnew)
+        if '_real' in fbase:
+            fbase = fbase.replace('_real', '_phasediff')
         else:
-            if '.nii.gz' in fnew:
-                os.rename(fnew, fnew.replace('.nii.gz', '_magnitude1.nii.gz'))
+            if '.nii.gz' in fbase:
+                fbase = fbase.replace('.nii.gz', '_magnitude1.nii.gz')
             else:
-                os.rename(fnew, fnew.replace('.', '_magnitude1.'))
+                fbase = fbase.replace('.', '_magnitude1.')
+        os.rename(fnew, op.join(directory, fbase))
 
     magnitude_jsons = glob(op.join(directory, '*_magnitude1.json'))
     [os.remove(tf) for tf in magnitude_jsons]
@@ -126,6 +250,12 @@ def _get_extra_info_from_par_header(par):
 
     if not found:
         raise ValueError("Could not determine number of slices from PAR header (%s)!" % par)
+
+    for line in lines:
+        if 'Examination date/time' in line:
+            # e.g. "2019.01.31 / 10:12:00" -> 2019-01-31
+            info['acq_date'] = line.split(':', 1)[-1].split('/')[0].strip().replace('.', '-')
+            break
     
     found = False
     for line_nr_of_dyns, line in enumerate(lines):
@@ -187,7 +317,7 @@ def _get_extra_info_from_par_header(par):
         # Replacing expected with actual number of dynamics
         lines[line_nr_of_dyns] = lines[line_nr_of_dyns].replace(str(info['n_dyns']),
                                                                 str(int(actual_n_dyns)))
-        info['n_dyns'] = actual_n_dyns
+        info['n_dyns'] = int(actual_n_dyns)
         with open(par, 'w') as f_out:
             [f_out.write(line) for line in lines]
 
@@ -0,0 +1,193 @@
+from __future__ import print_function, division
+import os.path as op
+import gzip
+import json
+import warnings
+import numpy as np
+import nibabel as nib
+from nibabel.parrec import PARRECHeader
+from .manifest import open_hashed, write_text
+from .version import __version__
+
+# Names of (non-magnitude) image types, as dcm2niix appends them
+IMAGE_TYPE_SUFFIXES = {0: '', 1: '_real', 2: '_imaginary', 3: '_ph'}
+
+
+def convert_par(par, rec, out_dir, fname, compress=True, fmap=False,
+                scan_info=None):
+    """ Converts a PAR/REC pair to nifti in-process (without dcm2niix).
+
+    The REC file is memory-mapped and each output volume is read by indexing
+    its (sorted) slices, scaled (using Philips' floating point scaling), and
+    streamed to the (compressed) nifti file. Incomplete volumes (dropped
+    frames) are removed based on the header, so the PAR file does not need
+    to be fixed.
+
+    Parameters
+    ----------
+    par : str
+        Path to PAR file
+    rec : str
+        Path to REC file
+    out_dir : str
+        Directory to write the nifti/json (and bval/bvec) files to
+    fname : str
+        Base name of the output files (to which _echo-<nr> is appended for
+        multiecho files)
+    compress : bool
+        Whether to write compressed niftis
+    fmap : bool
+        Whether the file is a (Philips B0) fieldmap, of which the magnitude
+        and phase images are written as _magnitude1 (without a json, as
+        `_rename_phasediff_files` does for dcm2niix) and _phasediff files
+    scan_info : dict or None
+        If given, it is updated with n_volumes and acq_date
+
+    Returns
+    -------
+    outputs : list
+        List with paths to the converted files (nifti, json, bval, bvec)
+    """
+
+    with warnings.catch_warnings(), open(par) as f_in:
+        # Inconsistencies due to dropped frames are expected
+        warnings.simplefilter('ignore', UserWarning)
+        hdr = PARRECHeader.from_fileobj(f_in, permit_truncated=True,
+                                        strict_sort=True)
+
+    shape = hdr.get_data_shape()
+    n_slices = shape[2]
+    n_vols = shape[3] if len(shape) > 3 else 1
+    rec_data = np.memmap(rec, dtype=hdr.get_data_dtype(), mode='r',
+                         shape=tuple(int(s) for s in hdr.get_rec_shape()),
+                         order='F')
+    slice_idx = hdr.get_sorted_slice_indices().reshape((n_vols, n_slices))
+    slopes, inters = [s.reshape((n_slices, n_vols))
+                      for s in hdr.get_data_scaling('fp')]
+    bvals, bvecs = hdr.get_bvals_bvecs()
+
+    # Separate files per echo and image type (e.g. magnitude and phase)
+    labels = hdr.get_volume_labels()
+    echoes = labels.get('echo number', np.ones(n_vols, dtype=int))
+    types = labels.get('image_type_mr', np.zeros(n_vols, dtype=int))
+    if fmap and np.setdiff1d(types, [0]).size > 1:
+        raise ValueError("Fieldmap %s has more than one non-magnitude image "
+                         "type (%s); expected a magnitude and a phase image"
+                         % (par, ', '.join(str(t) for t in np.unique(types))))
+
+    # Skip Philips' (computed) DWI trace volumes
+    keep = np.ones(n_vols, dtype=bool)
+    if bvals is not None and bvecs is not None:
+        keep = ~((bvals != 0) & (bvecs == 0).all(axis=1))
+
+    outputs = []
+    for echo in np.unique(echoes):
+        for itype in np.unique(types):
+            vols = np.where((echoes == echo) & (types == itype) & keep)[0]
+            if not vols.size:
+                continue
+
+            name = fname
+            if np.unique(echoes).size > 1:
+                name += '_echo-%i' % echo
+            if fmap:
+                name = name.replace('phasediff', '')
+                name += '_magnitude1' if itype == 0 else '_phasediff'
+            else:
+                name += IMAGE_TYPE_SUFFIXES.get(itype, '_%i' % itype)
+
+            base = op.join(out_dir, name)
+            ext = '.nii.gz' if compress else '.nii'
+            _write_nifti(base + ext, rec_data, hdr, slice_idx[vols],
+                         slopes[:, vols], inters[:, vols], compress)
+            outputs.append(base + ext)
+
+            if not (fmap and itype == 0):
+                metadata = _get_metadata(hdr, vols)
+                write_text(base + '.json', json.dumps(metadata, indent=4))
+                outputs.append(base + '.json')
+
+            if bvals is not None and bvecs is not None:
+                outputs.extend(_write_bval_bvec(base, bvals[vols], bvecs[vols]))
+
+    del rec_data
+    if scan_info is not None:
+        n_volumes = np.sum((echoes == echoes[0]) & (types == types[0]) & keep)
+        scan_info.update(n_volumes=int(n_volumes),
+                         acq_date=_get_acq_date(hdr.general_info))
+
+    return sorted(outputs)
+
+
+def _write_nifti(f, rec_data, hdr, slice_idx, slopes, inters, compress):
+    """ Writes the volumes (given by their slice indices) to nifti, one
+    volume at a time. """
+
+    shape = tuple(hdr.get_data_shape()[:3])
+    n_vols = len(slice_idx)
+    zooms = hdr.get_zooms()[:3]
+    affine = hdr.get_affine(origin='scanner')
+
+    # Only scale data if there are different scale factors
+    single_scale = np.unique(slopes).size == 1 and np.unique(inters).size == 1
+    dtype = rec_data.dtype if single_scale else np.dtype('float32')
+
+    nii_hdr = nib.Nifti1Header()
+    nii_hdr.set_data_dtype(dtype)
+    nii_hdr.set_data_shape(shape + ((n_vols,) if n_vols > 1 else ()))
+    nii_hdr.set_qform(affine, code=1)
+    nii_hdr.set_sform(affine, code=1)
+    nii_hdr.set_zooms(zooms + ((hdr.general_info['repetition_time'][0] / 1000.,)
+                               if n_vols > 1 else ()))
+    nii_hdr.set_xyzt_units('mm', 'sec')
+    if single_scale:
+        nii_hdr.set_slope_inter(float(slopes.flat[0]), float(inters.flat[0]))
+
+    # Single header (348 bytes) plus empty extension flag
+    nii_hdr['vox_offset'] = 352
+    with open_hashed(f) as f_hashed:
+        f_out = gzip.GzipFile(fileobj=f_hashed, mode='wb') if compress else f_hashed
+        f_out.write(nii_hdr.binaryblock)
+        f_out.write(b'\x00' * 4)
+        for i, idx in enumerate(slice_idx):
+            vol = rec_data[:, :, idx]
+            if not single_scale:
+                vol = vol * slopes[:, i].astype(dtype) + inters[:, i].astype(dtype)
+            f_out.write(vol.astype(dtype, copy=False).tobytes(order='F'))
+
+        if compress:
+            f_out.close()
+
+
+def _get_metadata(hdr, vols):
+    """ Sidecar metadata (as far as it is in the PAR header). """
+
+    info = hdr.general_info
+    image_defs = hdr.image_defs
+    first = image_defs[hdr.get_sorted_slice_indices()[vols[0] * hdr.get_data_shape()[2]]]
+    metadata = dict(
+        Manufacturer='Philips',
+        ProtocolName=info['protocol_name'],
+        SeriesNumber=int(info['acq_nr']),
+        RepetitionTime=float(info['repetition_time'][0]) / 1000.,
+        EchoTime=float(first['echo_time']) / 1000.,
+        FlipAngle=float(first['image_flip_angle']),
+        ConversionSoftware='bidsify (nibabel)',
+        ConversionSoftwareVersion=__version__
+    )
+    return metadata
+
+
+def _write_bval_bvec(base, bvals, bvecs):
+    """ Writes FSL-style bval and bvec files. """
+
+    write_text(base + '.bval', ' '.join('%g' % b for b in bvals) + '\n')
+    write_text(base + '.bvec', ''.join(' '.join('%g' % v for v in row) + '\n'
+                                       for row in bvecs.T))
+    return [base + '.bval', base + '.bvec']
+
+
+def _get_acq_date(info):
+    """ Date of the exam (e.g. 2019-01-31) from the PAR header. """
+
+    return info['exam_date'].split('/')[0].strip().replace('.', '-')
@@ -0,0 +1,157 @@
+from __future__ import print_function, division
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+from .scheduler import get_scheduler, usage_tags
+
+
+class TaskGraph(object):
+    """ Dependency graph of named tasks, executed as soon as all
+    dependencies of a task are done.
+
+    Tasks may add new tasks (and dependencies) to the graph while it is
+    running, which allows stages to be expanded once their inputs are known
+    (e.g., the outputs of a dcm2niix call). Dependencies may refer to tasks
+    that have not been added yet; such a dependency is only satisfied once
+    that task has been added and has finished. A task without a function
+    acts as a barrier.
+    """
+
+    def __init__(self):
+        self._tasks = OrderedDict()
+        self._done = set()
+        self._results = dict()
+        self._lock = threading.RLock()
+
+    def add(self, name, func=None, args=(), deps=(), tags=None):
+        """ Adds a task to the graph.
+
+        Parameters
+        ----------
+        name : str
+            Unique name of the task
+        func : callable or None
+            Function to run (None for a barrier)
+        args : tuple
+            Arguments for func
+        deps : iterable
+            Names of tasks that should be done before this one is started
+        tags : dict or None
+            Usage tags (e.g. input_file) for the external tools run by func
+        """
+        with self._lock:
+            if name in self._tasks:
+                raise ValueError("Task '%s' was already added!" % name)
+
+            self._tasks[name] = dict(func=func, args=tuple(args),
+                                     deps=set(deps), tags=tags or dict(),
+                                     started=False)
+
+    def add_dependency(self, name, dep):
+        """ Adds a dependency to an existing (not yet started) task. """
+        with self._lock:
+            task = self._tasks[name]
+            if task['started']:
+                raise ValueError("Cannot add dependency to task '%s', which "
+                                 "has already started!" % name)
+            task['deps'].add(dep)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._tasks
+
+    def result(self, name):
+        """ Returns the return value of a finished task. """
+        return self._results[name]
+
+    def run(self, submit=None):
+        """ Runs all tasks until the graph is exhausted.
+
+        Parameters
+        ----------
+        submit : callable or None
+            Function with the signature of ``Executor.submit``; defaults to
+            the persistent worker pool of the tool scheduler.
+
+        Returns
+        -------
+        results : dict
+            Mapping from task name to return value
+        """
+        if submit is None:
+            submit = get_scheduler().submit
+
+        running = dict()
+        error = None
+        while True:
+            ready = self._ready() if error is None else []
+            while ready:
+                barriers_done = False
+                for name in ready:
+                    task = self._tasks[name]
+                    if task['func'] is None:  # barrier
+                        self._finish(name, None)
+                        barriers_done = True
+                    else:
+                        future = submit(_run_task, task['func'], task['args'],
+                                        task['tags'], name)
+                        running[future] = name
+
+                # Finished barriers may have freed new tasks
+                ready = self._ready() if barriers_done else []
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    error = error or exc
+                else:
+                    self._finish(name, future.result())
+
+        if error is not None:
+            raise error
+
+        with self._lock:
+            left = [name for name, task in self._tasks.items()
+                    if name not in self._done]
+        if left:
+            raise ValueError("Could not run task(s) %s because of missing "
+                             "dependencies!" % left)
+
+        return self._results
+
+    def _ready(self):
+        with self._lock:
+            ready = [name for name, task in self._tasks.items()
+                     if not task['started'] and task['deps'] <= self._done]
+            for name in ready:
+                self._tasks[name]['started'] = True
+
+        return ready
+
+    def _finish(self, name, result):
+        with self._lock:
+            self._results[name] = result
+            self._done.add(name)
+
+
+def _run_task(func, args, tags, name=''):
+    t_start = time.time()
+    try:
+        with usage_tags(**tags):
+            return func(*args)
+    except Exception as e:
+        # Keep the (innermost) task that failed, for the failure ledger
+        if not hasattr(e, 'bidsify_task'):
+            e.bidsify_task = name
+        raise
+    finally:
+        # Stage of the task, e.g. 'convert' for 'convert:sub-01_T1w.PAR'
+        metrics = get_scheduler().metrics
+        if metrics is not None:
+            metrics.observe_stage(name.split(':')[0], time.time() - t_start)
@@ -0,0 +1,169 @@
+from __future__ import print_function, division
+import os.path as op
+import shutil
+import threading
+from .sources import DirSource
+from .utils import _make_dir
+
+
+class Prefetcher(object):
+    """ Reads the raw files of upcoming sessions into a local directory in a
+    background thread, so that reading them from (slow) network storage
+    overlaps with converting the current session.
+
+    Sessions are prefetched in order, as long as the prefetched (but not yet
+    processed) sessions fit in the byte budget; sessions that are larger than
+    the budget on their own, or that are reached by the conversion before
+    the prefetcher gets to them, are read from their source as usual.
+
+    Parameters
+    ----------
+    prefetch_dir : str
+        (Local) directory to store the prefetched files in
+    budget : float
+        Maximum size of the prefetched files (in GB)
+    """
+
+    def __init__(self, prefetch_dir, budget):
+        self.prefetch_dir = prefetch_dir
+        self.budget = int(budget * 1024 ** 3)
+        self.used = 0
+        self._ready = dict()  # key -> (local dir, files, size)
+        self._taken = set()
+        self._current = None  # key of session that is being prefetched
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, sessions):
+        """ Starts prefetching sessions, given as a list of (key, source)
+        tuples in the order in which they will be processed. Only sessions
+        in directories are prefetched (archives are streamed already). """
+        sessions = [(key, source) for key, source in sessions
+                    if not source.is_archive]
+        self._thread = threading.Thread(target=self._run, args=(sessions,),
+                                        name='bidsify-prefetch', daemon=True)
+        self._thread.start()
+
+    def take(self, key, source):
+        """ Returns the source to read a session from: its prefetched copy
+        (waiting for it if it is being prefetched) or the original source. """
+        with self._cond:
+            self._taken.add(key)
+            while self._current == key:
+                self._cond.wait()
+
+            if key not in self._ready:
+                return source
+
+            local_dir, files, _ = self._ready[key]
+            return PrefetchedSource(source.path, local_dir, files)
+
+    def release(self, key):
+        """ Removes the prefetched copy of a session that was processed. """
+        with self._cond:
+            local_dir, _, size = self._ready.pop(key, (None, None, 0))
+            self.used -= size
+            self._cond.notify_all()
+
+        if local_dir is not None:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    def stop(self):
+        """ Stops prefetching and removes all prefetched files. """
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        with self._cond:
+            self._ready.clear()
+            self.used = 0
+
+        shutil.rmtree(self.prefetch_dir, ignore_errors=True)
+
+    def _run(self, sessions):
+        for i, (key, source) in enumerate(sessions):
+            with self._cond:
+                if self._stop:
+                    return
+                if key in self._taken:  # the conversion is ahead of us
+                    continue
+
+            try:
+                files = source.list_files()
+                size = sum(op.getsize(f) for f in files)
+            except (IOError, OSError):
+                continue  # reported when the session is processed
+
+            if size > self.budget:
+                continue
+
+            with self._cond:
+                # Wait until earlier sessions are processed
+                while self.used and self.used + size > self.budget and not self._stop:
+                    self._cond.wait()
+
+                if self._stop:
+                    return
+                if key in self._taken:
+                    continue
+
+                self._current = key
+                self.used += size
+
+            local_dir = op.join(self.prefetch_dir, str(i))
+            local = []
+            try:
+                for f in files:
+                    dst = op.join(local_dir, op.relpath(f, source.path))
+                    _make_dir(op.dirname(dst))
+                    shutil.copy2(f, dst)
+                    local.append(dst)
+            except (IOError, OSError) as e:
+                print("Could not prefetch %s (%s); reading it from its "
+                      "source instead" % (source.path, e))
+                shutil.rmtree(local_dir, ignore_errors=True)
+                with self._cond:
+                    self.used -= size
+                    self._current = None
+                    self._cond.notify_all()
+                continue
+
+            with self._cond:
+                self._ready[key] = (local_dir, local, size)
+                self._current = None
+                self._cond.notify_all()
+
+
+class PrefetchedSource(DirSource):
+    """ Raw data of a session (in a directory) that was prefetched to a local
+    directory; the files are moved (instead of copied) from there.
+
+    Parameters
+    ----------
+    path : str
+        Path to the original session directory
+    local_dir : str
+        Directory with the prefetched copies
+    files : list
+        The prefetched copies
+    """
+
+    def __init__(self, path, local_dir, files):
+        self.path = path
+        self.local_dir = local_dir
+        self.files = files
+
+    def list_files(self):
+        return list(self.files)
+
+    def copy_files(self, files, dst_dir):
+        """ Moves (prefetched) files to dst_dir and returns the new paths. """
+        out = []
+        for f in files:
+            out.append(op.join(dst_dir, op.basename(f)))
+            shutil.move(f, out[-1])
+        return out
@@ -0,0 +1,635 @@
+from __future__ import print_function, division
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncio
+import threading
+import subprocess
+from glob import glob, escape as glob_escape
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import partial
+
+# Default per-tool limits: "slots" is the max. number of concurrent
+# processes of that tool (None = only limited by the CPU budget) and
+# "threads" is the number of CPUs each process may use (and is charged
+# against the global CPU budget). A process is killed after "timeout" plus
+# "timeout_per_gb" (per GB of input) seconds, or when it has not produced
+# output nor used CPU time for "hang_timeout" seconds; killed processes are
+# retried "retries" times, after "backoff" seconds (doubled each retry)
+DEFAULT_TOOL_LIMITS = dict(
+    dcm2niix=dict(slots=None, threads=1, timeout=600, timeout_per_gb=600,
+                  hang_timeout=300, retries=1),
+    pigz=dict(slots=None, threads=2, timeout=300, timeout_per_gb=300,
+              hang_timeout=120, retries=1),
+    fslreorient2std=dict(slots=None, threads=1, timeout=600, timeout_per_gb=600,
+                         retries=1),
+    flirt=dict(slots=None, threads=1, timeout=1800, retries=1),
+    convert_xfm=dict(slots=None, threads=1, timeout=300, retries=1),
+    pydeface=dict(slots=None, threads=1, timeout=3600, retries=1),
+)
+
+# Seconds between asking a process (group) to terminate and killing it
+KILL_GRACE = 5
+
+# Disk space and memory (in bytes) that admitted sessions should leave
+# free, and the interval (in seconds) to re-check them while waiting
+DISK_HEADROOM = 2 * 1024 ** 3
+MEMORY_HEADROOM = 1024 ** 3
+ADMISSION_POLL = 5
+
+# How to pass the thread count on the command line (if possible); the
+# other tools are single-threaded (dcm2niix, if it compresses with its
+# internal gzip, see mri2nifti._dcm2niix_cmd, and FSL's flirt,
+# convert_xfm, and fslreorient2std, also when called by pydeface) apart
+# from libraries that are limited by THREAD_ENV_VARS
+THREAD_ARGS = dict(
+    pigz=['-p', '{threads}']
+)
+
+# Environment variables that limit multithreading of (most) other tools
+# (OpenMP, BLAS, and ITK) and their Python libraries (e.g. numpy in pydeface)
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+CmdResult = namedtuple('CmdResult', ['returncode', 'stdout', 'stderr'])
+
+# Columns of the resource usage records (besides the tags)
+USAGE_COLUMNS = ['tool', 'returncode', 'attempt', 'killed', 'wall_time',
+                 'user_time', 'sys_time', 'max_rss_mb', 'block_in', 'block_out']
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+_TAGS = threading.local()
+
+
+def get_scheduler(n_cores=None, tool_limits=None):
+    """ Returns the (persistent) scheduler for external tools.
+
+    The scheduler is created on first use; subsequent calls return the
+    same instance, optionally updating its CPU budget and tool limits.
+
+    Parameters
+    ----------
+    n_cores : int or None
+        Global CPU budget (joblib-style, so -1 means all CPUs)
+    tool_limits : dict or None
+        Per-tool limits, e.g. {'pigz': {'slots': 2, 'threads': 4}}
+
+    Returns
+    -------
+    scheduler : ToolScheduler
+    """
+    global _SCHEDULER
+
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = ToolScheduler(n_cores=-1 if n_cores is None else n_cores,
+                                       tool_limits=tool_limits)
+        else:
+            _SCHEDULER.configure(n_cores=n_cores, tool_limits=tool_limits)
+
+    return _SCHEDULER
+
+
+@contextmanager
+def usage_tags(**tags):
+    """ Tags the resource usage of all external tools that are run (or
+    submitted to the worker pool) from within this context, e.g.
+    ``with usage_tags(session='sub-01/ses-1'): ...``. """
+    old = _current_tags()
+    _TAGS.tags = dict(old, **tags)
+    try:
+        yield
+    finally:
+        _TAGS.tags = old
+
+
+def _current_tags():
+    return dict(getattr(_TAGS, 'tags', dict()))
+
+
+def _with_tags(tags, func, *args, **kwargs):
+    with usage_tags(**tags):
+        return func(*args, **kwargs)
+
+
+def _n_cores(n_cores):
+    """ Converts a joblib-style number of cores to an actual number. """
+    n_cpus = os.cpu_count() or 1
+    if n_cores is None or n_cores == 0:
+        return n_cpus
+    elif n_cores < 0:
+        return max(n_cpus + 1 + n_cores, 1)
+    return n_cores
+
+
+class ToolScheduler(object):
+    """ Runs external commands on a persistent asyncio event loop.
+
+    All external tools (dcm2niix, pigz, FSL, pydeface) should be launched
+    through this scheduler, which makes sure that the total number of
+    threads used by concurrently running tools stays within a global CPU
+    budget and that per-tool slot limits are respected. Output of the
+    processes is captured without blocking the loop, and the resource usage
+    of each process (wall time, CPU time, peak memory, block I/O) is
+    recorded in `usage`, together with the active usage tags.
+
+    Parameters
+    ----------
+    n_cores : int
+        Global CPU budget (joblib-style, so -1 means all CPUs)
+    tool_limits : dict or None
+        Per-tool limits, which update DEFAULT_TOOL_LIMITS
+    """
+
+    def __init__(self, n_cores=-1, tool_limits=None):
+        self.tool_limits = deepcopy(DEFAULT_TOOL_LIMITS)
+        self.n_cores = _n_cores(n_cores)
+        self.configure(tool_limits=tool_limits)
+
+        # Usage bookkeeping; only touched from within the event loop
+        self._cpus_in_use = 0
+        self._tools_in_use = dict()
+        self._cond = None
+
+        # Estimated peak disk/memory usage of the admitted sessions
+        self._admitted = []
+        self._admission = threading.Condition()
+
+        # Resource usage of finished processes
+        self.usage = []
+        self._usage_lock = threading.Lock()
+
+        # Metrics of the conversions (see metrics.py), only if they are served
+        self.metrics = None
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='bidsify-scheduler', daemon=True)
+        self._thread.start()
+        self._pool = None
+        self._procs = None
+        self._start_pools()
+
+    def configure(self, n_cores=None, tool_limits=None):
+        """ Updates the CPU budget and/or tool limits. """
+        if n_cores is not None and _n_cores(n_cores) != self.n_cores:
+            self.n_cores = _n_cores(n_cores)
+            if self._pool is not None:
+                self._start_pools()
+
+        if tool_limits:
+            for tool, limits in tool_limits.items():
+                self.tool_limits.setdefault(tool, dict(slots=None, threads=1))
+                self.tool_limits[tool].update(limits)
+
+    def _start_pools(self):
+        """ (Re)creates the worker pools for the current CPU budget; work
+        that was submitted to the old pools still finishes. """
+        old = [self._pool, self._procs]
+        self._pool = ThreadPoolExecutor(max_workers=max(self.n_cores, 2),
+                                        thread_name_prefix='bidsify-worker')
+        # Processes are started and reaped (with wait4) in these threads;
+        # the CPU budget bounds the number of concurrent processes
+        self._procs = ThreadPoolExecutor(max_workers=max(self.n_cores, _n_cores(-1)) + 2,
+                                         thread_name_prefix='bidsify-proc')
+        [pool.shutdown(wait=False) for pool in old if pool is not None]
+
+    def run(self, cmd, verbose=False, outfile=None, env=None, stdout_to=None,
+            before_retry=None):
+        """ Runs a command and blocks until it has finished.
+
+        Parameters
+        ----------
+        cmd : list
+            Command (and arguments) to run
+        verbose : bool
+            Whether to print the stdout of the command
+        outfile : str or None
+            If given, the stdout of the command is written to this file
+        env : dict or None
+            Extra environment variables for the command
+        stdout_to : file-like or None
+            If given, the stdout of the command is streamed (as bytes) to
+            this object, e.g. for tools that write their output to stdout
+        before_retry : callable or None
+            If given, it is called before a killed command is retried, to
+            remove the partial output of the killed attempt (e.g. for tools
+            that do not overwrite existing files)
+
+        Returns
+        -------
+        result : CmdResult
+            Namedtuple with returncode, stdout, and stderr
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_async(cmd, verbose=verbose, outfile=outfile, env=env,
+                           tags=_current_tags(), stdout_to=stdout_to,
+                           before_retry=before_retry),
+            self._loop
+        )
+        return future.result()
+
+    def run_many(self, cmds, verbose=False, env=None):
+        """ Runs many commands concurrently (within the budgets) and
+        returns their results in order. """
+        tags = _current_tags()
+        coros = [self.run_async(cmd, verbose=verbose, env=env, tags=tags)
+                 for cmd in cmds]
+        if not coros:
+            return []
+
+        future = asyncio.run_coroutine_threadsafe(
+            _gather(coros), self._loop
+        )
+        return future.result()
+
+    def map(self, func, iterable):
+        """ Applies a Python function to each item on the persistent worker
+        pool; external tools called by the function are still scheduled
+        through this scheduler. """
+        func = partial(_with_tags, _current_tags(), func)
+        return list(self._pool.map(func, iterable))
+
+    def submit(self, func, *args, **kwargs):
+        """ Submits a Python function to the persistent worker pool. """
+        return self._pool.submit(_with_tags, _current_tags(), func,
+                                 *args, **kwargs)
+
+    @contextmanager
+    def admit(self, disk=0, memory=0, path=None, name=''):
+        """ Admits a session (within this context) once its estimated peak
+        disk usage and memory fit in the free disk space (of the filesystem
+        of path) and the available memory, minus the estimates of the
+        sessions that were admitted before and are still running. A session
+        is always admitted if no other session is running.
+
+        Parameters
+        ----------
+        disk : int
+            Estimated peak disk usage (in bytes)
+        memory : int
+            Estimated peak memory (in bytes)
+        path : str or None
+            Directory the session writes to (None: disk is not checked)
+        name : str
+            Name of the session (for messages)
+        """
+        ticket = dict(disk=disk, memory=memory, name=name,
+                      dev=os.stat(path).st_dev if path is not None else None,
+                      path=path)
+        waiting = False
+        with self._admission:
+            while self._admitted and not self._fits(ticket):
+                if not waiting:
+                    print("Waiting for disk space and/or memory to start %s ..." % name)
+                    waiting = True
+                self._admission.wait(timeout=ADMISSION_POLL)
+
+            self._admitted.append(ticket)
+
+        try:
+            yield
+        finally:
+            with self._admission:
+                self._admitted = [t for t in self._admitted if t is not ticket]
+                self._admission.notify_all()
+
+    def _fits(self, ticket):
+        """ Whether a session fits next to the admitted ones. """
+        if ticket['dev'] is not None:
+            reserved = sum(t['disk'] for t in self._admitted
+                           if t['dev'] == ticket['dev'])
+            free = shutil.disk_usage(ticket['path']).free
+            if free - reserved - DISK_HEADROOM < ticket['disk']:
+                return False
+
+        available = _available_memory()
+        if available is not None:
+            reserved = sum(t['memory'] for t in self._admitted)
+            if available - reserved - MEMORY_HEADROOM < ticket['memory']:
+                return False
+
+        return True
+
+    def slot_usage(self):
+        """ Returns the CPUs in use, the CPU budget, and per tool the number
+        of running processes and the max. number of slots (None if the tool
+        is only limited by the CPU budget). """
+        tools = dict((tool, dict(in_use=self._tools_in_use.get(tool, 0),
+                                 slots=limits.get('slots')))
+                     for tool, limits in self.tool_limits.items())
+        for tool, n in list(self._tools_in_use.items()):
+            tools.setdefault(tool, dict(in_use=n, slots=None))
+
+        return dict(cpus_in_use=self._cpus_in_use, n_cores=self.n_cores,
+                    tools=tools)
+
+    def usage_report(self, start=0, by=None, **filters):
+        """ Returns the recorded resource usage of external tools.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first record to include (e.g., the number of
+            records before a run)
+        by : str, list, or None
+            If given, records are aggregated per value of these column(s),
+            e.g. 'tool' or ['session', 'tool']
+        filters : dict
+            Tags (or columns) to select records on, e.g. session='sub-01'
+
+        Returns
+        -------
+        report : DataFrame
+            One row per process (or per group, if `by` is given); times are
+            in seconds, block I/O in number of blocks
+        """
+        with self._usage_lock:
+            records = self.usage[start:]
+
+        report = pd.DataFrame(records)
+        for col in USAGE_COLUMNS:
+            if col not in report.columns:
+                report[col] = None
+
+        for key, value in filters.items():
+            report = report[report[key] == value] if key in report.columns else report.iloc[:0]
+
+        if by is None:
+            return report.reset_index(drop=True)
+
+        agg = dict(n_calls=('tool', 'size'), wall_time=('wall_time', 'sum'),
+                   user_time=('user_time', 'sum'), sys_time=('sys_time', 'sum'),
+                   max_rss_mb=('max_rss_mb', 'max'), block_in=('block_in', 'sum'),
+                   block_out=('block_out', 'sum'))
+        return report.groupby(by).agg(**agg).reset_index()
+
+    async def run_async(self, cmd, verbose=False, outfile=None, env=None,
+                        tags=None, stdout_to=None, before_retry=None):
+        """ Coroutine version of `run`; `tags` are stored with the
+        resource usage of the process. """
+
+        tool = os.path.basename(cmd[0])
+        limits = self.tool_limits.get(tool, dict(slots=None, threads=1))
+        threads = max(min(int(limits.get('threads') or 1), self.n_cores), 1)
+        cmd = _add_thread_args(cmd, tool, threads)
+
+        proc_env = dict(os.environ)
+        proc_env.update({var: str(threads) for var in THREAD_ENV_VARS})
+        if env is not None:
+            proc_env.update(env)
+
+        timeout = limits.get('timeout')
+        if timeout is not None and limits.get('timeout_per_gb'):
+            timeout += limits['timeout_per_gb'] * _input_size(cmd) / 1024 ** 3
+
+        # Streamed output cannot be taken back, so such commands are not retried
+        retries = int(limits.get('retries') or 0) if stdout_to is None else 0
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = limits.get('backoff', 5) * 2 ** (attempt - 1)
+                print("%s was killed (%s); retrying in %i seconds ..." %
+                      (' '.join(cmd), usage['killed'] or 'signal %i' % -returncode, delay))
+                await asyncio.sleep(delay)
+                if before_retry is not None:
+                    await self._loop.run_in_executor(self._procs, before_retry)
+
+            await self._acquire(tool, threads, limits.get('slots'))
+            try:
+                returncode, stdout, stderr, usage = await self._loop.run_in_executor(
+                    self._procs, _run_process, cmd, proc_env, stdout_to, timeout,
+                    limits.get('hang_timeout')
+                )
+            finally:
+                await self._release(tool, threads)
+
+            record = dict(tags if tags is not None else _current_tags())
+            record.update(tool=tool, returncode=returncode, attempt=attempt + 1,
+                          **usage)
+            with self._usage_lock:
+                self.usage.append(record)
+
+            # Only processes that were killed (e.g. by a timeout or the OOM
+            # killer) are retried; errors of the tool itself are not transient
+            if returncode >= 0:
+                break
+
+        stdout = stdout.decode(errors='replace')
+        stderr = stderr.decode(errors='replace')
+        if outfile is not None:
+            with open(outfile, 'w') as f:
+                f.write(stdout)
+        elif verbose and stdout:
+            print(stdout)
+
+        if stderr:
+            sys.stderr.write(stderr)
+
+        return CmdResult(returncode, stdout, stderr)
+
+    async def _acquire(self, tool, threads, slots):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+
+        async with self._cond:
+            while not self._has_room(tool, threads, slots):
+                await self._cond.wait()
+
+            self._cpus_in_use += threads
+            self._tools_in_use[tool] = self._tools_in_use.get(tool, 0) + 1
+
+    async def _release(self, tool, threads):
+        async with self._cond:
+            self._cpus_in_use -= threads
+            self._tools_in_use[tool] -= 1
+            self._cond.notify_all()
+
+    def _has_room(self, tool, threads, slots):
+        if slots is not None and self._tools_in_use.get(tool, 0) >= slots:
+            return False
+
+        # Always allow a single process, even if it asks for more threads
+        # than the budget
+        if self._cpus_in_use == 0:
+            return True
+
+        return self._cpus_in_use + threads <= self.n_cores
+
+
+def _run_process(cmd, env, stdout_to=None, timeout=None, hang_timeout=None):
+    """ Runs a process to completion and measures its resource usage; if
+    stdout_to is given, stdout is streamed to it (and not returned).
+
+    The process runs in its own process group, which is killed when the
+    process runs longer than timeout seconds or when it has neither written
+    output nor used CPU time for hang_timeout seconds.
+
+    Returns
+    -------
+    returncode, stdout, stderr, usage : int, bytes, bytes, dict
+    """
+    usage = dict((col, None) for col in USAGE_COLUMNS[4:])
+    usage['killed'] = None
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env,
+                                start_new_session=hasattr(os, 'killpg'))
+    except OSError as e:  # e.g., executable not found
+        usage['wall_time'] = time.perf_counter() - start
+        return 127, b'', str(e).encode(), usage
+
+    if not hasattr(os, 'wait4'):  # e.g., Windows
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            stdout, stderr = proc.communicate()
+            usage['killed'] = 'timeout'
+        if stdout_to is not None:
+            stdout_to.write(stdout)
+            stdout = b''
+        usage['wall_time'] = time.perf_counter() - start
+        return proc.returncode, stdout, stderr, usage
+
+    # Read both pipes (to avoid blocking the process) and reap the process
+    # ourselves, because only wait4 returns its resource usage
+    progress = dict(time=time.perf_counter())
+    stdout, stderr = [], []
+
+    def _read(pipe, write):
+        for chunk in iter(lambda: pipe.read1(2 ** 20), b''):
+            progress['time'] = time.perf_counter()
+            write(chunk)
+
+    write_stdout = stdout_to.write if stdout_to is not None else stdout.append
+    readers = [threading.Thread(target=_read, args=(proc.stdout, write_stdout)),
+               threading.Thread(target=_read, args=(proc.stderr, stderr.append))]
+    [r.start() for r in readers]
+
+    done = threading.Event()
+    watchdog = None
+    if timeout is not None or hang_timeout is not None:
+        watchdog = threading.Thread(target=_watch_process,
+                                    args=(proc.pid, start, progress, done, usage,
+                                          timeout, hang_timeout))
+        watchdog.start()
+
+    [r.join() for r in readers]
+    proc.stdout.close()
+    proc.stderr.close()
+    stdout, stderr = b''.join(stdout), b''.join(stderr)
+
+    _, status, rusage = os.wait4(proc.pid, 0)
+    done.set()
+    if watchdog is not None:
+        watchdog.join()
+    usage['wall_time'] = time.perf_counter() - start
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    maxrss = rusage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    usage.update(user_time=rusage.ru_utime, sys_time=rusage.ru_stime,
+                 max_rss_mb=maxrss, block_in=rusage.ru_inblock,
+                 block_out=rusage.ru_oublock)
+    return proc.returncode, stdout, stderr, usage
+
+
+def _watch_process(pid, start, progress, done, usage, timeout, hang_timeout):
+    """ Kills the process group of pid when it times out or hangs. """
+
+    cpu_time = _cpu_time(pid)
+    while not done.wait(1):
+        now = time.perf_counter()
+        this_cpu_time = _cpu_time(pid)
+        if this_cpu_time != cpu_time:
+            cpu_time = this_cpu_time
+            progress['time'] = now
+
+        if timeout is not None and now - start > timeout:
+            usage['killed'] = 'timeout'
+        elif hang_timeout is not None and now - progress['time'] > hang_timeout:
+            usage['killed'] = 'hang'
+        else:
+            continue
+
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(pid, sig)
+            except OSError:  # group is gone already
+                break
+            if done.wait(KILL_GRACE):
+                break
+        return None
+
+
+def _cpu_time(pgid):
+    """ CPU time (in clock ticks) of the processes in a process group and
+    their reaped children, so that a tool that waits for its child process
+    (e.g. pydeface for flirt) is not considered idle (Linux only; None
+    elsewhere). """
+    total = None
+    for stat in glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f_in:
+                # Fields after the (parenthesized) command name
+                fields = f_in.read().rpartition(')')[2].split()
+            if int(fields[2]) == pgid:
+                total = (total or 0) + sum(int(f) for f in fields[11:15])
+        except (OSError, ValueError, IndexError):  # e.g. process is gone
+            continue
+
+    return total
+
+
+def _available_memory():
+    """ Memory (in bytes) available for new processes (Linux only). """
+    try:
+        with open('/proc/meminfo') as f_in:
+            for line in f_in:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def _input_size(cmd):
+    """ Total size (in bytes) of the existing files in a command, including
+    files with the same stem (e.g. the REC file of a PAR file) and the
+    files in directories. """
+    files = set()
+    for arg in cmd[1:]:
+        if not isinstance(arg, str) or not os.path.exists(arg):
+            continue
+        if os.path.isdir(arg):
+            files.update(glob(os.path.join(arg, '*')))
+        else:
+            files.update(glob(glob_escape(os.path.splitext(arg)[0]) + '.*'))
+            files.add(arg)
+
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+
+async def _gather(coros):
+    return await asyncio.gather(*coros)
+
+
+def _add_thread_args(cmd, tool, threads):
+    """ Adds a thread-count argument to the command (if supported). """
+    if tool not in THREAD_ARGS:
+        return list(cmd)
+
+    args = [a.format(threads=threads) for a in THREAD_ARGS[tool]]
+    return [cmd[0]] + args + list(cmd[1:])
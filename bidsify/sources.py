@@ -0,0 +1,248 @@
+from __future__ import print_function, division
+import os
+import os.path as op
+import shutil
+import fnmatch
+import tarfile
+import zipfile
+import warnings
+import threading
+from glob import glob
+from collections import OrderedDict
+
+ARCHIVE_EXTS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                '.zip']
+
+# Listings of archives (path -> member names and sizes), so that an
+# archive of a subject is only listed once for all its sessions
+_LISTINGS = dict()
+_LISTINGS_LOCK = threading.Lock()
+
+
+def is_archive(path):
+    """ Checks whether a path is a (supported) archive file. """
+    return op.isfile(path) and any(path.endswith(ext) for ext in ARCHIVE_EXTS)
+
+
+def archive_stem(path):
+    """ Returns the name of an archive without extension, e.g. ses-1 for
+    /raw/sub-01/ses-1.tar.bz2. """
+    name = op.basename(path)
+    for ext in sorted(ARCHIVE_EXTS, key=len, reverse=True):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def drop_duplicate_sources(paths):
+    """ Removes archives of which a directory (or another archive) with the
+    same name exists, e.g. sub-01.tar.gz next to sub-01/, which would
+    otherwise be converted twice into the same output. Directories are
+    preferred over archives.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to directories and/or archives
+
+    Returns
+    -------
+    paths : list
+        Paths (in the original order) with a unique name
+    """
+    kept = dict()
+    for path in sorted(paths, key=lambda p: not op.isdir(p)):
+        stem = archive_stem(path)
+        if stem in kept:
+            warnings.warn("Skipping %s, because %s has the same name"
+                          % (path, kept[stem]))
+        else:
+            kept[stem] = path
+
+    kept = set(kept.values())
+    return [p for p in paths if p in kept]
+
+
+def find_session_sources(sub_path):
+    """ Finds the sessions of a subject, which may be a directory or an
+    archive, and whose sessions may be directories or archives themselves.
+
+    Parameters
+    ----------
+    sub_path : str
+        Path to subject directory or archive
+
+    Returns
+    -------
+    sessions : list
+        List of (cdir, is_sess, source) tuples, in which cdir is the
+        (possibly virtual) path of the session, e.g. /raw/sub-01/ses-1,
+        which is only used for its name
+    """
+
+    if is_archive(sub_path):
+        cdir = op.join(op.dirname(sub_path), archive_stem(sub_path))
+        names = _list_archive(sub_path)
+
+        # Archive may contain a top-level directory of the subject itself
+        root = ''
+        if names and all(n.startswith(archive_stem(sub_path) + '/') for n in names):
+            root = archive_stem(sub_path) + '/'
+
+        sess_names = sorted(set(n[len(root):].split('/')[0] for n in names
+                                if n[len(root):].startswith('ses-')
+                                and '/' in n[len(root):]))
+        if not sess_names:
+            return [(cdir, False, ArchiveSource(sub_path, prefix=root))]
+
+        return [(op.join(cdir, sess), True,
+                 ArchiveSource(sub_path, prefix=root + sess + '/'))
+                for sess in sess_names]
+
+    # Important: to find session-dirs, they should be named ses-*something*
+    sessions = []
+    sess_paths = [p for p in sorted(glob(op.join(sub_path, 'ses-*')))
+                  if op.isdir(p) or is_archive(p)]
+    for sess in drop_duplicate_sources(sess_paths):
+        if op.isdir(sess):
+            sessions.append((sess, True, DirSource(sess)))
+        elif is_archive(sess):
+            sessions.append((op.join(sub_path, archive_stem(sess)), True,
+                             ArchiveSource(sess)))
+
+    if not sessions:
+        sessions.append((sub_path, False, DirSource(sub_path)))
+
+    return sessions
+
+
+def select_files(files, cfg):
+    """ Selects the files that can end up in the BIDS dataset, i.e.,
+    files that match one of the mappings. For (enhanced) DICOM data, all
+    files are selected, because the names of the converted files are only
+    known after conversion.
+    """
+    if cfg['options']['mri_ext'] in ['DICOM', 'dcm']:
+        return list(files)
+
+    idfs = ['*%s*' % idf for idf in cfg['mappings'].values() if idf is not None]
+    return [f for f in files
+            if any(fnmatch.fnmatch(op.basename(f), idf) for idf in idfs)]
+
+
+class DirSource(object):
+    """ Raw data of a session in a directory. """
+
+    is_archive = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def list_files(self):
+        """ Lists the files of the session (or, if there are none, the files
+        in its subdirectories). """
+        files = sorted([f for f in glob(op.join(self.path, '*')) if op.isfile(f)])
+        if not files:
+            files = sorted([f for f in glob(op.join(self.path, '*', '*'))
+                            if op.isfile(f)])
+        return files
+
+    def copy_files(self, files, dst_dir):
+        """ Copies files to dst_dir and returns the new paths. """
+        out = []
+        for f in files:
+            out.append(op.join(dst_dir, op.basename(f)))
+            shutil.copy2(f, out[-1])
+        return out
+
+
+class ArchiveSource(object):
+    """ Raw data of a session in a (tar or zip) archive, of which members
+    are listed and extracted without unpacking the whole archive.
+
+    Parameters
+    ----------
+    path : str
+        Path to archive
+    prefix : str
+        Directory (within the archive) of the session, e.g. 'ses-1/'
+    """
+
+    is_archive = True
+
+    def __init__(self, path, prefix=''):
+        self.path = path
+        self.prefix = prefix
+
+    def list_files(self):
+        """ Lists the member names of the files of the session (or, if there
+        are none, the files one directory deeper). """
+        rel = [n[len(self.prefix):] for n in _list_archive(self.path)
+               if n.startswith(self.prefix)]
+        files = [r for r in rel if '/' not in r]
+        if not files:
+            files = [r for r in rel if r.count('/') == 1]
+        return sorted(self.prefix + r for r in files)
+
+    def file_sizes(self, files):
+        """ Returns the (uncompressed) sizes of the given members, which are
+        known from the listing of the archive. """
+        sizes = _list_archive_sizes(self.path)
+        return dict((f, sizes[f]) for f in files)
+
+    def copy_files(self, files, dst_dir):
+        """ Streams the given members to dst_dir (in a single pass over the
+        archive) and returns the new paths. """
+        wanted = set(files)
+        out = []
+        if self.path.endswith('.zip'):
+            with zipfile.ZipFile(self.path) as zf:
+                for name in files:
+                    out.append(_copy_member(zf.open(name), name, dst_dir))
+            return out
+
+        # Each wanted member is streamed through extractfile; uncompressed
+        # tars are opened in random-access mode, compressed ones as a stream
+        mode = 'r:' if self.path.endswith('.tar') else 'r|*'
+        with tarfile.open(self.path, mode=mode) as tar:
+            for member in tar:
+                if member.isfile() and _norm(member.name) in wanted:
+                    out.append(_copy_member(tar.extractfile(member),
+                                            member.name, dst_dir))
+        return sorted(out)
+
+
+def _copy_member(f_in, name, dst_dir):
+    dst = op.join(dst_dir, op.basename(name))
+    with f_in, open(dst, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 2 ** 20)
+    return dst
+
+
+def _norm(name):
+    return name[2:] if name.startswith('./') else name
+
+
+def _list_archive(path):
+    """ Lists the names of the files in an archive (without extracting). """
+    return list(_list_archive_sizes(path))
+
+
+def _list_archive_sizes(path):
+    """ Lists the names and (uncompressed) sizes of the files in an
+    archive (without extracting), as an ordered dict. """
+    with _LISTINGS_LOCK:
+        key = (path, os.stat(path).st_mtime)
+        if key not in _LISTINGS:
+            if path.endswith('.zip'):
+                with zipfile.ZipFile(path) as zf:
+                    members = [(i.filename, i.file_size) for i in zf.infolist()
+                               if not i.is_dir()]
+            else:
+                # Streaming mode, so compressed tars are read only once
+                mode = 'r:' if path.endswith('.tar') else 'r|*'
+                with tarfile.open(path, mode=mode) as tar:
+                    members = [(m.name, m.size) for m in tar if m.isfile()]
+            _LISTINGS[key] = OrderedDict((_norm(n), size) for n, size in members)
+
+    return _LISTINGS[key]
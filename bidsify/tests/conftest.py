@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import yaml
+import pytest
+import numpy as np
+import nibabel as nib
+import os.path as op
+from bidsify import bidsify
+
+
+class Dataset(object):
+    """ Raw dataset (in path/raw, with its config in path/raw/config.yml)
+    that is converted to path/bids.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset
+    cfg : dict
+        Config dictionary
+    """
+
+    def __init__(self, path, cfg):
+        self.path = path
+        self.raw_dir = op.join(path, 'raw')
+        self.bids_dir = op.join(path, 'bids')
+        self.cfg_path = op.join(self.raw_dir, 'config.yml')
+        self.cfg = cfg
+        if not op.isdir(self.raw_dir):
+            os.makedirs(self.raw_dir)
+        self.write_cfg()
+
+    def write_cfg(self):
+        """ Writes the (modified) config to the config file. """
+        with open(self.cfg_path, 'w') as f:
+            yaml.safe_dump(self.cfg, f)
+
+    def set_options(self, **options):
+        """ Updates the options in the config file. """
+        self.cfg['options'].update(options)
+        self.write_cfg()
+
+    def run(self, **kwargs):
+        """ Runs bidsify on the dataset (kwargs override the defaults)
+        and returns the index. """
+        kwargs = dict(dict(cfg_path=self.cfg_path, directory=self.raw_dir,
+                           validate=False, out_dir=self.bids_dir), **kwargs)
+        return bidsify(**kwargs)
+
+
+def make_nifti_dataset(path, **options):
+    """ Creates a small (synthetic) dataset with nifti files (one subject
+    with one session) with the given options. """
+
+    sess_dir = op.join(path, 'raw', 'sub-01', 'ses-1')
+    os.makedirs(sess_dir)
+    for name, shape, md in [('sub-01_t13d_T1w', (4, 4, 4), {'a': 1}),
+                            ('sub-01_pioprs_bold', (4, 4, 4, 3),
+                             {'RepetitionTime': 2,
+                              'AcquisitionDateTime': '2019-01-31T10:12:00'}),
+                            ('sub-01_B0_real', (4, 4, 4), {'b': 1}),
+                            ('sub-01_B0', (4, 4, 4), {'c': 1})]:
+        img = nib.Nifti1Image(np.ones(shape, dtype='int16'), np.eye(4))
+        nib.save(img, op.join(sess_dir, name + '.nii.gz'))
+        with open(op.join(sess_dir, name + '.json'), 'w') as f:
+            json.dump(md, f)
+
+    with open(op.join(sess_dir, 'notes.txt'), 'w') as f:
+        f.write('unallocated')
+
+    with open(op.join(sess_dir, 'sub-01_pioprs_log.csv'), 'w') as f:
+        f.write('onset,duration,trial_type\n2.0,1.0,a\n0.0,1.0,b\n')
+
+    cfg = dict(
+        options=dict(dict(mri_ext='nifti', deface=False, n_cores=2), **options),
+        mappings=dict(bold='_bold', T1w='_T1w', phasediff='_phasediff',
+                      magnitude1='_magnitude1', events='_log'),
+        metadata=dict(MagneticFieldStrength=3),
+        anat=dict(t1=dict(id='t13d')),
+        func=dict(metadata=dict(PhaseEncodingDirection='j'),
+                  rest=dict(id='pioprs', task='rest')),
+        fmap=dict(b0=dict(id='B0'))
+    )
+    return Dataset(path, cfg)
+
+
+@pytest.fixture
+def nifti_dataset(tmpdir, monkeypatch):
+    """ Factory of synthetic nifti datasets (see `make_nifti_dataset`) in
+    tmpdir (or a subdirectory), which are converted without FSL. """
+
+    monkeypatch.setenv('TRAVIS', '1')  # no FSL
+
+    def _make(name='', **options):
+        return make_nifti_dataset(op.join(str(tmpdir), name), **options)
+
+    return _make
+
+
+@pytest.fixture
+def dataset(tmpdir, monkeypatch):
+    """ Factory of datasets in tmpdir with a given config, of which the
+    raw files are created by the test, which are converted without FSL. """
+
+    monkeypatch.setenv('TRAVIS', '1')  # no FSL
+    return lambda cfg: Dataset(str(tmpdir), cfg)
@@ -0,0 +1,62 @@
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tarfile
+import numpy as np
+import nibabel as nib
+import os.path as op
+from bidsify.admission import estimate_session, BASE_MEMORY, MEMORY_COPIES
+from bidsify.sources import DirSource, ArchiveSource
+
+NIB_DATA = op.join(op.dirname(nib.__file__), 'tests', 'data')
+
+
+def test_estimate_session(tmpdir):
+    """ Tests estimating the peak disk usage and memory of a session """
+
+    sess_dir = str(tmpdir)
+    for ext in ['.PAR', '.REC']:
+        shutil.copy(op.join(NIB_DATA, 'phantom_varscale' + ext),
+                    op.join(sess_dir, 'sub-01_bold' + ext))
+    with open(op.join(sess_dir, 'sub-01_log.csv'), 'w') as f:
+        f.write('onset,duration\n')
+
+    cfg = dict(options=dict(mri_ext='PAR', deface=False))
+    disk, memory = estimate_session(DirSource(sess_dir), cfg, n_cores=4)
+
+    raw = sum(op.getsize(op.join(sess_dir, f)) for f in os.listdir(sess_dir))
+    img = 64 * 64 * 9 * 3 * 2  # int16
+    assert disk == raw + 2 * img
+    assert memory == BASE_MEMORY + MEMORY_COPIES * img
+
+    cfg['options']['deface'] = True
+    assert estimate_session(DirSource(sess_dir), cfg)[0] == raw + 3 * img
+
+    # Niftis (e.g. of anonymized data) are sized by their header
+    nii = op.join(sess_dir, 'sub-02_T1w.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((10, 10, 10), dtype='float32'), np.eye(4)), nii)
+    cfg['options'].update(mri_ext='nifti', deface=False)
+    disk, memory = estimate_session(DirSource(sess_dir), cfg, n_cores=1)
+    assert memory == BASE_MEMORY + MEMORY_COPIES * 4000
+
+
+def test_estimate_archive_session(tmpdir):
+    """ Tests estimating a session in an archive from its members only """
+
+    archive = op.join(str(tmpdir), 'sub-01.tar')
+    with tarfile.open(archive, 'w') as tar:
+        for ext in ['.PAR', '.REC']:
+            tar.add(op.join(NIB_DATA, 'phantom_varscale' + ext),
+                    arcname='ses-1/sub-01_bold' + ext)
+        big = op.join(str(tmpdir), 'big.REC')
+        with open(big, 'wb') as f:
+            f.write(b'\x00' * 10 ** 6)
+        tar.add(big, arcname='ses-2/sub-01_bold.REC')
+
+    cfg = dict(options=dict(mri_ext='PAR', deface=False))
+    disk, memory = estimate_session(ArchiveSource(archive, prefix='ses-1/'), cfg)
+
+    par, rec = [op.getsize(op.join(NIB_DATA, 'phantom_varscale' + ext))
+                for ext in ['.PAR', '.REC']]
+    assert disk == par + rec + 2 * rec
+    assert memory == BASE_MEMORY + MEMORY_COPIES * rec
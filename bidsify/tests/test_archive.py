@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function
+import os
+import os.path as op
+import tarfile
+import pandas as pd
+from bidsify.archive import BIDSArchive
+
+
+def test_archive(tmpdir):
+    """ Tests streaming sessions into per-subject tar archives """
+
+    out_dir = op.join(str(tmpdir), 'bids')
+    for sub in ['sub-01', 'sub-02']:
+        os.makedirs(op.join(out_dir, sub, 'ses-1', 'anat'))
+        with open(op.join(out_dir, sub, 'ses-1', 'anat', sub + '_T1w.json'), 'w') as f:
+            f.write('{"sub": "%s"}' % sub)
+
+    archive = BIDSArchive(out_dir, mode='subject')
+    for sub in ['sub-01', 'sub-02']:
+        archive.add_session(op.join(out_dir, sub, 'ses-1'))
+        archive.close_subject(sub)
+    archive.close()
+
+    tar_path = archive.get_path('sub-02')
+    with tarfile.open(tar_path) as tar:
+        assert tar.getnames() == ['sub-02/ses-1/anat/sub-02_T1w.json']
+
+    index = pd.read_csv(tar_path + '.index.tsv', sep='\t')
+    with open(tar_path, 'rb') as f:
+        f.seek(index.loc[0, 'offset_data'])
+        assert f.read(index.loc[0, 'size']) == b'{"sub": "sub-02"}'
+
+
+def test_archive_rerun(tmpdir):
+    """ Tests that re-runs do not add duplicate members """
+
+    out_dir = op.join(str(tmpdir), 'bids')
+    os.makedirs(op.join(out_dir, 'sub-01'))
+    session_file = op.join(out_dir, 'sub-01', 'sub-01_T1w.json')
+    participants = op.join(out_dir, 'participants.tsv')
+    for run in range(2):
+        for f in [session_file, participants]:
+            with open(f, 'w') as f_out:
+                f_out.write('run %i' % run)
+
+        archive = BIDSArchive(out_dir)
+        archive.add_session(op.join(out_dir, 'sub-01'))
+        archive.close()
+        archive.write_toplevel([participants])
+
+    with tarfile.open(archive.get_path()) as tar:
+        assert tar.getnames() == ['sub-01/sub-01_T1w.json']
+    assert len(pd.read_csv(archive.get_path() + '.index.tsv', sep='\t')) == 1
+
+    with tarfile.open(archive.get_path('toplevel')) as tar:
+        assert tar.getnames() == ['participants.tsv']
+        assert tar.extractfile('participants.tsv').read() == b'run 1'
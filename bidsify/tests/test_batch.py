@@ -0,0 +1,34 @@
+from __future__ import absolute_import, division, print_function
+import os.path as op
+from shutil import copytree
+from bidsify import bidsify_batch
+
+
+def test_bidsify_batch(tmpdir, nifti_dataset):
+    """ Tests converting multiple datasets with the batch API """
+
+    jobs = []
+    for project in ['a', 'b']:
+        ds = nifti_dataset(project)
+        jobs.append((ds.cfg_path, ds.raw_dir, ds.bids_dir))
+
+    # Project a has two sessions
+    raw_sub = op.join(str(tmpdir), 'a', 'raw', 'sub-01')
+    copytree(op.join(raw_sub, 'ses-1'), op.join(raw_sub, 'ses-2'))
+    jobs.append(('non-existing.yml', str(tmpdir), op.join(str(tmpdir), 'c')))
+
+    results = list(bidsify_batch(jobs, n_parallel=2))
+    sessions = [(r['job'], r['session']) for r in results if r['session'] is not None]
+    assert sorted(sessions) == [(0, 'sub-01/ses-1'), (0, 'sub-01/ses-2'),
+                                (1, 'sub-01/ses-1')]
+
+    done = dict((r['job'], r) for r in results if r['session'] is None)
+    assert done[0]['status'] == 'done' and done[1]['status'] == 'done'
+    assert done[2]['status'] == 'failed' and 'non-existing.yml' in done[2]['error']
+    assert len(done[0]['index'].get(suffix='bold', extension='.nii.gz')) == 2
+
+    for r in results:
+        if r['session'] is not None:
+            assert r['status'] == 'converted'
+            assert all(op.isfile(f) for f in r['outputs'])
+            assert any(f.endswith('_task-rest_bold.nii.gz') for f in r['outputs'])
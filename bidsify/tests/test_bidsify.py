@@ -1,9 +1,18 @@
 from __future__ import absolute_import, division, print_function
 import os
+import sys
+import json
+import yaml
 import pytest
+import numpy as np
+import pandas as pd
+import nibabel as nib
 import os.path as op
-from shutil import rmtree
+from shutil import rmtree, copytree
 from bidsify import bidsify
+import bidsify.main as bidsify_main
+from bidsify.main import _infer_session_cfg, _reorient_file
+from bidsify.manifest import hash_file, _DIGESTS
 
 data_path = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'data')
 testdata_path = op.join(data_path, 'test_data')
@@ -45,3 +54,298 @@ def test_bidsify(path_to_data):
     
     if op.isdir(unall_dir):
         rmtree(unall_dir)
+
+
+def test_bidsify_nifti(nifti_dataset):
+    """ Tests bidsify on a synthetic nifti dataset """
+
+    ds = nifti_dataset()
+    bids_dir = ds.bids_dir
+    index = ds.run()
+
+    sess_dir = op.join(bids_dir, 'sub-01', 'ses-1')
+    for f in ['anat/sub-01_ses-1_T1w.nii.gz',
+              'func/sub-01_ses-1_task-rest_bold.nii.gz',
+              'fmap/sub-01_ses-1_phasediff.nii.gz',
+              'fmap/sub-01_ses-1_magnitude1.nii.gz']:
+        assert op.isfile(op.join(sess_dir, f))
+
+    assert op.isfile(op.join(bids_dir, 'unallocated', 'sub-01', 'ses-1', 'notes.txt'))
+
+    events = op.join(sess_dir, 'func', 'sub-01_ses-1_task-rest_events.tsv')
+    assert open(events).read().splitlines()[1] == '0.0000\t1.0000\tb'
+
+    with open(op.join(sess_dir, 'func', 'sub-01_ses-1_task-rest_bold.json')) as f:
+        md = json.load(f)
+    assert md['TaskName'] == 'rest'
+    assert md['PhaseEncodingDirection'] == 'j'
+
+    with open(op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.json')) as f:
+        md = json.load(f)
+    assert md['IntendedFor'] == ['ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz']
+
+    scans = pd.read_csv(op.join(sess_dir, 'sub-01_ses-1_scans.tsv'), sep='\t')
+    assert len(scans) == 4
+    bold = scans[scans['filename'] == 'func/sub-01_ses-1_task-rest_bold.nii.gz'].iloc[0]
+    assert bold['source'] == 'sub-01_pioprs_bold.nii.gz'
+    assert bold['n_volumes'] == 3
+    assert bold['acq_time'] == '2019-01-31T10:12:00'
+
+    assert op.isfile(op.join(bids_dir, '.bidsify_index.sqlite'))
+    assert not [f for f in _DIGESTS if f.startswith(op.abspath(ds.path))]
+    bold = index.get(suffix='bold', extension='.nii.gz', return_type='dict')
+    assert len(bold) == 1
+    assert index.get(suffix='events') == \
+        [op.join(bids_dir, 'sub-01/ses-1/func/sub-01_ses-1_task-rest_events.tsv')]
+    assert bold[0]['task'] == 'rest'
+    assert bold[0]['metadata']['PhaseEncodingDirection'] == 'j'
+    assert index.get(datatype='fmap', suffix='phasediff', extension='.nii.gz') == \
+        [op.join(bids_dir, 'sub-01/ses-1/fmap/sub-01_ses-1_phasediff.nii.gz')]
+
+
+def test_bidsify_scratch_dir(tmpdir, nifti_dataset):
+    """ Tests processing sessions in a scratch dir """
+
+    ds = nifti_dataset()
+    bids_dir = ds.bids_dir
+    scratch_dir = op.join(str(tmpdir), 'scratch')
+    index = ds.run(scratch_dir=scratch_dir)
+
+    sess_dir = op.join(bids_dir, 'sub-01', 'ses-1')
+    assert op.isfile(op.join(sess_dir, 'func', 'sub-01_ses-1_task-rest_bold.nii.gz'))
+    assert op.isfile(op.join(bids_dir, 'unallocated', 'sub-01', 'ses-1', 'notes.txt'))
+    with open(op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.json')) as f:
+        md = json.load(f)
+    assert md['IntendedFor'] == ['ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz']
+
+    assert os.listdir(scratch_dir) == []
+    assert index.get(suffix='T1w', extension='.nii.gz') == \
+        [op.join(bids_dir, 'sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz')]
+
+
+def test_bidsify_filters(nifti_dataset):
+    """ Tests converting selected subjects and re-converting datatypes """
+
+    ds = nifti_dataset()
+    raw_dir, bids_dir = ds.raw_dir, ds.bids_dir
+    copytree(op.join(raw_dir, 'sub-01'), op.join(raw_dir, 'sub-02'))
+
+    ds.run(participant_label=['sub-01'])
+    assert op.isdir(op.join(bids_dir, 'sub-01', 'ses-1'))
+    assert not op.isdir(op.join(bids_dir, 'sub-02'))
+
+    # Fix the metadata of the fieldmap and only re-convert the fieldmaps
+    with open(op.join(raw_dir, 'sub-01', 'ses-1', 'sub-01_B0_real.json'), 'w') as f:
+        json.dump({'b': 2}, f)
+
+    sess_dir = op.join(bids_dir, 'sub-01', 'ses-1')
+    bold = op.join(sess_dir, 'func', 'sub-01_ses-1_task-rest_bold.nii.gz')
+    mtime = os.stat(bold).st_mtime_ns
+    index = ds.run(participant_label='0[1]', session_label=['1'],
+                   datatypes=['fmap'])
+    assert not op.isdir(op.join(bids_dir, 'sub-02'))
+    assert os.stat(bold).st_mtime_ns == mtime
+
+    # Sessions that were not converted yet are not converted partially
+    ds.run(participant_label='02', datatypes=['fmap'])
+    assert not op.isdir(op.join(bids_dir, 'sub-02'))
+    with open(op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.json')) as f:
+        md = json.load(f)
+    assert md['b'] == 2
+    assert md['IntendedFor'] == ['ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz']
+    assert not [f for f in os.listdir(bids_dir) if f.startswith('.bidsify_partial')]
+
+    scans = pd.read_csv(op.join(sess_dir, 'sub-01_ses-1_scans.tsv'), sep='\t')
+    assert len(scans) == 4
+    assert index.get(sub='01', suffix='phasediff', extension='.nii.gz') == \
+        [op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.nii.gz')]
+    assert len(index.get(sub='01', suffix='bold')) == 2
+
+    # The manifest covers the old and new files
+    with open(op.join(sess_dir, '.bidsify_manifest.sha256')) as f:
+        manifest = dict(line.split()[::-1] for line in f)
+    assert sorted(manifest) == sorted(
+        op.relpath(op.join(d, f), bids_dir) for d, _, fs in os.walk(sess_dir)
+        for f in fs if not f.startswith('.'))
+    assert manifest['sub-01/ses-1/fmap/sub-01_ses-1_phasediff.json'] == \
+        hash_file(op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.json'))
+
+    with pytest.raises(ValueError):
+        ds.run(datatypes=['foo'])
+
+
+def test_bidsify_inherit_metadata(nifti_dataset):
+    """ Tests writing shared metadata to dataset-level sidecars """
+
+    ds = nifti_dataset(inherit_metadata=True)
+    bids_dir = ds.bids_dir
+    index = ds.run()
+
+    with open(op.join(bids_dir, 'task-rest_bold.json')) as f:
+        md = json.load(f)
+    assert md['TaskName'] == 'rest'
+    assert md['PhaseEncodingDirection'] == 'j'
+    assert md['MagneticFieldStrength'] == 3
+
+    with open(op.join(bids_dir, 'T1w.json')) as f:
+        md = json.load(f)
+    assert md['MagneticFieldStrength'] == 3
+    assert 'TaskName' not in md
+
+    func = op.join(bids_dir, 'sub-01', 'ses-1', 'func')
+    with open(op.join(func, 'sub-01_ses-1_task-rest_bold.json')) as f:
+        md = json.load(f)
+    assert 'TaskName' not in md
+    assert md['RepetitionTime'] == 2
+
+    with open(op.join(bids_dir, 'sub-01', 'ses-1', 'fmap', 'sub-01_ses-1_phasediff.json')) as f:
+        md = json.load(f)
+    assert md['IntendedFor'] == ['ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz']
+
+    # The index has all (inherited) metadata
+    bold = index.get(suffix='bold', extension='.nii.gz', return_type='dict')[0]
+    assert bold['metadata']['PhaseEncodingDirection'] == 'j'
+
+
+def test_bidsify_compression(nifti_dataset):
+    """ Tests storing niftis (un)compressed per datatype """
+
+    ds = nifti_dataset(compression=dict(func=0, magnitude1=0, default=1))
+    bids_dir = ds.bids_dir
+    index = ds.run()
+
+    sess_dir = op.join(bids_dir, 'sub-01', 'ses-1')
+    for f in ['anat/sub-01_ses-1_T1w.nii.gz',
+              'func/sub-01_ses-1_task-rest_bold.nii',
+              'fmap/sub-01_ses-1_phasediff.nii.gz',
+              'fmap/sub-01_ses-1_magnitude1.nii']:
+        assert op.isfile(op.join(sess_dir, f))
+        assert not op.isfile(op.join(sess_dir, f[:-3] if f.endswith('.gz') else f + '.gz'))
+
+    bold = op.join(sess_dir, 'func', 'sub-01_ses-1_task-rest_bold.nii')
+    assert nib.load(bold).shape == (4, 4, 4, 3)
+    with open(op.join(sess_dir, 'fmap', 'sub-01_ses-1_phasediff.json')) as f:
+        md = json.load(f)
+    assert md['IntendedFor'] == ['ses-1/func/sub-01_ses-1_task-rest_bold.nii']
+
+    scans = pd.read_csv(op.join(sess_dir, 'sub-01_ses-1_scans.tsv'), sep='\t')
+    assert 'func/sub-01_ses-1_task-rest_bold.nii' in scans['filename'].tolist()
+    assert index.get(suffix='bold', extension='.nii') == [bold]
+
+    with open(op.join(sess_dir, '.bidsify_manifest.sha256')) as f:
+        manifest = dict(line.split()[::-1] for line in f)
+    assert manifest['sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii'] == hash_file(bold)
+
+    ds.set_options(compression=dict(func=10))
+    with pytest.raises(ValueError):
+        ds.run()
+
+
+def test_bidsify_continue_on_error(nifti_dataset):
+    """ Tests isolating failed sessions and re-running them """
+
+    ds = nifti_dataset()
+    raw_dir, bids_dir = ds.raw_dir, ds.bids_dir
+
+    # The second subject has a file that matches two mappings
+    sess_dir = op.join(raw_dir, 'sub-02', 'ses-1')
+    copytree(op.join(raw_dir, 'sub-01', 'ses-1'), sess_dir)
+    bad = op.join(sess_dir, 'sub-02_pioprs_bold_T1w.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype='int16'), np.eye(4)), bad)
+
+    with pytest.raises(ValueError):
+        ds.run()
+    rmtree(bids_dir)
+
+    ds.run(on_error='continue')
+    assert op.isdir(op.join(bids_dir, 'sub-01', 'ses-1'))
+    assert not op.isdir(op.join(bids_dir, 'sub-02'))
+    quarantine = op.join(bids_dir, '.bidsify_quarantine', 'sub-02', 'ses-1')
+    assert op.isdir(quarantine)
+    participants = pd.read_csv(op.join(bids_dir, 'participants.tsv'), sep='\t')
+    assert participants['participant_id'].tolist() == ['sub-01']
+
+    with open(op.join(bids_dir, '.bidsify_failures.json')) as f:
+        entries = json.load(f)
+    assert len(entries) == 1
+    assert entries[0]['session'] == op.join('sub-02', 'ses-1')
+    assert entries[0]['source'] == sess_dir
+    assert entries[0]['error'] == 'ValueError'
+    assert entries[0]['task'].startswith('rename')
+    assert entries[0]['quarantine'] == quarantine
+
+    # Fix the error and only re-run the failed session
+    os.remove(bad)
+    rmtree(op.join(bids_dir, 'sub-01'))
+    index = ds.run(rerun_failed=True)
+    assert not op.isdir(op.join(bids_dir, 'sub-01'))
+    assert op.isfile(op.join(bids_dir, 'sub-02', 'ses-1', 'anat',
+                             'sub-02_ses-1_T1w.nii.gz'))
+    assert not op.isfile(op.join(bids_dir, '.bidsify_failures.json'))
+    assert index.get(sub='02', suffix='T1w', extension='.nii.gz')
+
+
+def test_infer_session_cfg_cache(tmpdir, monkeypatch):
+    """ Tests reuse of the config of a known (Spinoza) protocol """
+
+    with open(op.join(data_path, 'spinoza_cfg.yml')) as f:
+        cfg = yaml.safe_load(f)
+    cfg['options'] = dict(spinoza_data=True)
+
+    calls = []
+
+    def _counted(name):
+        func = getattr(bidsify_main, name)
+
+        def _wrapper(*args):
+            calls.append(name)
+            return func(*args)
+        return _wrapper
+
+    for name in ['_infer_dtype_elements', '_extract_metadata_from_cfg']:
+        monkeypatch.setattr(bidsify_main, name, _counted(name))
+
+    cache = dict()
+    cfgs = []
+    for sub in ['sub-01', 'sub-02']:
+        sub_dir = op.join(str(tmpdir), sub)
+        os.makedirs(sub_dir)
+        for fname in ['%s_task-rest_bold.nii', '%s_acq-MPRAGE_T1w.nii',
+                      '%s_task-rest-acq-AP_topup.nii']:
+            open(op.join(sub_dir, fname % sub), 'w').close()
+
+        renamed = dict()
+        cfgs.append(_infer_session_cfg(sub_dir, cfg, renamed=renamed,
+                                       cache=cache))
+        # Typos should still be fixed for every session
+        assert op.isfile(op.join(sub_dir, '%s_dir-rest_acq-AP_topup.nii' % sub))
+        assert len(renamed) == 2
+
+    # The second session gets the same config, without inferring it again
+    assert len(cache) == 1
+    assert cfgs[1] is cfgs[0]
+    assert calls == ['_infer_dtype_elements', '_extract_metadata_from_cfg']
+    assert 'func' not in cfg  # not modified
+    assert cfgs[0]['func']['bold_1'] == dict(task='rest', id='task-rest')
+    assert cfgs[0]['fmap']['epi_1']['dir'] == 'rest'
+    assert sorted(cfgs[0]['data_types']) == ['anat', 'fmap', 'func']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='fake FSL is a shell script')
+def test_reorient_failure(tmpdir, monkeypatch):
+    """ Tests that an image is not replaced by a partial reoriented image """
+
+    bin_dir = op.join(str(tmpdir), 'bin')
+    os.makedirs(bin_dir)
+    with open(op.join(bin_dir, 'fslreorient2std'), 'w') as f:
+        f.write('#!/bin/sh\necho partial > "$2"\nexit 1\n')
+    os.chmod(op.join(bin_dir, 'fslreorient2std'), 0o755)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+
+    f = op.join(str(tmpdir), 'sub-01_T1w.nii')
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype='int16'), np.eye(4)), f)
+    data = hash_file(f)
+    with pytest.raises(ValueError, match='fslreorient2std'):
+        _reorient_file(f)
+    assert hash_file(f) == data
+    assert sorted(os.listdir(str(tmpdir))) == ['bin', 'sub-01_T1w.nii']
@@ -0,0 +1,153 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import shutil
+import numpy as np
+import nibabel as nib
+import os.path as op
+import bidsify.main as bidsify_main
+import bidsify.dedup as bidsify_dedup
+from glob import glob
+from bidsify.cache import ConversionCache
+
+
+def test_cache_lru(tmpdir):
+    """ Tests storing, restoring, and evicting cache entries """
+
+    cache = ConversionCache(op.join(str(tmpdir), 'cache'), max_size=2.5e-6)  # ~2.7 kB
+    raw = op.join(str(tmpdir), 'raw.dcm')
+    out = op.join(str(tmpdir), 'out')
+    os.makedirs(out)
+
+    keys = []
+    for i in range(3):
+        with open(raw, 'wb') as f:
+            f.write(bytes([i]) * 1000)
+        keys.append(cache.key([raw], dict(compress=True)))
+        cache.put(keys[-1], {'x.nii.gz': raw, 'x.json': b'{}'}, info=dict(i=i))
+        if i == 1:
+            # Makes the first entry the most recently used one
+            assert cache.get(keys[0], out)[1] == dict(i=0)
+            os.utime(cache._entry_path(keys[0]), (1e10, 1e10))
+            os.utime(cache._entry_path(keys[1]), (1, 1))
+
+    assert cache.key([raw], dict(compress=False)) != keys[-1]
+    assert cache.get(keys[1], out) == (None, None)  # evicted
+    outputs, info = cache.get(keys[2], out)
+    assert info == dict(i=2)
+    assert sorted(op.basename(f) for f in outputs) == ['x.json', 'x.nii.gz']
+    assert not cache._pinned  # unpinned after restoring
+    with open(op.join(out, 'x.nii.gz'), 'rb') as f:
+        assert f.read() == bytes([2]) * 1000
+
+    # The json is stored only once
+    assert len(os.listdir(op.join(str(tmpdir), 'cache', 'objects'))) == 3
+
+    # Objects that are being restored are not evicted
+    cache._pinned.update(['x' * 64])
+    open(cache._object_path('x' * 64), 'wb').close()
+    cache._evict()
+    assert op.isfile(cache._object_path('x' * 64))
+
+
+def test_bidsify_cache(tmpdir, monkeypatch, dataset):
+    """ Tests re-running bidsify with images from the cache """
+
+    ds = dataset(dict(
+        options=dict(mri_ext='dcm', deface=False,
+                     cache_dir=op.join(str(tmpdir), 'cache')),
+        mappings=dict(bold='_bold'),
+        metadata=dict(MagneticFieldStrength=3),
+        func=dict(rest=dict(id='pioprs', task='rest'))
+    ))
+    sess_dir = op.join(ds.raw_dir, 'sub-01')
+    os.makedirs(sess_dir)
+    with open(op.join(sess_dir, 'sub-01_pioprs_bold.dcm'), 'wb') as f:
+        f.write(b'raw')
+
+    converted = []
+
+    def _fake_convert(f, cfg, compress=True, scan_info=None):
+        converted.append(f)
+        base = op.splitext(f)[0]
+        img = nib.Nifti1Image(np.ones((4, 4, 4, 2), dtype='int16'), np.eye(4))
+        nib.save(img, base + '.nii')
+        with open(base + '.json', 'w') as f_out:
+            json.dump(dict(RepetitionTime=2), f_out)
+        os.remove(f)
+        return [base + '.json', base + '.nii']
+
+    hashed, fingerprints = [], []
+
+    def _hash_data(data_file):
+        hashed.append(data_file)
+        return hash_data(data_file)
+
+    def _key(self, files, options, fingerprint=None):
+        fingerprints.append(fingerprint)
+        return key(self, files, options, fingerprint=fingerprint)
+
+    hash_data, key = bidsify_dedup._hash_data, ConversionCache.key
+    monkeypatch.setattr(bidsify_main, 'convert_mri_file', _fake_convert)
+    monkeypatch.setattr(bidsify_dedup, '_hash_data', _hash_data)
+    monkeypatch.setattr(ConversionCache, 'key', _key)
+    bids_dir = ds.bids_dir
+    bold = op.join(bids_dir, 'sub-01', 'func', 'sub-01_task-rest_bold')
+    ds.run()
+    assert len(converted) == 1
+    # The raw data is read once, for the fingerprint of deduplication
+    assert len(hashed) == 1 and fingerprints[0] is not None
+    with open(bold + '.nii.gz', 'rb') as f:
+        data = f.read()
+
+    # Change the config and re-run
+    shutil.rmtree(bids_dir)
+    ds.cfg['func']['rest']['task'] = 'resting'
+    ds.write_cfg()
+    ds.run()
+    assert len(converted) == 1
+    assert len(hashed) == 2
+    bold = bold.replace('rest', 'resting')
+    with open(bold + '.nii.gz', 'rb') as f:
+        assert f.read() == data
+
+    with open(bold + '.json') as f:
+        md = json.load(f)
+    assert md['TaskName'] == 'resting'
+    assert md['RepetitionTime'] == 2
+    assert not glob(op.join(bids_dir, 'sub-01', 'func', '*.nii'))
+
+
+def test_bidsify_cache_par_engine(tmpdir, monkeypatch, dataset):
+    """ Tests that images of another PAR engine are not restored """
+
+    ds = dataset(dict(
+        options=dict(mri_ext='PAR', deface=False, deduplicate=False,
+                     cache_dir=op.join(str(tmpdir), 'cache')),
+        mappings=dict(bold='_bold'),
+        func=dict(rest=dict(id='pioprs', task='rest'))
+    ))
+    sess_dir = op.join(ds.raw_dir, 'sub-01')
+    os.makedirs(sess_dir)
+    for ext in ['PAR', 'REC']:
+        with open(op.join(sess_dir, 'sub-01_pioprs_bold.' + ext), 'wb') as f:
+            f.write(b'raw')
+
+    engines = []
+
+    def _fake_convert(f, cfg, compress=True, scan_info=None):
+        engines.append(cfg['options']['par_engine'])
+        base = op.splitext(f)[0]
+        img = nib.Nifti1Image(np.ones((4, 4, 4, 2), dtype='int16'), np.eye(4))
+        nib.save(img, base + '.nii')
+        os.remove(f)
+        os.remove(base + '.REC')
+        return [base + '.nii']
+
+    monkeypatch.setattr(bidsify_main, 'convert_mri_file', _fake_convert)
+    for engine in ['dcm2niix', 'nibabel', 'nibabel']:
+        ds.set_options(par_engine=engine)
+        ds.run()
+        shutil.rmtree(ds.bids_dir)
+
+    assert engines == ['dcm2niix', 'nibabel']  # the last run is a cache hit
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function
+import os
+import os.path as op
+from bidsify.cache import ConversionCache
+from bidsify.dedup import ScanRegistry, find_duplicate_scans, fingerprint_scan
+
+
+def _write_par_rec(path, name, comment, data):
+    with open(op.join(path, name + '.PAR'), 'w') as f:
+        f.write('# Dataset name: %s\n. Protocol name : bold\n' % comment)
+    with open(op.join(path, name + '.REC'), 'wb') as f:
+        f.write(data)
+    return op.join(path, name + '.PAR')
+
+
+def test_find_duplicate_scans(tmpdir):
+    """ Tests detection of (near-)exact duplicate PAR/RECs """
+
+    path = str(tmpdir)
+    cfg = dict(options=dict(mri_ext='PAR'))
+    par1 = _write_par_rec(path, 'bold', 'export1', b'\x00' * 100)
+    par2 = _write_par_rec(path, 'bold_resent', 'export2', b'\x00' * 100)
+    par3 = _write_par_rec(path, 'other', 'export1', b'\x01' * 100)
+    files = [par1, par2, par3] + [f.replace('.PAR', '.REC') for f in [par1, par2, par3]]
+
+    registry = ScanRegistry()
+    to_skip = find_duplicate_scans(files, cfg, 'sub-01', registry)
+    assert to_skip == [par2, par2.replace('.PAR', '.REC')]
+
+    # Across sessions, duplicates are reported but still converted
+    assert find_duplicate_scans([par1], cfg, 'sub-02', registry) == []
+    assert [r['kind'] for r in registry.records] == ['within-session', 'across-sessions']
+
+    # Files of earlier sessions may be removed (e.g. temporary copies)
+    [os.remove(f) for f in files]
+    par4 = _write_par_rec(path, 'bold_again', 'export3', b'\x00' * 100)
+    assert find_duplicate_scans([par4], cfg, 'sub-03', registry) == []
+    assert registry.records[-1]['duplicate_of'] == op.join('sub-01', 'bold.PAR')
+
+
+def test_fingerprints_cache_key(tmpdir):
+    """ Tests reusing the fingerprints of raw files for the cache key """
+
+    path = str(tmpdir)
+    cfg = dict(options=dict(mri_ext='PAR'))
+    par1 = _write_par_rec(path, 'bold', 'export1', b'\x00' * 100)
+    par2 = _write_par_rec(path, 'other', 'export1', b'\x01' * 100)
+    files = [par1, par2] + [f.replace('.PAR', '.REC') for f in [par1, par2]]
+
+    fingerprints = dict()
+    find_duplicate_scans(files, cfg, 'sub-01', fingerprints=fingerprints)
+    assert sorted(fingerprints) == ['bold.PAR', 'other.PAR']
+    assert fingerprints['bold.PAR'] == fingerprint_scan(par1, 'PAR')
+
+    cache = ConversionCache(op.join(path, 'cache'))
+    raw = [par1, par1.replace('.PAR', '.REC')]
+    key = cache.key(raw, dict(compress=True), fingerprint=fingerprints['bold.PAR'])
+    assert key != cache.key(raw, dict(compress=True),
+                            fingerprint=fingerprints['other.PAR'])
+
+    # The raw data is not read again
+    [os.remove(f) for f in files]
+    assert cache.key(raw, dict(compress=True),
+                     fingerprint=fingerprints['bold.PAR']) == key
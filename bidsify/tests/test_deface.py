@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import pytest
+import os.path as op
+import numpy as np
+import nibabel as nib
+from bidsify.deface import select_reference, _apply_facemask, _pydeface_file
+
+
+def test_select_reference():
+    """ Tests selection of the session reference for defacing """
+
+    files = ['sub-01_magnitude1.nii.gz', 'sub-01_FLAIR.nii.gz',
+             'sub-01_T1w.nii.gz']
+    assert select_reference(files) == 'sub-01_T1w.nii.gz'
+    assert select_reference(files[:2]) == 'sub-01_FLAIR.nii.gz'
+    assert select_reference(files[:1]) == 'sub-01_magnitude1.nii.gz'
+
+
+def test_apply_facemask(tmpdir):
+    """ Tests applying a facemask to a 4D image """
+
+    data = np.ones((4, 4, 4, 2), dtype='int16')
+    f = op.join(str(tmpdir), 'sub-01_magnitude1.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), f)
+
+    mask = np.ones((4, 4, 4), dtype='uint8')
+    mask[0] = 0
+    mask_file = op.join(str(tmpdir), 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+
+    _apply_facemask(f, mask_file)
+    defaced = nib.load(f).get_fdata()
+    assert defaced[0].sum() == 0
+    assert defaced[1:].sum() == 3 * 4 * 4 * 2
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='fake pydeface is a shell script')
+def test_pydeface_failure(tmpdir, monkeypatch):
+    """ Tests that an image is not kept as is if pydeface fails """
+
+    bin_dir = op.join(str(tmpdir), 'bin')
+    os.makedirs(bin_dir)
+    with open(op.join(bin_dir, 'pydeface'), 'w') as f:
+        # Writes a partial output and fails
+        f.write('#!/bin/sh\necho partial > "$3"\nexit 1\n')
+    os.chmod(op.join(bin_dir, 'pydeface'), 0o755)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+
+    f = op.join(str(tmpdir), 'sub-01_T1w.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype='int16'), np.eye(4)), f)
+    with pytest.raises(ValueError, match='pydeface'):
+        _pydeface_file(f)
+    assert sorted(os.listdir(str(tmpdir))) == ['bin', 'sub-01_T1w.nii.gz']
@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+import os.path as op
+import pytest
+from bidsify.layout import BIDSIndex, FieldmapTargets, InheritedMetadata, parse_bids_name
+
+
+def test_parse_bids_name():
+    """ Tests parsing of BIDS filenames """
+
+    info = parse_bids_name('sub-01_ses-1_task-rest_run-1_bold.nii.gz')
+    assert info == dict(sub='01', ses='1', task='rest', run='1',
+                        suffix='bold', extension='.nii.gz')
+
+
+def test_bids_index(tmpdir):
+    """ Tests incremental saving and loading of the index """
+
+    root = str(tmpdir)
+    index = BIDSIndex(root)
+    func = op.join(root, 'sub-01', 'func')
+    index.add_file(op.join(func, 'sub-01_task-rest_bold.nii.gz'))
+    index.add_file(op.join(func, 'sub-01_task-rest_bold.json'))
+    index.add_file(op.join(func, 'sub-01_task-nback_bold.nii.gz'))
+    index.update_metadata(op.join(func, 'sub-01_task-rest_bold.json'),
+                          dict(TaskName='rest', SliceTiming=[0, 1]))
+    index.save()
+
+    index.remove_file(op.join(func, 'sub-01_task-nback_bold.nii.gz'))
+    index.save()
+
+    loaded = BIDSIndex.load(root)
+    assert len(loaded) == 2
+    rows = loaded.get(return_type='dict', extension='.nii.gz', TaskName='rest')
+    assert len(rows) == 1
+    assert rows[0]['datatype'] == 'func'
+    assert 'SliceTiming' not in rows[0]['metadata']
+    assert loaded.get(task=['nback']) == []
+
+
+def test_fieldmap_targets(tmpdir):
+    """ Tests resolving the IntendedFor field of fieldmaps """
+
+    index = BIDSIndex(str(tmpdir))
+    ses = op.join(str(tmpdir), 'sub-01', 'ses-1')
+    for fname, acq_time in [('func/sub-01_ses-1_task-AP_acq-mb_run-1_bold.nii.gz', '10:00:00'),
+                            ('func/sub-01_ses-1_task-AP_acq-mb_run-2_bold.nii.gz', '10:30:00.5'),
+                            ('dwi/sub-01_ses-1_acq-Dirs64_dwi.nii.gz', None)]:
+        index.add_file(op.join(ses, fname))
+        if acq_time is not None:
+            index.update_metadata(op.join(ses, fname), dict(AcquisitionTime=acq_time))
+
+    targets = FieldmapTargets(index.get(return_type='dict'))
+    assert targets.match('sub-01_ses-1_phasediff.json') == [
+        'ses-1/func/sub-01_ses-1_task-AP_acq-mb_run-1_bold.nii.gz',
+        'ses-1/func/sub-01_ses-1_task-AP_acq-mb_run-2_bold.nii.gz']
+    assert targets.match('sub-01_ses-1_acq-mb_dir-AP_run-2_epi.json') == [
+        'ses-1/func/sub-01_ses-1_task-AP_acq-mb_run-2_bold.nii.gz']
+    assert targets.match('sub-01_ses-1_acq-Dirs64_dir-PA_epi.json') == [
+        'ses-1/dwi/sub-01_ses-1_acq-Dirs64_dwi.nii.gz']
+    assert targets.match('sub-01_ses-1_acq-Dirs64_dir-PA_run-1_epi.json') == [
+        'ses-1/dwi/sub-01_ses-1_acq-Dirs64_dwi.nii.gz']
+    assert targets.match('sub-01_ses-1_acq-mb_dir-PA_epi.json') == []
+
+    with pytest.warns(UserWarning):
+        intended_for = targets.match('sub-01_ses-1_acq-mb_dir-AP_epi.json')
+    assert intended_for == ['ses-1/func/sub-01_ses-1_task-AP_acq-mb_run-1_bold.nii.gz']
+
+    targets = FieldmapTargets(index.get(return_type='dict'), nearest=True)
+    intended_for = targets.match('sub-01_ses-1_acq-mb_dir-AP_epi.json', acq_time='10:25:00')
+    assert intended_for == ['ses-1/func/sub-01_ses-1_task-AP_acq-mb_run-2_bold.nii.gz']
+
+
+def test_inherited_metadata(tmpdir):
+    """ Tests sharing metadata through dataset-level sidecars """
+
+    inherited = InheritedMetadata()
+    md = dict(MagneticFieldStrength=3, EchoTime=0.03)
+    assert inherited.share('sub-01_task-rest_run-1_bold.json', md) == md
+
+    # Only fields with the same value are inherited
+    md2 = dict(MagneticFieldStrength=3, EchoTime=0.02)
+    assert inherited.share('sub-02_task-rest_bold.json', md2) == dict(MagneticFieldStrength=3)
+
+    # A sidecar that overlaps with another one is not created
+    assert inherited.share('sub-01_T1w.json', md) == md
+    assert inherited.share('sub-01_acq-mp2rage_T1w.json', md) == md
+    inherited = InheritedMetadata()
+    assert inherited.share('sub-01_acq-mp2rage_T1w.json', md) == md
+    assert inherited.share('sub-01_T1w.json', md) == dict()
+    assert [name for name, _ in inherited.items()] == ['acq-mp2rage_T1w.json']
+
+    # Sidecars of earlier runs are kept
+    with open(op.join(str(tmpdir), 'task-rest_bold.json'), 'w') as f:
+        f.write('{"EchoTime": 0.03}')
+    inherited = InheritedMetadata(str(tmpdir))
+    assert inherited.share('sub-03_task-rest_bold.json', md2) == dict()
+    assert inherited.items() == [('task-rest_bold.json', dict(EchoTime=0.03))]
@@ -0,0 +1,65 @@
+from __future__ import absolute_import, division, print_function
+import os.path as op
+import pytest
+import numpy as np
+import pandas as pd
+from bidsify.log2tsv import convert_log
+
+PRESENTATION_LOG = """Scenario - workingmemory
+Logfile written - 01/01/2019 12:00:00
+
+Subject\tTrial\tEvent Type\tCode\tTime\tTTime\tUncertainty\tDuration\tUncertainty\tReqTime\tReqDur\tStim Type\tPair Index
+sub01\t1\tPicture\tfix\t5000\t0\t1\t20000\t2\t0\tnext\tother\t0
+sub01\t2\tPulse\t30\t15000\t0\t1
+sub01\t3\tPicture\tface\t35000\t0\t1\t10000\t2\t0\tnext\tother\t0
+sub01\t3\tResponse\t1\t40000\t5000\t1
+sub01\t4\tPulse\t30\t35000\t0\t1
+
+Event Type\tCode\tType\tResponse\tRT\tRT Uncertainty\tTime
+Picture\tface\thit\t1\t5000\t1\t35000
+"""
+
+
+def test_convert_presentation_log(tmpdir):
+    """ Tests converting a Presentation logfile to events """
+
+    f = op.join(str(tmpdir), 'sub-01_task-wm_events.log')
+    with open(f, 'w') as f_out:
+        f_out.write(PRESENTATION_LOG)
+
+    f_tsv = convert_log(f)
+    assert f_tsv == op.join(str(tmpdir), 'sub-01_task-wm_events.tsv')
+    assert not op.isfile(f)
+
+    events = pd.read_csv(f_tsv, sep='\t')
+    assert events.columns.tolist()[:3] == ['onset', 'duration', 'trial_type']
+    np.testing.assert_allclose(events['onset'], [-1, 2, 2.5])
+    assert events['trial_type'].tolist() == ['fix', 'face', '1']
+    assert events['duration'].iloc[1] == 1
+    assert np.isnan(events['duration'].iloc[2])
+
+    # A truncated event table is not converted
+    f = op.join(str(tmpdir), 'sub-01_task-wm_run-2_events.log')
+    with open(f, 'w') as f_out:
+        f_out.write('\n'.join(PRESENTATION_LOG.splitlines()[:3]) + '\nSubject\tTrial\n')
+    with pytest.warns(UserWarning):
+        assert convert_log(f) is None
+
+
+def test_convert_table_log(tmpdir):
+    """ Tests converting a (PsychoPy-like) csv-file to events """
+
+    f = op.join(str(tmpdir), 'sub-01_task-wm_events.csv')
+    df = pd.DataFrame({'stim.started': [12.5, 10.5, np.nan],
+                       'trigger.started': [np.nan, 10.0, np.nan],
+                       'condition': ['a', 'b', None],
+                       'resp.rt': [0.5, 0.7, None]})
+    df.to_csv(f, index=False)
+
+    options = dict(onset='stim.started', trial_type='condition',
+                   trigger_column='trigger.started')
+    events = pd.read_csv(convert_log(f, options), sep='\t')
+    np.testing.assert_allclose(events['onset'], [0.5, 2.5])
+    assert events['trial_type'].tolist() == ['b', 'a']
+    assert events.columns.tolist() == ['onset', 'duration', 'trial_type', 'resp.rt']
+    assert events['duration'].isna().all()
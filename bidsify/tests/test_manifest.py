@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+import os
+import os.path as op
+import sys
+import pytest
+from bidsify.manifest import (write_session_manifest, write_dataset_manifest,
+                              write_text, hash_file, open_hashed, get_digests,
+                              move_digest, forget_digests, MANIFEST_FILE, _DIGESTS)
+from bidsify.utils import _compress, _decompress, _run_cmd
+
+
+def test_session_manifest(tmpdir):
+    """ Tests writing session and dataset manifests """
+
+    root = str(tmpdir)
+    func = op.join(root, 'sub-01', 'ses-1', 'func')
+    os.makedirs(func)
+    f_nii = op.join(func, 'sub-01_ses-1_task-rest_bold.nii')
+    with open(f_nii, 'wb') as f:
+        f.write(b'\x00' * 10000)
+    _compress(f_nii, pigz=False)
+    write_text(op.join(func, 'sub-01_ses-1_task-rest_bold.json'), '{}')
+    with open(op.join(func, 'sub-01_ses-1_task-rest_events.tsv'), 'w') as f:
+        f.write('onset\tduration\n')  # not hashed while writing
+
+    write_session_manifest(op.join(root, 'sub-01', 'ses-1'), root)
+    write_text(op.join(root, 'participants.tsv'), 'participant_id\nsub-01\n')
+    manifest = write_dataset_manifest(root, [op.join(root, 'participants.tsv')])
+
+    with open(manifest) as f:
+        lines = [line.split('  ') for line in f.read().splitlines()]
+    assert [l[1] for l in lines] == ['participants.tsv',
+                                     'sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.json',
+                                     'sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz',
+                                     'sub-01/ses-1/func/sub-01_ses-1_task-rest_events.tsv']
+    for digest, path in lines:
+        assert digest == hash_file(op.join(root, path))
+
+    assert op.isfile(op.join(root, 'sub-01', 'ses-1', MANIFEST_FILE))
+
+
+def test_hash_tool_stdout(tmpdir):
+    """ Tests hashing the output of a tool that writes to stdout """
+
+    f = op.join(str(tmpdir), 'out.txt')
+    with open_hashed(f) as f_out:
+        _run_cmd([sys.executable, '-c', 'print("x" * 10 ** 6)'], stdout_to=f_out)
+
+    assert op.getsize(f) > 10 ** 6
+    assert op.abspath(f) in _DIGESTS
+    assert get_digests([f])[f] == hash_file(f)
+
+
+def test_compress_level(tmpdir):
+    """ Tests compressing at a given level and decompressing """
+
+    f_nii = op.join(str(tmpdir), 'img.nii')
+    data = ' '.join(str(i ** 2) for i in range(20000)).encode()
+    sizes = []
+    for level in [1, 9]:
+        with open(f_nii, 'wb') as f:
+            f.write(data)
+        _compress(f_nii, pigz=False, level=level)
+        sizes.append(op.getsize(f_nii + '.gz'))
+    assert sizes[1] < sizes[0]
+
+    _decompress(f_nii + '.gz')
+    assert not op.isfile(f_nii + '.gz')
+    with open(f_nii, 'rb') as f:
+        assert f.read() == data
+    assert _DIGESTS.pop(op.abspath(f_nii)) == hash_file(f_nii)
+
+
+def test_move_and_forget_digests(tmpdir):
+    """ Tests keeping track of digests of moved and removed files """
+
+    f = op.join(str(tmpdir), 'a.json')
+    write_text(f, '{}')
+    os.rename(f, f.replace('a.json', 'b.json'))
+    move_digest(f, f.replace('a.json', 'b.json'))
+    assert op.abspath(f) not in _DIGESTS
+    assert _DIGESTS[op.abspath(f.replace('a.json', 'b.json'))] == hash_file(f.replace('a.json', 'b.json'))
+
+    forget_digests(str(tmpdir))
+    assert not [p for p in _DIGESTS if p.startswith(op.abspath(str(tmpdir)))]
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='fake pigz is a shell script')
+def test_compress_failure(tmpdir, monkeypatch):
+    """ Tests keeping the uncompressed file if pigz fails """
+
+    bin_dir = op.join(str(tmpdir), 'bin')
+    os.makedirs(bin_dir)
+    with open(op.join(bin_dir, 'pigz'), 'w') as f:
+        f.write('#!/bin/sh\necho partial\nexit 1\n')
+    os.chmod(op.join(bin_dir, 'pigz'), 0o755)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+
+    f_nii = op.join(str(tmpdir), 'x.nii')
+    with open(f_nii, 'wb') as f:
+        f.write(b'\x00' * 10000)
+
+    with pytest.raises(ValueError, match='pigz'):
+        _compress(f_nii, pigz=True)
+    assert op.getsize(f_nii) == 10000
+    assert not op.isfile(f_nii + '.gz')
+    assert op.abspath(f_nii + '.gz') not in _DIGESTS
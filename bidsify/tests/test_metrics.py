@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import subprocess
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import pytest
+from bidsify.metrics import Metrics, get_metrics, start_metrics_server
+
+
+def test_metrics_render():
+    """ Tests rendering metrics in the Prometheus text format """
+
+    metrics = Metrics()
+    metrics.session_queued(4)
+    metrics.session_started()
+    metrics.session_finished(n_bytes=1000)
+    metrics.session_started()
+    metrics.session_finished('skipped')
+    metrics.session_started()
+    metrics.observe_stage('convert', 0.3)
+    metrics.observe_stage('convert', 20)
+
+    lines = metrics.render().splitlines()
+    assert 'bidsify_sessions{state="queued"} 1' in lines
+    assert 'bidsify_sessions{state="running"} 1' in lines
+    assert 'bidsify_sessions{state="done"} 1' in lines
+    assert 'bidsify_sessions{state="skipped"} 1' in lines
+    assert 'bidsify_sessions{state="empty"} 0' in lines
+    assert 'bidsify_converted_bytes_total 1000' in lines
+    assert 'bidsify_stage_seconds_bucket{stage="convert",le="0.1"} 0' in lines
+    assert 'bidsify_stage_seconds_bucket{stage="convert",le="0.5"} 1' in lines
+    assert 'bidsify_stage_seconds_bucket{stage="convert",le="+Inf"} 2' in lines
+    assert 'bidsify_stage_seconds_count{stage="convert"} 2' in lines
+    assert 'bidsify_tool_processes{tool="dcm2niix"} 0' in lines
+
+
+def test_metrics_server():
+    """ Tests serving the metrics over HTTP """
+
+    server = start_metrics_server(0)
+    assert start_metrics_server(0) is server
+    url = 'http://127.0.0.1:%i' % server.server_address[1]
+    get_metrics().observe_stage('reorient', 1.)
+
+    body = urlopen(url + '/metrics').read().decode()
+    assert 'bidsify_stage_seconds_count{stage="reorient"}' in body
+    assert 'bidsify_memory_bytes{kind="max_rss"}' in body
+
+    with pytest.raises(HTTPError):
+        urlopen(url + '/other')
+
+
+def test_metrics_not_imported():
+    """ Tests that the metrics (and HTTP server) are only imported on demand """
+
+    code = "import sys, bidsify; assert 'bidsify.metrics' not in sys.modules"
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_bidsify_metrics(nifti_dataset):
+    """ Tests the session states of a (re-)run of bidsify """
+
+    ds = nifti_dataset(metrics_port=0)
+    metrics = get_metrics()
+    before = dict(metrics.sessions)
+    ds.run()
+    ds.run()  # the session was converted already
+
+    assert metrics.sessions['done'] == before['done'] + 1
+    assert metrics.sessions['skipped'] == before['skipped'] + 1
+    assert metrics.sessions['running'] == before['running']
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+import shutil
+import subprocess
+import warnings
+import numpy as np
+import nibabel as nib
+import os.path as op
+import pytest
+from nibabel import parrec
+from bidsify.par2nifti import convert_par
+from bidsify.mri2nifti import convert_mri_file
+from bidsify.utils import check_executable
+
+NIB_DATA = op.join(op.dirname(nib.__file__), 'tests', 'data')
+
+
+def _copy_par(name, dst_dir, rec_data=True):
+    par = op.join(dst_dir, name + '.PAR')
+    shutil.copy(op.join(NIB_DATA, name + '.PAR'), par)
+    rec = op.join(dst_dir, name + '.REC')
+    if rec_data is True:
+        shutil.copy(op.join(NIB_DATA, name + '.REC'), rec)
+    else:
+        rec_data.tofile(rec)
+    return par, rec
+
+
+def _load_reference(par):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        img = parrec.load(par, scaling='fp', permit_truncated=True,
+                          strict_sort=True)
+        return img, np.asanyarray(img.dataobj)
+
+
+@pytest.mark.parametrize('name', ['phantom_varscale', 'phantom_truncated'])
+@pytest.mark.parametrize('compress', [True, False])
+def test_convert_par(tmpdir, name, compress):
+    """ Tests in-process PAR/REC conversion against nibabel """
+
+    par, rec = _copy_par(name, str(tmpdir))
+    img, ref = _load_reference(par)
+    scan_info = dict()
+    outputs = convert_par(par, rec, str(tmpdir), 'sub-01_bold',
+                          compress=compress, scan_info=scan_info)
+
+    ext = '.nii.gz' if compress else '.nii'
+    assert outputs == [op.join(str(tmpdir), 'sub-01_bold.json'),
+                       op.join(str(tmpdir), 'sub-01_bold' + ext)]
+    nii = nib.load(outputs[1])
+    np.testing.assert_allclose(nii.get_fdata(), ref, rtol=1e-5)  # float32
+    np.testing.assert_allclose(nii.affine, img.header.get_affine(origin='scanner'))
+    assert nii.header.get_zooms()[3] == 2.0
+    assert scan_info['n_volumes'] == ref.shape[3]
+
+    with open(outputs[0]) as f:
+        md = json.load(f)
+    assert md['RepetitionTime'] == 2.0
+    assert md['Manufacturer'] == 'Philips'
+
+
+def test_convert_par_fmap(tmpdir):
+    """ Tests in-process conversion of a B0 fieldmap via convert_mri_file """
+
+    rec_data = np.arange(80 * 80 * 20, dtype='uint16')
+    par, rec = _copy_par('fieldmap', str(tmpdir), rec_data=rec_data)
+    os.rename(par, op.join(str(tmpdir), 'sub-01_B0.PAR'))
+    os.rename(rec, op.join(str(tmpdir), 'sub-01_B0.REC'))
+    par = op.join(str(tmpdir), 'sub-01_B0.PAR')
+
+    cfg = dict(options=dict(mri_ext='PAR', par_engine='nibabel', debug=False),
+               fmap=dict(b0=dict(id='B0')))
+    outputs = convert_mri_file(par, cfg, compress=False)
+    assert [op.basename(f) for f in outputs] == [
+        'sub-01_B0_magnitude1.nii', 'sub-01_B0_phasediff.json',
+        'sub-01_B0_phasediff.nii'
+    ]
+    assert not op.isfile(par)
+    assert nib.load(outputs[0]).shape == (80, 80, 10)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='fake FSL is a shell script')
+def test_bidsify_par_reorient_manifest(tmpdir, monkeypatch, dataset):
+    """ Tests the manifest of uncompressed niftis that are reoriented """
+
+    ds = dataset(dict(
+        options=dict(mri_ext='PAR', par_engine='nibabel', compression=0,
+                     deface=False),
+        mappings=dict(bold='_bold'),
+        func=dict(rest=dict(id='pioprs', task='rest'))
+    ))
+    monkeypatch.delenv('TRAVIS')  # with (fake) FSL
+    bin_dir = op.join(str(tmpdir), 'bin')
+    os.makedirs(bin_dir)
+    with open(op.join(bin_dir, 'fslreorient2std'), 'w') as f:
+        # Changes the image (trailing bytes are ignored by nibabel)
+        f.write('#!/bin/sh\ncp "$1" "$2"\nprintf x >> "$2"\n')
+    os.chmod(op.join(bin_dir, 'fslreorient2std'), 0o755)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+    check_executable.cache_clear()
+
+    sess_dir = op.join(ds.raw_dir, 'sub-01')
+    os.makedirs(sess_dir)
+    par, rec = _copy_par('phantom_varscale', sess_dir)
+    os.rename(par, op.join(sess_dir, 'sub-01_pioprs_bold.PAR'))
+    os.rename(rec, op.join(sess_dir, 'sub-01_pioprs_bold.REC'))
+
+    bids_dir = ds.bids_dir
+    try:
+        ds.run()
+    finally:
+        check_executable.cache_clear()
+
+    bold = op.join(bids_dir, 'sub-01', 'func', 'sub-01_task-rest_bold.nii')
+    with open(bold, 'rb') as f:
+        assert f.read()[-1:] == b'x'  # reoriented
+
+    res = subprocess.run(['sha256sum', '-c', '.bidsify_manifest.sha256'],
+                         cwd=bids_dir, stdout=subprocess.PIPE)
+    assert res.returncode == 0, res.stdout.decode()
+    assert b'sub-01_task-rest_bold.nii: OK' in res.stdout
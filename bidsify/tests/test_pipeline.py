@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from bidsify.pipeline import TaskGraph
+
+
+def test_task_graph():
+    """ Tests running a graph that is expanded while running """
+
+    order = []
+    graph = TaskGraph()
+
+    def _expand():
+        order.append('expand')
+        graph.add('late', order.append, args=('late',))
+        graph.add_dependency('barrier', 'late')
+
+    graph.add('final', order.append, args=('final',), deps=['barrier'])
+    graph.add('barrier', None, deps=['expand'])
+    graph.add('expand', _expand)
+
+    with ThreadPoolExecutor(2) as pool:
+        graph.run(submit=pool.submit)
+
+    assert order == ['expand', 'late', 'final']
+
+
+def test_task_graph_errors():
+    """ Tests errors of the task graph """
+
+    graph = TaskGraph()
+    graph.add('a', None, deps=['does-not-exist'])
+    with pytest.raises(ValueError):
+        graph.run()
+
+    def _fail():
+        raise IOError('failed')
+
+    graph = TaskGraph()
+    graph.add('a', _fail)
+    graph.add('b', print, deps=['a'])
+    with pytest.raises(IOError):
+        graph.run()
@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+import os
+import time
+import os.path as op
+from shutil import copytree
+from bidsify.prefetch import Prefetcher, PrefetchedSource
+from bidsify.sources import DirSource
+
+
+def _wait_for(func, timeout=10):
+    t_start = time.time()
+    while not func():
+        assert time.time() - t_start < timeout
+        time.sleep(0.01)
+
+
+def test_prefetcher(tmpdir):
+    """ Tests prefetching sessions within a byte budget """
+
+    sessions = []
+    for i, size in enumerate([1000, 1000, 1000, 5000]):
+        sess_dir = op.join(str(tmpdir), 'raw', 'sub-0%i' % i)
+        os.makedirs(sess_dir)
+        with open(op.join(sess_dir, 'sub-0%i_bold.PAR' % i), 'wb') as f:
+            f.write(b'x' * size)
+        sessions.append((sess_dir, DirSource(sess_dir)))
+
+    prefetch_dir = op.join(str(tmpdir), 'prefetch')
+    prefetcher = Prefetcher(prefetch_dir, budget=2.5e-6)  # ~2.7 kB
+    prefetcher.start(sessions)
+    _wait_for(lambda: len(prefetcher._ready) == 2)
+    assert prefetcher.used == 2000
+
+    source = prefetcher.take(*sessions[0])
+    assert isinstance(source, PrefetchedSource)
+    assert source.path == sessions[0][0]
+    files = source.list_files()
+    assert [op.basename(f) for f in files] == ['sub-00_bold.PAR']
+    assert files[0].startswith(prefetch_dir)
+
+    work_dir = op.join(str(tmpdir), 'work')
+    os.makedirs(work_dir)
+    out = source.copy_files(files, work_dir)
+    assert op.getsize(out[0]) == 1000
+    assert op.isfile(op.join(sessions[0][0], 'sub-00_bold.PAR'))
+
+    # Only when a session is done, the next one fits in the budget
+    assert sessions[2][0] not in prefetcher._ready
+    prefetcher.release(sessions[0][0])
+    _wait_for(lambda: sessions[2][0] in prefetcher._ready)
+
+    # Larger than the budget: read from the source itself
+    _wait_for(lambda: not prefetcher._thread.is_alive())
+    assert prefetcher.take(*sessions[3]) is sessions[3][1]
+
+    prefetcher.stop()
+    assert not op.isdir(prefetch_dir)
+
+
+def test_bidsify_prefetch(nifti_dataset):
+    """ Tests bidsify with prefetching of the raw data """
+
+    ds = nifti_dataset(prefetch=1)
+    raw_dir = ds.raw_dir
+    copytree(op.join(raw_dir, 'sub-01'), op.join(raw_dir, 'sub-02'))
+
+    index = ds.run()
+    for sub in ['01', '02']:
+        assert index.get(sub=sub, suffix='bold', extension='.nii.gz')
+        assert op.isfile(op.join(raw_dir, 'sub-%s' % sub, 'ses-1',
+                                 'sub-01_pioprs_bold.nii.gz'))
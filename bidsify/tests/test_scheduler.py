@@ -0,0 +1,126 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import time
+import shutil
+import threading
+from bidsify.scheduler import ToolScheduler, usage_tags, _add_thread_args
+
+
+def test_add_thread_args():
+    """ Tests passing thread counts to tools """
+    assert _add_thread_args(['pigz', 'f.nii'], 'pigz', 4) == ['pigz', '-p', '4', 'f.nii']
+    assert _add_thread_args(['dcm2niix', 'f'], 'dcm2niix', 4) == ['dcm2niix', 'f']
+
+
+def test_scheduler_configure():
+    """ Tests resizing the worker pools when the CPU budget changes """
+
+    sched = ToolScheduler(n_cores=2)
+    pool = sched._pool
+    sched.configure(n_cores=2)
+    assert sched._pool is pool
+
+    sched.configure(n_cores=3)
+    assert sched._pool is not pool
+    assert sched._pool._max_workers == 3
+    assert sched.map(lambda x: x * 2, range(5)) == [0, 2, 4, 6, 8]
+
+
+def test_scheduler_run_many():
+    """ Tests running commands concurrently within a CPU budget """
+
+    sched = ToolScheduler(n_cores=2, tool_limits={'python': {'slots': 1}})
+    cmd = [sys.executable, '-c', 'import os; print(os.environ["OMP_NUM_THREADS"])']
+    results = sched.run_many([cmd] * 3)
+    assert [r.returncode for r in results] == [0, 0, 0]
+    assert all(r.stdout.strip() == '1' for r in results)
+
+    res = sched.run(['bidsify-non-existing-tool'])
+    assert res.returncode != 0
+
+
+def test_scheduler_usage():
+    """ Tests recording the resource usage of tools """
+
+    sched = ToolScheduler(n_cores=2)
+    cmd = [sys.executable, '-c', 'x = bytearray(50 * 2 ** 20)']
+    with usage_tags(session='sub-01', input_file='f.PAR'):
+        sched.map(lambda i: sched.run(cmd), range(2))
+    sched.run(cmd)
+
+    report = sched.usage_report()
+    assert len(report) == 3
+    assert (report['returncode'] == 0).all()
+    assert report['max_rss_mb'].min() > 50
+    assert (report['wall_time'] > 0).all() and (report['user_time'] > 0).all()
+
+    sub = sched.usage_report(session='sub-01')
+    assert len(sub) == 2 and (sub['input_file'] == 'f.PAR').all()
+
+    summary = sched.usage_report(by='tool')
+    assert summary['n_calls'].tolist() == [3]
+
+
+def test_scheduler_timeout():
+    """ Tests killing (and retrying) tools that time out or hang """
+
+    sched = ToolScheduler(n_cores=2, tool_limits={
+        'python': dict(timeout=1, retries=1, backoff=0)
+    })
+    # The child process (in the same process group) is killed as well
+    cmd = [sys.executable, '-c',
+           'import subprocess, sys, time; '
+           'subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]); '
+           'time.sleep(60)']
+    t_start = time.time()
+    cleaned = []
+    res = sched.run(cmd, before_retry=lambda: cleaned.append(True))
+    assert res.returncode < 0
+    assert time.time() - t_start < 20
+    assert cleaned == [True]  # once, before the retry
+
+    report = sched.usage_report()
+    assert report['attempt'].tolist() == [1, 2]
+    assert (report['killed'] == 'timeout').all()
+
+    sched.configure(tool_limits={'python': dict(timeout=None, hang_timeout=1,
+                                                retries=0)})
+    res = sched.run([sys.executable, '-c', 'import time; time.sleep(60)'])
+    assert res.returncode < 0
+    assert sched.usage_report(start=2)['killed'].tolist() == ['hang']
+
+    # CPU time of child processes counts as progress
+    cmd = [sys.executable, '-c',
+           'import subprocess, sys; subprocess.call([sys.executable, "-c", '
+           '"import time\\nt = time.time()\\nwhile time.time() - t < 3: pass"])']
+    assert sched.run(cmd).returncode == 0
+
+    # Output counts as progress
+    cmd = [sys.executable, '-c',
+           'import time\nfor i in range(3):\n    print(i, flush=True); time.sleep(0.6)']
+    assert sched.run(cmd).returncode == 0
+
+
+def test_scheduler_admit(tmpdir):
+    """ Tests admitting sessions based on free disk space """
+
+    scheduler = ToolScheduler(n_cores=2)
+    path = str(tmpdir)
+    too_big = shutil.disk_usage(path).free
+    started = []
+
+    def _second():
+        with scheduler.admit(disk=1, path=path, name='sub-02'):
+            started.append(time.time())
+
+    # A session is admitted when nothing else runs, even if it is too big
+    with scheduler.admit(disk=too_big, memory=0, path=path, name='sub-01'):
+        thread = threading.Thread(target=_second)
+        thread.start()
+        time.sleep(0.2)
+        assert not started
+        t_done = time.time()
+
+    thread.join()
+    assert started[0] >= t_done
+    assert scheduler._admitted == []
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+import os
+import os.path as op
+import pytest
+import tarfile
+import zipfile
+from shutil import rmtree
+from bidsify.sources import (find_session_sources, archive_stem,
+                             drop_duplicate_sources)
+
+
+def test_archive_stem():
+    """ Tests stripping archive extensions """
+    assert archive_stem('/raw/sub-01/ses-1.tar.bz2') == 'ses-1'
+    assert archive_stem('sub-01.zip') == 'sub-01'
+
+
+def test_drop_duplicate_sources(tmpdir):
+    """ Tests skipping archives with the same name as a directory """
+    sub_dir = op.join(str(tmpdir), 'sub-01')
+    os.makedirs(op.join(sub_dir, 'ses-1'))
+    paths = [op.join(str(tmpdir), 'sub-01.tar.gz'), sub_dir,
+             op.join(str(tmpdir), 'sub-02.zip')]
+    for f in paths[::2] + [op.join(sub_dir, 'ses-1.zip')]:
+        open(f, 'w').close()
+
+    with pytest.warns(UserWarning, match='same name'):
+        assert drop_duplicate_sources(paths) == paths[1:]
+
+    with pytest.warns(UserWarning, match='same name'):
+        sessions = find_session_sources(sub_dir)
+    assert [(c, is_sess) for c, is_sess, _ in sessions] == [
+        (op.join(sub_dir, 'ses-1'), True)]
+
+
+def test_bidsify_from_archives(nifti_dataset):
+    """ Tests converting sessions that are stored in tar/zip archives """
+
+    ds = nifti_dataset()
+    raw_dir = ds.raw_dir
+    sub_dir = op.join(raw_dir, 'sub-01')
+    sess_dir = op.join(sub_dir, 'ses-1')
+
+    # sub-01: one (compressed) tar for the subject, with a top-level dir
+    with tarfile.open(op.join(raw_dir, 'sub-01.tar.bz2'), 'w:bz2') as tar:
+        tar.add(sub_dir, arcname='sub-01')
+
+    # sub-02: a zip per session
+    os.makedirs(op.join(raw_dir, 'sub-02'))
+    with zipfile.ZipFile(op.join(raw_dir, 'sub-02', 'ses-1.zip'), 'w') as zf:
+        for f in os.listdir(sess_dir):
+            zf.write(op.join(sess_dir, f), arcname=f.replace('sub-01', 'sub-02'))
+    rmtree(sub_dir)
+
+    sessions = find_session_sources(op.join(raw_dir, 'sub-01.tar.bz2'))
+    assert [(op.basename(c), is_sess) for c, is_sess, _ in sessions] == [('ses-1', True)]
+    assert len(sessions[0][2].list_files()) == 10
+
+    bids_dir = ds.bids_dir
+    ds.run()
+
+    for sub in ['sub-01', 'sub-02']:
+        func = op.join(bids_dir, sub, 'ses-1', 'func')
+        assert op.isfile(op.join(func, '%s_ses-1_task-rest_bold.nii.gz' % sub))
+        assert op.isfile(op.join(func, '%s_ses-1_task-rest_events.tsv' % sub))
+
+    # Files that match none of the mappings are not extracted
+    assert not op.isdir(op.join(bids_dir, 'unallocated'))
@@ -1,15 +1,20 @@
 import platform
 import subprocess
 import os
+import errno
 import json
 import gzip
 import shutil
 import os.path as op
 from glob import glob
+from functools import lru_cache
+from .scheduler import get_scheduler
+from .manifest import open_hashed, write_text
 
 
+@lru_cache(maxsize=None)
 def check_executable(executable):
-    """ Checks if executable is available.
+    """ Checks if executable is available (the result is cached).
 
     Params
     ------
@@ -43,31 +48,78 @@ def _append_to_json(json_path, to_append):
         print(msg)
         metadata = to_append
 
-    with open(json_path, 'w') as new_metadata_file:
-        json.dump(metadata, new_metadata_file, indent=4)
+    write_text(json_path, json.dumps(metadata, indent=4))
 
+    return metadata
 
-def _compress(f, pigz):
 
-    if pigz:
-        cmd = ['pigz', f]
-        with open(os.devnull, 'w') as devnull:
-            subprocess.call(cmd, stdout=devnull)
-    else:
-        with open(f, 'rb') as f_in, gzip.open(f + '.gz', 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(f)
+def _compress(f, pigz, level=None):
+    """ Compresses a file (and hashes the compressed data while writing
+    it, for the checksum manifest) at the given gzip level (1-9), or at the
+    default level of pigz/gzip if None. """
+
+    try:
+        # The digest is only recorded if the file is written completely
+        with open_hashed(f + '.gz') as f_out:
+            if pigz:
+                level = [] if level is None else ['-%i' % level]
+                rs = _run_cmd(['pigz', '-c'] + level + [f], stdout_to=f_out)
+                if rs != 0:
+                    raise ValueError("pigz could not compress %s (return code "
+                                     "%i)!" % (f, rs))
+            else:
+                level = 9 if level is None else level
+                with open(f, 'rb') as f_in, gzip.GzipFile(fileobj=f_out, mode='wb',
+                                                          compresslevel=level) as f_gz:
+                    shutil.copyfileobj(f_in, f_gz)
+    except Exception:
+        # Keep the uncompressed file and remove the partial output
+        if op.isfile(f + '.gz'):
+            os.remove(f + '.gz')
+        raise
+
+    os.remove(f)
+
+
+def _decompress(f):
+    """ Decompresses a gzipped file (e.g. a nifti that should be stored
+    uncompressed) and hashes the decompressed data while writing it. """
+
+    with gzip.open(f, 'rb') as f_in, open_hashed(f[:-3]) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(f)
 
 
 def _make_dir(path):
     """ Creates dir-if-not-exists-already. """
 
-    if not op.isdir(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)  # safe if created concurrently
 
     return path
 
 
+def _publish_dir(src, dst):
+    """ Moves a (finished) directory to its final location, such that it
+    appears there at once. Across filesystems, it is copied to a hidden
+    directory next to dst first, which is then renamed. """
+
+    try:
+        os.rename(src, dst)
+        return dst
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    partial = op.join(op.dirname(dst), '.%s.partial' % op.basename(dst))
+    if op.isdir(partial):  # left over from an interrupted run
+        shutil.rmtree(partial)
+
+    shutil.copytree(src, partial)
+    os.rename(partial, dst)
+    shutil.rmtree(src)
+    return dst
+
+
 def _glob(path, wildcards):
     """ Finds files with different wildcards. """
 
@@ -78,16 +130,12 @@ def _glob(path, wildcards):
     return sorted(files)
 
 
-def _run_cmd(cmd, verbose=False, outfile=None):
+def _run_cmd(cmd, verbose=False, outfile=None, env=None, stdout_to=None,
+             before_retry=None):
+    """ Runs an external command through the (persistent) tool scheduler,
+    which enforces the CPU budget and per-tool limits (see ToolScheduler.run). """
 
-    if verbose:
-        if outfile is None:
-            rs = subprocess.call(cmd)
-        else:
-            with open(outfile, 'w') as f:
-                rs = subprocess.call(cmd, stdout=f)
-    else:
-        with open(os.devnull, 'w') as devnull:
-            rs = subprocess.call(cmd, stdout=devnull)
+    res = get_scheduler().run(cmd, verbose=verbose, outfile=outfile, env=env,
+                              stdout_to=stdout_to, before_retry=before_retry)
+    return res.returncode
 
-    return rs